@@ -3,6 +3,10 @@ import os
 import psycopg2
 from typing import Dict, Any, List
 
+from tracing import span, traced_handler
+
+
+@traced_handler('admin-stats')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Get feedback statistics for admin panel
@@ -48,36 +52,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Database not configured'})
         }
     
-    conn = psycopg2.connect(database_url)
+    with span('db_connect'):
+        conn = psycopg2.connect(database_url)
     cur = conn.cursor()
     
-    cur.execute("""
-        SELECT 
-            COUNT(*) as total,
-            SUM(CASE WHEN feedback_type = 'positive' THEN 1 ELSE 0 END) as positive_count,
-            SUM(CASE WHEN feedback_type = 'negative' THEN 1 ELSE 0 END) as negative_count
-        FROM message_feedback
-    """)
+    with span('db_stats'):
+        cur.execute("""
+            SELECT 
+                COUNT(*) as total,
+                SUM(CASE WHEN feedback_type = 'positive' THEN 1 ELSE 0 END) as positive_count,
+                SUM(CASE WHEN feedback_type = 'negative' THEN 1 ELSE 0 END) as negative_count
+            FROM message_feedback
+        """)
+        stats_row = cur.fetchone()
     
-    stats_row = cur.fetchone()
     total_count = stats_row[0] if stats_row else 0
     positive_count = stats_row[1] if stats_row else 0
     negative_count = stats_row[2] if stats_row else 0
     
-    cur.execute("""
-        SELECT 
-            message_id,
-            user_message,
-            agent_response,
-            feedback_type,
-            created_at
-        FROM message_feedback
-        ORDER BY created_at DESC
-        LIMIT 50
-    """)
+    with span('db_recent'):
+        cur.execute("""
+            SELECT 
+                message_id,
+                user_message,
+                agent_response,
+                feedback_type,
+                created_at
+            FROM message_feedback
+            ORDER BY created_at DESC
+            LIMIT 50
+        """)
+        rows = cur.fetchall()
     
     recent_feedback: List[Dict[str, Any]] = []
-    for row in cur.fetchall():
+    for row in rows:
         recent_feedback.append({
             'message_id': row[0],
             'user_message': row[1][:100] if row[1] else '',
@@ -0,0 +1,82 @@
+import contextvars
+import json
+import os
+import random
+import re
+from typing import Any
+
+LEVELS = {'debug': 10, 'info': 20, 'warn': 30, 'error': 40}
+LOG_LEVEL = LEVELS.get(os.environ.get('LOG_LEVEL', 'info').lower(), 20)
+# Share of requests whose full payloads (receipts, provider responses) are logged at debug level
+LOG_PAYLOAD_SAMPLE = float(os.environ.get('LOG_PAYLOAD_SAMPLE', '0.05'))
+LOG_PAYLOAD_MAX = int(os.environ.get('LOG_PAYLOAD_MAX', '4000'))
+
+_sampled: contextvars.ContextVar = contextvars.ContextVar('log_sampled', default=None)
+
+_EMAIL_RE = re.compile(r'([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*@([A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,})')
+_AUTH_RE = re.compile(r'\b(Bearer|Basic|Api-Key)\s+[A-Za-z0-9._~+/=-]+')
+_SECRET_RE = re.compile(
+    r'''(["']?\w*(?:token|password|pass|secret|auth_key|api_key)["']?\s*[:=]\s*["'])[^"']*(["'])''',
+    re.IGNORECASE
+)
+
+
+def mask(text: str) -> str:
+    '''Hide emails (a***@mail.ru), auth headers and secret-looking fields'''
+    text = _EMAIL_RE.sub(r'\1***@\2', text)
+    text = _AUTH_RE.sub(r'\1 ***', text)
+    return _SECRET_RE.sub(r'\1***\2', text)
+
+
+def enabled(level: str) -> bool:
+    return LEVELS[level] >= LOG_LEVEL
+
+
+def begin_request() -> None:
+    '''Decide once per request whether its payloads are logged'''
+    _sampled.set(random.random() < LOG_PAYLOAD_SAMPLE)
+
+
+def _emit(level: str, msg: str, args: tuple, fields: dict) -> None:
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = f'{msg} {args!r}'
+    record = {'level': level, 'msg': mask(msg)}
+    for key, value in fields.items():
+        record[key] = mask(value) if isinstance(value, str) else value
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def debug(msg: str, *args: Any, **fields: Any) -> None:
+    if LOG_LEVEL <= 10:
+        _emit('debug', msg, args, fields)
+
+
+def info(msg: str, *args: Any, **fields: Any) -> None:
+    if LOG_LEVEL <= 20:
+        _emit('info', msg, args, fields)
+
+
+def warn(msg: str, *args: Any, **fields: Any) -> None:
+    if LOG_LEVEL <= 30:
+        _emit('warn', msg, args, fields)
+
+
+def error(msg: str, *args: Any, **fields: Any) -> None:
+    if LOG_LEVEL <= 40:
+        _emit('error', msg, args, fields)
+
+
+def payload(msg: str, value: Any) -> None:
+    '''
+    Debug log of a large object. Serialized only when debug is enabled and
+    the request was sampled by begin_request (outside a request: always).
+    '''
+    if LOG_LEVEL > 10 or _sampled.get() is False:
+        return
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) > LOG_PAYLOAD_MAX:
+        text = text[:LOG_PAYLOAD_MAX] + f'...(+{len(text) - LOG_PAYLOAD_MAX} chars)'
+    _emit('debug', msg, (), {'payload': text})
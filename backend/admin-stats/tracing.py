@@ -0,0 +1,137 @@
+import contextvars
+import functools
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import log
+
+# TRACING=0 turns spans into no-ops and drops the Server-Timing header
+TRACING_ENABLED = os.environ.get('TRACING', '1').lower() not in ('0', 'false', 'no')
+
+_current: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+_METRIC_NAME_RE = re.compile(r'[^A-Za-z0-9_-]')
+
+
+class Trace:
+    '''Spans of one request: (name, milliseconds), aggregated by name on output'''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+
+    def add(self, name: str, milliseconds: float) -> None:
+        # list.append is atomic, spans may finish on worker threads
+        self.spans.append((name, milliseconds))
+
+    def totals(self) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for name, milliseconds in self.spans:
+            totals[name] = totals.get(name, 0.0) + milliseconds
+        return totals
+
+    def server_timing(self, total_ms: float) -> str:
+        parts = [f'{_METRIC_NAME_RE.sub("_", name)};dur={ms:.1f}' for name, ms in self.totals().items()]
+        parts.append(f'total;dur={total_ms:.1f}')
+        return ', '.join(parts)
+
+
+@contextmanager
+def _timed(trace: Trace, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, (time.perf_counter() - started) * 1000)
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+def span(name: str):
+    '''with span('llm'): ... -- records into the request's trace, if any'''
+    trace = _current.get() if TRACING_ENABLED else None
+    if trace is None:
+        return _noop()
+    return _timed(trace, name)
+
+
+def in_current_trace(fn: Callable) -> Callable:
+    '''
+    fn bound to the calling request's trace. ContextVars do not follow work
+    into ThreadPoolExecutor workers: wrap what is submitted there, or its
+    spans are dropped.
+    '''
+    trace = _current.get()
+    if trace is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+
+def traced(name: str) -> Callable:
+    '''Decorator form of span(); returns the function untouched when tracing is off'''
+    def decorator(fn: Callable) -> Callable:
+        if not TRACING_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            with _timed(trace, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_handler(function_name: str) -> Callable:
+    '''
+    Wrap a cloud function handler: opens a trace per invocation, adds the
+    Server-Timing header to the response and prints one JSON timing line.
+    '''
+    def decorator(handler: Callable) -> Callable:
+        if not TRACING_ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            trace = Trace(function_name)
+            token = _current.set(trace)
+            status: Optional[int] = None
+            try:
+                response = handler(event, context)
+                if isinstance(response, dict):
+                    status = response.get('statusCode')
+                    total_ms = (time.perf_counter() - trace.started) * 1000
+                    headers = response.setdefault('headers', {})
+                    headers['Server-Timing'] = trace.server_timing(total_ms)
+                    headers['Timing-Allow-Origin'] = '*'
+                    headers['Access-Control-Expose-Headers'] = 'Server-Timing'
+                return response
+            finally:
+                _current.reset(token)
+                total_ms = (time.perf_counter() - trace.started) * 1000
+                log.info(
+                    'timing',
+                    function=function_name,
+                    method=event.get('httpMethod') if isinstance(event, dict) else None,
+                    status=status,
+                    total_ms=round(total_ms, 1),
+                    spans={name: round(ms, 1) for name, ms in trace.totals().items()}
+                )
+        return wrapper
+    return decorator
@@ -0,0 +1,117 @@
+import importlib.util
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Default read timeouts per host, seconds. Override with
+# HTTP_TIMEOUTS="app.ecomkassa.ru=20,gptunnel.ru=15"
+DEFAULT_HOST_TIMEOUTS: Dict[str, float] = {
+    'ngw.devices.sberbank.ru': 10,
+    'gigachat.devices.sberbank.ru': 5,
+    'llm.api.cloud.yandex.net': 10,
+    'gptunnel.ru': 10,
+    'app.ecomkassa.ru': 15
+}
+DEFAULT_TIMEOUT = 10.0
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+# Opt-in: HTTP2_ENABLED=1 and httpx[http2] installed on top of requirements.txt,
+# otherwise every call goes through requests over HTTP/1.1
+HTTP2_ENABLED = os.environ.get('HTTP2_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+RequestError: Tuple[type, ...] = (requests.RequestException,) + ((httpx.HTTPError,) if httpx else ())
+# Network-level failures only (no connection, timeout, dropped stream): a bad
+# status or unparseable body is an answer, not an outage
+TransportError: Tuple[type, ...] = (
+    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError
+) + ((httpx.TransportError,) if httpx else ())
+
+_sessions: Dict[Tuple[str, bool, bool], Any] = {}
+_sessions_lock = threading.Lock()
+
+
+def _parse_timeouts(raw: str) -> Dict[str, float]:
+    timeouts = dict(DEFAULT_HOST_TIMEOUTS)
+    for part in raw.split(','):
+        host, _, value = part.partition('=')
+        if host.strip() and value.strip():
+            try:
+                timeouts[host.strip()] = float(value)
+            except ValueError:
+                pass
+    return timeouts
+
+
+HOST_TIMEOUTS = _parse_timeouts(os.environ.get('HTTP_TIMEOUTS', ''))
+
+
+def _http2_available() -> bool:
+    if not (HTTP2_ENABLED and httpx):
+        return False
+    return importlib.util.find_spec('h2') is not None
+
+
+def get_session(host: str, verify: bool = True, http2: Optional[bool] = None):
+    '''
+    Persistent client per (host, verify) kept across warm invocations:
+    DNS, TCP and TLS are paid once, later calls reuse pooled connections.
+    '''
+    use_http2 = _http2_available() if http2 is None else (http2 and _http2_available())
+    key = (host, verify, use_http2)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            if use_http2:
+                session = httpx.Client(
+                    http2=True,
+                    verify=verify,
+                    limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE)
+                )
+            else:
+                session = requests.Session()
+                session.verify = verify
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+            _sessions[key] = session
+        return session
+
+
+def host_timeout(host: str) -> float:
+    return HOST_TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+
+
+def request(method: str, url: str, timeout: Optional[float] = None, verify: bool = True, stream: bool = False, **kwargs):
+    '''
+    Send request through the shared session for url's host. Streaming
+    responses always use requests so callers can rely on iter_lines().
+    '''
+    host = urlsplit(url).hostname or ''
+    read_timeout = timeout if timeout is not None else host_timeout(host)
+    if stream:
+        session = get_session(host, verify, http2=False)
+        return session.request(method, url, timeout=(CONNECT_TIMEOUT, read_timeout), stream=True, **kwargs)
+    session = get_session(host, verify)
+    if httpx is not None and isinstance(session, httpx.Client):
+        return session.request(method, url, timeout=httpx.Timeout(read_timeout, connect=CONNECT_TIMEOUT), **kwargs)
+    return session.request(method, url, timeout=(CONNECT_TIMEOUT, read_timeout), **kwargs)
+
+
+def post(url: str, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def get(url: str, **kwargs):
+    return request('GET', url, **kwargs)
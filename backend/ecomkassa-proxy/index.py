@@ -1,11 +1,15 @@
 import json
-import requests
 import urllib3
 from typing import Dict, Any
 
+import http_client
+import log
+from tracing import span, traced_handler
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+@traced_handler('ecomkassa-proxy')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Proxy requests to Ecomkassa API with Token authentication (ATOL Online v5 protocol)
@@ -39,6 +43,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    log.begin_request()
     body_str = event.get('body', '')
     if not body_str:
         body_data = {}
@@ -83,16 +88,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'Content-Type': 'application/json; charset=utf-8'
         }
         
-        print(f"Getting token from: {token_url}")
-        token_response = requests.post(
-            token_url, 
-            json=token_payload, 
-            headers=headers,
-            timeout=10, 
-            verify=False
-        )
-        print(f"Token response status: {token_response.status_code}")
-        print(f"Token response body: {token_response.text[:200]}")
+        log.debug('Getting token from: %s', token_url)
+        with span('token'):
+            token_response = http_client.post(
+                token_url, 
+                json=token_payload, 
+                headers=headers,
+                timeout=10, 
+                verify=False
+            )
+        log.debug('Token response status: %s', token_response.status_code)
+        log.payload('Token response body', token_response.text[:200])
         
         if token_response.status_code != 200:
             return {
@@ -135,14 +141,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'Content-Type': 'application/json; charset=utf-8'
         }
         
-        print(f"Requesting {api_method}: {url}")
+        log.debug('Requesting %s: %s', api_method, url)
         if api_payload:
-            print(f"Payload: {json.dumps(api_payload, ensure_ascii=False)}")
+            log.payload('Payload', api_payload)
         
         if api_method == 'POST' and api_payload:
-            response = requests.post(url, json=api_payload, headers=api_headers, timeout=10, verify=False)
+            with span('upstream'):
+                response = http_client.post(url, json=api_payload, headers=api_headers, timeout=10, verify=False)
         elif api_method == 'GET':
-            response = requests.get(url, headers=api_headers, timeout=10, verify=False)
+            with span('upstream'):
+                response = http_client.get(url, headers=api_headers, timeout=10, verify=False)
         else:
             return {
                 'statusCode': 400,
@@ -154,8 +162,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        print(f"Response status: {response.status_code}")
-        print(f"Response body: {response.text[:1000]}")
+        log.debug('Response status: %s', response.status_code)
+        log.payload('Response body', response.text[:1000])
         
         return {
             'statusCode': response.status_code,
@@ -166,7 +174,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False,
             'body': response.text
         }
-    except requests.RequestException as e:
+    except http_client.RequestError as e:
         return {
             'statusCode': 500,
             'headers': {
@@ -2,6 +2,10 @@ import json
 import os
 from typing import Dict, Any
 
+from tracing import span, traced_handler
+
+
+@traced_handler('get-receipts')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Get receipt history from database
@@ -53,33 +57,36 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     from psycopg2.extras import RealDictCursor
     
     try:
-        conn = psycopg2.connect(database_url)
+        with span('db_connect'):
+            conn = psycopg2.connect(database_url)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Проверяем, есть ли колонка payments
-        cursor.execute(
-            "SELECT column_name FROM information_schema.columns "
-            "WHERE table_name = 'receipts' AND column_name = 'payments'"
-        )
-        has_payments = cursor.fetchone() is not None
-        
-        if has_payments:
+        with span('db_schema'):
             cursor.execute(
-                f'SELECT id, external_id, user_message, operation_type, items, total, '
-                f'payment_type, payments, customer_email, status, demo_mode, created_at, uuid '
-                f'FROM receipts ORDER BY created_at DESC LIMIT {limit} OFFSET {offset}'
-            )
-        else:
-            cursor.execute(
-                f'SELECT id, external_id, user_message, operation_type, items, total, '
-                f'payment_type, customer_email, status, demo_mode, created_at, uuid '
-                f'FROM receipts ORDER BY created_at DESC LIMIT {limit} OFFSET {offset}'
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = 'receipts' AND column_name = 'payments'"
             )
+            has_payments = cursor.fetchone() is not None
         
-        receipts = cursor.fetchall()
+        with span('db_receipts'):
+            if has_payments:
+                cursor.execute(
+                    f'SELECT id, external_id, user_message, operation_type, items, total, '
+                    f'payment_type, payments, customer_email, status, demo_mode, created_at, uuid '
+                    f'FROM receipts ORDER BY created_at DESC LIMIT {limit} OFFSET {offset}'
+                )
+            else:
+                cursor.execute(
+                    f'SELECT id, external_id, user_message, operation_type, items, total, '
+                    f'payment_type, customer_email, status, demo_mode, created_at, uuid '
+                    f'FROM receipts ORDER BY created_at DESC LIMIT {limit} OFFSET {offset}'
+                )
+            receipts = cursor.fetchall()
         
-        cursor.execute('SELECT COUNT(*) as total FROM receipts')
-        total_count = cursor.fetchone()['total']
+        with span('db_count'):
+            cursor.execute('SELECT COUNT(*) as total FROM receipts')
+            total_count = cursor.fetchone()['total']
         
         cursor.close()
         conn.close()
@@ -0,0 +1,138 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from money import line_sum, to_kopecks, to_qty
+
+# Accepted difference between payments and items, kopecks (LLM rounding of fractional quantities)
+PAYMENT_TOLERANCE = 1
+ANSWER_KEYS = ('items', 'error', 'intent')
+
+_DECODER = json.JSONDecoder(strict=False)
+# "1 300,50 ₽", "200 руб.", "~150" -> the number inside
+_NUMBER_RE = re.compile(r'-?\d[\d\s ]*(?:[.,]\d+)?')
+
+
+def first_json_object(text: str) -> Optional[Dict[str, Any]]:
+    '''
+    First object in model output that looks like an answer (items, error or
+    intent), None when there is none. raw_decode parses from each "{" in C
+    and stops at the end of that object, so prose around it, a second
+    object or a trailing comment do not break the parse. A truncated answer
+    only has complete inner objects (one item) and must not pass for one.
+    '''
+    position = text.find('{')
+    while position != -1:
+        try:
+            parsed, end = _DECODER.raw_decode(text, position)
+        except json.JSONDecodeError:
+            position = text.find('{', position + 1)
+            continue
+        if isinstance(parsed, dict) and any(key in parsed for key in ANSWER_KEYS):
+            return parsed
+        position = text.find('{', end)
+    return None
+
+
+def _number(value: Any) -> Any:
+    '''String amount as the model sometimes writes it -> int/float; anything else unchanged'''
+    if not isinstance(value, str):
+        return value
+    match = _NUMBER_RE.search(value)
+    if not match or any(char.isdigit() for char in value[match.end():]):
+        # "2 шт по 150": not a single amount, leave it to validation
+        return value
+    text = re.sub(r'[\s ]', '', match.group()).replace(',', '.')
+    number = float(text)
+    return int(number) if number.is_integer() and '.' not in text else number
+
+
+def repair_answer(parsed: Optional[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+    '''
+    Fix defects that do not change the meaning of an answer, in place:
+    string prices and sums, missing quantity, a single item instead of a
+    list, numeric payment types. Returns the answer and what was repaired.
+    '''
+    repairs: List[str] = []
+    if not isinstance(parsed, dict):
+        return parsed, repairs
+
+    items = parsed.get('items')
+    if isinstance(items, dict):
+        parsed['items'] = items = [items]
+        repairs.append('items object')
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        for key in ('price', 'quantity'):
+            if isinstance(item.get(key), str):
+                fixed = _number(item[key])
+                if fixed is not item[key]:
+                    item[key] = fixed
+                    repairs.append(f'{key} string')
+        if item.get('quantity') is None:
+            item['quantity'] = 1
+            repairs.append('quantity missing')
+        if isinstance(item.get('name'), str) and item['name'] != item['name'].strip():
+            item['name'] = item['name'].strip()
+
+    payments = parsed.get('payments')
+    if isinstance(payments, dict):
+        parsed['payments'] = payments = [payments]
+        repairs.append('payments object')
+    for payment in payments if isinstance(payments, list) else []:
+        if not isinstance(payment, dict):
+            continue
+        if isinstance(payment.get('sum'), str):
+            fixed = _number(payment['sum'])
+            if fixed is not payment['sum']:
+                payment['sum'] = fixed
+                repairs.append('sum string')
+        if isinstance(payment.get('type'), int) and not isinstance(payment['type'], bool):
+            # Receipt builder only reads digit strings, an int type became card (1)
+            payment['type'] = str(payment['type'])
+            repairs.append('payment type int')
+    return parsed, repairs
+
+
+def answer_problem(parsed: Optional[Dict[str, Any]]) -> Optional[str]:
+    '''
+    Local validation of a model answer. None when it can be used as is,
+    otherwise a short reason to ask again (see tiered_call).
+    '''
+    if not isinstance(parsed, dict):
+        return 'no json'
+    if isinstance(parsed.get('error'), str):
+        return None
+    intent = parsed.get('intent')
+    if intent == 'irrelevant':
+        return None
+    if intent in ('bulk_copy', 'repeat'):
+        if intent == 'bulk_copy' and not (parsed.get('uuid') and str(parsed.get('count', '')).isdigit()):
+            return 'bulk without count/uuid'
+        return None
+
+    items = parsed.get('items')
+    if not isinstance(items, list) or not items:
+        return 'no items'
+    total = 0
+    try:
+        for item in items:
+            if not isinstance(item, dict) or not str(item.get('name') or '').strip():
+                return 'item without name'
+            price = to_kopecks(item.get('price'))
+            qty = to_qty(item.get('quantity', 1))
+            if price <= 0 or qty <= 0:
+                return 'non-positive price or quantity'
+            total += line_sum(price, qty)
+
+        payments = parsed.get('payments')
+        if payments:
+            if not isinstance(payments, list) or not all(isinstance(p, dict) for p in payments):
+                return 'bad payments'
+            paid = sum(to_kopecks(p.get('sum', 0)) for p in payments)
+            if abs(paid - total) > PAYMENT_TOLERANCE:
+                return 'payments do not match items'
+    except (ValueError, TypeError, ArithmeticError):
+        return 'bad number'
+    return None
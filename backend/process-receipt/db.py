@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+import log
+
+# Pool lives at module level so warm invocations reuse open connections
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_PING_IDLE = float(os.environ.get('DB_POOL_PING_IDLE', '30'))
+DB_POOL_WAIT_TIMEOUT = float(os.environ.get('DB_POOL_WAIT_TIMEOUT', '10'))
+
+_pool: Optional[ThreadedConnectionPool] = None
+_pool_dsn: Optional[str] = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used: Dict[int, float] = {}
+
+
+def get_pool() -> ThreadedConnectionPool:
+    global _pool, _pool_dsn
+    database_url = os.environ.get('DATABASE_URL', '')
+    with _pool_lock:
+        if _pool is None or _pool_dsn != database_url:
+            if _pool is not None:
+                _pool.closeall()
+            _pool = ThreadedConnectionPool(0, DB_POOL_MAX, database_url)
+            _pool_dsn = database_url
+            _last_used.clear()
+        return _pool
+
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    # Ping only connections that sat idle long enough to be dropped by the server;
+    # one never returned to the pool was just opened
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_POOL_PING_IDLE:
+        return True
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(pool: ThreadedConnectionPool):
+    '''
+    Healthy connection from the pool. After a DB restart every idle one may
+    be stale: they are discarded one by one until the pool opens a new one.
+    '''
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        log.debug('Discarding broken pooled DB connection')
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError('No healthy DB connection in pool')
+
+
+@contextmanager
+def db_connection() -> Iterator['psycopg2.extensions.connection']:
+    '''
+    Borrow a pooled connection. Callers commit themselves; an open transaction
+    left behind (plain SELECT or an exception) is rolled back on return.
+    '''
+    if not _slots.acquire(timeout=DB_POOL_WAIT_TIMEOUT):
+        raise psycopg2.OperationalError('DB pool exhausted')
+    pool = None
+    conn = None
+    try:
+        pool = get_pool()
+        conn = _checkout(pool)
+        yield conn
+    finally:
+        if conn is not None:
+            broken = bool(conn.closed)
+            if not broken and conn.status != psycopg2.extensions.STATUS_READY:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=broken)
+        _slots.release()
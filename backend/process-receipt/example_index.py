@@ -0,0 +1,197 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import log
+from db import db_connection
+
+FEW_SHOT_K = int(os.environ.get('FEW_SHOT_K', '3'))
+# Receipts kept in memory per container; the oldest are evicted first
+EXAMPLE_INDEX_SIZE = int(os.environ.get('EXAMPLE_INDEX_SIZE', '2000'))
+EXAMPLE_INDEX_REFRESH = float(os.environ.get('EXAMPLE_INDEX_REFRESH', '300'))
+EXAMPLE_MIN_SCORE = float(os.environ.get('EXAMPLE_MIN_SCORE', '0.2'))
+# Longer answers cost more prompt than they are worth as an example
+EXAMPLE_MAX_CHARS = 600
+
+NGRAM = 3
+_WHITESPACE_RE = re.compile(r'\s+')
+_DIGITS_RE = re.compile(r'\d+')
+_EMAIL_RE = re.compile(r'\S+@\S+')
+
+
+def ngrams(text: str) -> Set[str]:
+    '''Character trigrams; numbers collapse to "0" so "кофе 200" and "кофе 350" match'''
+    text = (text or '').lower().replace('ё', 'е')
+    text = _EMAIL_RE.sub('@', text)
+    text = _DIGITS_RE.sub('0', text)
+    text = f' {_WHITESPACE_RE.sub(" ", text).strip()} '
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class _Doc:
+    __slots__ = ('utterance', 'answer', 'user_id', 'seed', 'grams', 'norm')
+
+    def __init__(self, utterance: str, answer: str, user_id: Optional[str], seed: bool, grams: Set[str]):
+        self.utterance = utterance
+        self.answer = answer
+        self.user_id = user_id
+        self.seed = seed
+        self.grams = grams
+        self.norm = 1.0
+
+
+class ExampleIndex:
+    '''
+    TF-IDF over character trigrams of past requests, with an inverted index so
+    a query only touches receipts sharing a trigram with it. Seed examples
+    are visible to everyone and never evicted; history is bounded by
+    max_docs and only ever shown to the user it belongs to. IDF moves as receipts arrive, document norms
+    keep the value from insertion time.
+    '''
+
+    def __init__(self, max_docs: int = EXAMPLE_INDEX_SIZE):
+        self.max_docs = max_docs
+        self._docs: Dict[Any, _Doc] = {}
+        self._history: 'OrderedDict[Any, None]' = OrderedDict()
+        self._by_text: Dict[Tuple[Optional[str], str], Any] = {}
+        self._postings: Dict[str, Set[Any]] = {}
+        self._lock = threading.Lock()
+        self.last_id = 0
+        self._refreshed_at = 0.0
+        self._refreshing = False
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def _idf(self, gram: str) -> float:
+        return math.log(1 + len(self._docs) / (len(self._postings.get(gram, ())) or 1))
+
+    def add(self, doc_id: Any, utterance: str, answer: Dict[str, Any], user_id: Optional[str] = None,
+            seed: bool = False) -> bool:
+        if not seed and user_id is None:
+            return False
+        text = json.dumps(answer, ensure_ascii=False, separators=(',', ':'))
+        if not utterance or len(text) > EXAMPLE_MAX_CHARS:
+            return False
+        grams = ngrams(utterance)
+        key = (user_id, ' '.join(sorted(grams)))
+        with self._lock:
+            previous = self._by_text.get(key)
+            if previous is not None:
+                # Same request again (bulk copies, regulars): keep the newest answer
+                self._remove(previous)
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(doc_id)
+            doc = self._docs[doc_id] = _Doc(utterance, text, user_id, seed, grams)
+            doc.norm = math.sqrt(sum(self._idf(gram) ** 2 for gram in grams)) or 1.0
+            self._by_text[key] = doc_id
+            if not seed:
+                self._history[doc_id] = None
+                while len(self._history) > self.max_docs:
+                    self._remove(next(iter(self._history)))
+        return True
+
+    def _remove(self, doc_id: Any) -> None:
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+        self._history.pop(doc_id, None)
+        self._by_text.pop((doc.user_id, ' '.join(sorted(doc.grams))), None)
+        for gram in doc.grams:
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(doc_id)
+                if not posting:
+                    del self._postings[gram]
+
+    def search(self, utterance: str, user_id: Optional[str] = None, k: int = FEW_SHOT_K,
+               min_score: float = EXAMPLE_MIN_SCORE) -> List[Tuple[str, str]]:
+        '''Top k (utterance, answer JSON) by cosine similarity, own history and seeds only'''
+        grams = ngrams(utterance)
+        with self._lock:
+            weights = {gram: self._idf(gram) for gram in grams if gram in self._postings}
+            query_norm = math.sqrt(sum(weight ** 2 for weight in weights.values())) or 1.0
+            scores: Dict[Any, float] = {}
+            for gram, weight in weights.items():
+                for doc_id in self._postings[gram]:
+                    scores[doc_id] = scores.get(doc_id, 0.0) + weight * weight
+            ranked = []
+            for doc_id, score in scores.items():
+                doc = self._docs[doc_id]
+                if not doc.seed and (user_id is None or doc.user_id != user_id):
+                    continue
+                score /= query_norm * doc.norm
+                if score >= min_score:
+                    ranked.append((score, doc_id))
+            best = heapq.nlargest(k, ranked, key=lambda pair: pair[0])
+            return [(self._docs[doc_id].utterance, self._docs[doc_id].answer) for _, doc_id in best]
+
+    def refresh_due(self) -> bool:
+        '''True once per EXAMPLE_INDEX_REFRESH for the caller that should reload history'''
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._refreshed_at < EXAMPLE_INDEX_REFRESH:
+                return False
+            self._refreshing = True
+            return True
+
+    def refresh_done(self) -> None:
+        with self._lock:
+            self._refreshing = False
+            self._refreshed_at = time.monotonic()
+
+
+def example_answer(items: Any, payments: Any) -> Optional[Dict[str, Any]]:
+    '''Receipt history columns -> answer in the LLM format, without client contacts'''
+    if isinstance(items, str):
+        items = json.loads(items)
+    if isinstance(payments, str):
+        payments = json.loads(payments)
+    if not items:
+        return None
+    return {'items': items, 'payments': payments or []}
+
+
+def load_history(index: ExampleIndex) -> None:
+    '''Add successful receipts saved since the last load (by any container) to the index'''
+    if not os.environ.get('DATABASE_URL', ''):
+        return
+
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, user_message, items, payments, user_id FROM receipts "
+                "WHERE status = 'success' AND NOT demo_mode AND id > %s "
+                "ORDER BY id DESC LIMIT %s",
+                (index.last_id, index.max_docs)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+    except Exception as e:
+        log.error('Error loading receipt examples: %s', e)
+        return
+
+    added = 0
+    seen = set()
+    for receipt_id, user_message, items, payments, user_id in reversed(rows):
+        index.last_id = max(index.last_id, receipt_id)
+        try:
+            answer = example_answer(items, payments)
+        except (TypeError, ValueError):
+            continue
+        if not answer:
+            continue
+        # Bulk copies differ only in the message ("Копия #N чека ..."): one example per answer
+        key = (user_id, json.dumps(answer, sort_keys=True, ensure_ascii=False))
+        if key in seen:
+            continue
+        seen.add(key)
+        if index.add(receipt_id, user_message, answer, user_id):
+            added += 1
+    log.debug('Receipt examples loaded: %s new, %s in index', added, len(index))
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import log
+
+
+class LatencyWindow:
+    '''Rolling window of successful call latencies (seconds) per provider'''
+
+    def __init__(self, size: int = 50):
+        self.size = size
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(provider)
+            if samples is None:
+                samples = self._samples[provider] = deque(maxlen=self.size)
+            samples.append(seconds)
+
+    def percentile(self, provider: str, pct: float, min_samples: int = 5) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+def hedged_call(
+    calls: List[Tuple[str, Callable[[], Any]]],
+    hedge_delay: float,
+    is_valid: Callable[[Any], bool]
+) -> Tuple[Optional[str], Any]:
+    '''
+    Start calls[0]; if it has not produced a valid result after hedge_delay
+    (or failed earlier), start the next call. Returns (name, result) of the
+    first valid result, or (None, None). Calls that were not started yet are
+    cancelled; in-flight losers are left to finish and their result dropped.
+    '''
+    executor = ThreadPoolExecutor(max_workers=len(calls))
+    pending = {}
+    remaining = list(calls)
+    try:
+        name, call = remaining.pop(0)
+        pending[executor.submit(call)] = name
+        deadline = time.monotonic() + hedge_delay
+
+        while pending:
+            timeout = max(0.0, deadline - time.monotonic()) if remaining else None
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.warn('Hedged call %s raised: %s', name, e)
+                    result = None
+                if result is not None and is_valid(result):
+                    return name, result
+                log.debug('Hedged call %s returned no valid result', name)
+
+            # Hedge timer fired or everything in flight failed: launch the next provider
+            if remaining and (not done or not pending):
+                name, call = remaining.pop(0)
+                log.debug('Launching hedged request to %s', name)
+                pending[executor.submit(call)] = name
+                deadline = time.monotonic() + hedge_delay
+        return None, None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -1,33 +1,40 @@
 import json
 import os
-import urllib.request
-import urllib.error
 import uuid
 import re
-from typing import Dict, Any, Optional
-
-
-def get_ai_completion(user_text: str, settings: dict, context: str = '') -> Optional[Dict[str, Any]]:
-    '''
-    Universal AI completion function supporting multiple providers
-    Returns parsed receipt JSON or None if failed
-    context: previous incomplete request from user
-    '''
-    active_provider = settings.get('active_ai_provider', 'gigachat')
-    
-    context_part = f"\n\nКонтекст предыдущего запроса: \"{context}\"\n\nВАЖНО: Если новый запрос содержит только недостающие данные (email, phone), НЕ дублируй товары из контекста. Объедини данные в один чек:\n- Товары берём из контекста (если там есть)\n- Email/phone берём из нового запроса (если указан)\nЕсли новый запрос содержит новые товары - добавь их к существующим." if context else ""
-    
-    prompt = f"""Ты ИИ кассир, который получает запросы на создание чека текстом или голосовыми сообщениями.
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional, Tuple
+
+import http_client
+import log
+from answer_schema import answer_problem, first_json_object, repair_answer
+from db import db_connection
+from example_index import FEW_SHOT_K, ExampleIndex, example_answer, load_history
+from hedging import LatencyWindow, hedged_call
+from intent_lexer import MessageFlags, scan_message
+from json_stream import openai_delta, read_json_object, sse_data, yandex_deltas
+from model_tiers import DEFAULT_MODEL_TIERS, FAST, STRONG, TierStats, model_tiers
+from money import MoneyError, build_money, line_sum, qty_value, reconcile_receipt_total, rubles, to_kopecks, to_qty
+from normalizer import normalize_message
+from parse_cache import ParseCache, parse_cache_key
+from provider_router import ProviderRouter, ProviderUnavailable
+from rule_parser import UNSUPPORTED_STEMS, parse_with_rules, receipt_payments, split_items, tokenize
+from token_cache import TokenCache, cache_key
+from tracing import in_current_trace, span, traced, traced_handler
+
+GIGACHAT_TOKEN_CACHE = TokenCache(refresh_margin=60.0)
+ECOMKASSA_TOKEN_CACHE = TokenCache(refresh_margin=300.0)
+ECOMKASSA_TOKEN_TTL = 24 * 3600
+LLM_PARSE_CACHE = ParseCache()
+
+# Static rules and examples go into the system message so providers can reuse
+# the cached prompt prefix; the per-request part is a short user message
+SYSTEM_PROMPT = '''Ты ИИ кассир, который получает запросы на создание чека текстом или голосовыми сообщениями.
 
 Задача: Преобразуй запрос в JSON, заполняя часть API запроса по документации Ecomkassa (https://ecomkassa.ru/dokumentacija_cheki_12).
 
-Запрос: "{user_text}"{context_part}
-
-ВАЖНО: Запрос может быть голосовым (с ошибками распознавания). Исправляй очевидные опечатки и синонимы:
-- "150₽" = "150 рублей" = "150р" = "150 руб" = "полторы сотни"
-- "1300.12₽" = "1300,12 рублей" = "тысяча триста рублей двенадцать копеек"
-- "ivan@mail.ru" = "иван собака мейл точка ру" = "ivan at mail dot ru"
-- Числа: "2000" = "две тысячи" = "2к" = "2 тыщи"
+ВАЖНО: Запрос может быть голосовым (с ошибками распознавания), исправляй очевидные опечатки. Числа и email уже приведены к цифрам и виду ivan@mail.ru.
 
 ВАЖНО про название товара/услуги (name):
 - Название товара - это все слова ДО указания цены
@@ -48,9 +55,9 @@ def get_ai_completion(user_text: str, settings: dict, context: str = '') -> Opti
 - Сумма всех payments ОБЯЗАТЕЛЬНО должна равняться общей стоимости товаров
 
 Примеры смешанной оплаты:
-- "500 наличными, остальное картой" → payments: [{{"type":"0","sum":500}}, {{"type":"1","sum":ОСТАТОК}}]
-- "первоначальный взнос 500, остальное в кредит" → payments: [{{"type":"1","sum":500}}, {{"type":"3","sum":ОСТАТОК}}]
-- "аванс 300, остальное потом" → payments: [{{"type":"2","sum":300}}, {{"type":"3","sum":ОСТАТОК}}]
+- "500 наличными, остальное картой" → payments: [{"type":"0","sum":500}, {"type":"1","sum":ОСТАТОК}]
+- "первоначальный взнос 500, остальное в кредит" → payments: [{"type":"1","sum":500}, {"type":"3","sum":ОСТАТОК}]
+- "аванс 300, остальное потом" → payments: [{"type":"2","sum":300}, {"type":"3","sum":ОСТАТОК}]
 
 Если ты не получил все обязательные данные (price, name, email/phone), ты подставляешь их исходя из контекста, а если их определить не удалось - спрашиваешь у пользователя через error.
 
@@ -87,114 +94,518 @@ client: email (проверь формат), phone (+7...), МОЖНО null ес
 Часть данных подставит бэкэнд (group_code, inn, sno, default_vat, company_email, payment_address), так как он связан с настройками который вводит пользователя.
 
 Успешный формат (простая оплата):
-{{"operation_type":"sell","items":[{{"name":"Товар","price":100,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}}],"client":{{"email":"user@mail.ru","phone":null}},"payments":[{{"type":"1","sum":100}}]}}
+{"operation_type":"sell","items":[{"name":"Товар","price":100,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}],"client":{"email":"user@mail.ru","phone":null},"payments":[{"type":"1","sum":100}]}
 
 Формат БЕЗ ПОЧТЫ (бэкэнд подставит дефолтный email):
-{{"operation_type":"sell","items":[{{"name":"Товар","price":100,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}}],"client":{{"email":null,"phone":null}},"payments":[{{"type":"1","sum":100}}]}}
+{"operation_type":"sell","items":[{"name":"Товар","price":100,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}],"client":{"email":null,"phone":null},"payments":[{"type":"1","sum":100}]}
 
 Если НЕ ХВАТАЕТ ДАННЫХ - ОБЯЗАТЕЛЬНО верни error с детальным объяснением:
-{{"error":"Не хватает данных для чека: укажи цену товара/услуги. Email можно не указывать (будет использован дефолтный). Пример: изготовление шкафа 25000₽"}}
-
-Примеры запросов:
-- "кофе 200₽ без почты" → {{"operation_type":"sell","items":[{{"name":"кофе","price":200,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}}],"client":{{"email":null,"phone":null}},"payments":[{{"type":"1","sum":200}}]}}
-- "услуга 1500₽ не отправлять чек" → {{"operation_type":"sell","items":[{{"name":"услуга","price":1500,"quantity":1,"measure":"услуга","vat":"none","payment_method":"full_payment","payment_object":"service"}}],"client":{{"email":null,"phone":null}},"payments":[{{"type":"1","sum":1500}}]}}
-- "Я продаю мебель на заказ за 1300.12 в кредит первоначальный взнос 500" → {{"operation_type":"sell","items":[{{"name":"мебель на заказ","price":1300.12,"quantity":1,"measure":"шт","vat":"none","payment_method":"partial_payment","payment_object":"commodity"}}],"client":{{"email":null,"phone":null}},"payments":[{{"type":"1","sum":500}},{{"type":"3","sum":800.12}}]}}
-- "товар 1000₽, 600 наличными остальное картой" → {{"operation_type":"sell","items":[{{"name":"товар","price":1000,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}}],"client":{{"email":null,"phone":null}},"payments":[{{"type":"0","sum":600}},{{"type":"1","sum":400}}]}}
-- "стрижка и укладка 2500₽" → {{"operation_type":"sell","items":[{{"name":"стрижка и укладка","price":2500,"quantity":1,"measure":"услуга","vat":"none","payment_method":"full_payment","payment_object":"service"}}],"client":{{"email":null,"phone":null}},"payments":[{{"type":"1","sum":2500}}]}}
-- "кофе" → {{"error":"Укажи цену. Email необязателен (будет дефолтный). Пример: кофе 200₽"}}
-- "стрижка test@mail.ru" → {{"error":"Укажи цену услуги. Пример: стрижка 1500₽ test@mail.ru"}}
-- "изготовление шкафа" → {{"error":"Укажи цену. Пример: изготовление шкафа 25000₽"}}
-
-JSON:"""
-    
-    print(f"[DEBUG] Using AI provider: {active_provider}")
-    
-    if active_provider == 'gigachat':
-        return call_gigachat(prompt, settings)
-    elif active_provider == 'yandexgpt':
-        return call_yandexgpt(prompt, settings)
-    elif active_provider == 'gptunnel_chatgpt':
-        return call_gptunnel(prompt, settings, 'gpt-4o')
-    elif active_provider == 'gptunnel_claude':
-        return call_gptunnel(prompt, settings, 'claude-3.5-sonnet')
-    else:
-        print(f"[WARN] Unknown provider {active_provider}, falling back to GigaChat")
-        return call_gigachat(prompt, settings)
+{"error":"Не хватает данных для чека: укажи цену товара/услуги. Email можно не указывать (будет использован дефолтный). Пример: изготовление шкафа 25000₽"}
+
+Примеры похожих запросов с ответами, если есть, приходят вместе с запросом.
+'''
+
+INTENT_INSTRUCTIONS = '''
+ДОПОЛНИТЕЛЬНО определи намерение пользователя и добавь в ответ поле intent:
+- "receipt" — новый чек: верни чек в формате выше и добавь "intent":"receipt"
+- "bulk_copy" — создать несколько копий существующего чека по его UUID/номеру (последовательность цифр и букв, обычно 8+ символов): {"intent":"bulk_copy","count":КОЛИЧЕСТВО,"uuid":"UUID"}
+- "repeat" — повторить существующий чек: {"intent":"repeat","uuid":"UUID"}, для последнего чека {"intent":"repeat","uuid":null}
+- "irrelevant" — запрос не про чеки: {"intent":"irrelevant"}
+
+Примеры намерений:
+- "105000516 сделай 2 дубля" → {"intent":"bulk_copy","count":2,"uuid":"105000516"}
+- "создай 5 копий чека 12345678" → {"intent":"bulk_copy","count":5,"uuid":"12345678"}
+- "повтори 3 раза abc123def" → {"intent":"bulk_copy","count":3,"uuid":"abc123def"}
+- "еще 10 штук номер 999888" → {"intent":"bulk_copy","count":10,"uuid":"999888"}
+- "2 кофе ещё раз по 150" → {"intent":"receipt","operation_type":"sell","items":[{"name":"кофе","price":150,"quantity":2,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}],"client":{"email":null,"phone":null},"payments":[{"type":"1","sum":300}]}
+'''
+# Intent detection appends to the same prefix, so both variants share its cache
+SYSTEM_PROMPT_WITH_INTENT = SYSTEM_PROMPT + INTENT_INSTRUCTIONS
+# Seed few-shot examples: always in the index, picked by similarity like history
+SEED_EXAMPLES = [
+    ('кофе 200₽ без почты', '{"operation_type":"sell","items":[{"name":"кофе","price":200,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}],"client":{"email":null,"phone":null},"payments":[{"type":"1","sum":200}]}'),
+    ('услуга 1500₽ не отправлять чек', '{"operation_type":"sell","items":[{"name":"услуга","price":1500,"quantity":1,"measure":"услуга","vat":"none","payment_method":"full_payment","payment_object":"service"}],"client":{"email":null,"phone":null},"payments":[{"type":"1","sum":1500}]}'),
+    ('Я продаю мебель на заказ за 1300.12 в кредит первоначальный взнос 500', '{"operation_type":"sell","items":[{"name":"мебель на заказ","price":1300.12,"quantity":1,"measure":"шт","vat":"none","payment_method":"partial_payment","payment_object":"commodity"}],"client":{"email":null,"phone":null},"payments":[{"type":"1","sum":500},{"type":"3","sum":800.12}]}'),
+    ('товар 1000₽, 600 наличными остальное картой', '{"operation_type":"sell","items":[{"name":"товар","price":1000,"quantity":1,"measure":"шт","vat":"none","payment_method":"full_payment","payment_object":"commodity"}],"client":{"email":null,"phone":null},"payments":[{"type":"0","sum":600},{"type":"1","sum":400}]}'),
+    ('стрижка и укладка 2500₽', '{"operation_type":"sell","items":[{"name":"стрижка и укладка","price":2500,"quantity":1,"measure":"услуга","vat":"none","payment_method":"full_payment","payment_object":"service"}],"client":{"email":null,"phone":null},"payments":[{"type":"1","sum":2500}]}'),
+    ('кофе', '{"error":"Укажи цену. Email необязателен (будет дефолтный). Пример: кофе 200₽"}'),
+    ('стрижка test@mail.ru', '{"error":"Укажи цену услуги. Пример: стрижка 1500₽ test@mail.ru"}'),
+    ('изготовление шкафа', '{"error":"Укажи цену. Пример: изготовление шкафа 25000₽"}')
+]
+CONTEXT_INSTRUCTIONS = '''ВАЖНО: Если новый запрос содержит только недостающие данные (email, phone), НЕ дублируй товары из контекста. Объедини данные в один чек:
+- Товары берём из контекста (если там есть)
+- Email/phone берём из нового запроса (если указан)
+Если новый запрос содержит новые товары - добавь их к существующим.'''
+EXAMPLE_INDEX = ExampleIndex()
+for _seed_index, (_utterance, _answer) in enumerate(SEED_EXAMPLES):
+    EXAMPLE_INDEX.add(('seed', _seed_index), _utterance, json.loads(_answer), seed=True)
+PROVIDER_LATENCIES = LatencyWindow()
+PROVIDER_ROUTER = ProviderRouter(PROVIDER_LATENCIES)
+# Breakers count only these; a rejected key or bad output is the caller's problem
+# Answer field naming the provider that produced it, removed by cached_ai_completion
+ANSWERED_BY = '_answered_by'
+OUTAGE_ERRORS = (ProviderUnavailable,) + http_client.TransportError
+TIER_STATS = TierStats()
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', '8'))
+# Above BULK_SYNC_LIMIT copies are created by a background job: a timer trigger
+# on this function runs the worker (run_bulk_jobs), clients poll GET ?job_id=
+BULK_SYNC_LIMIT = 50
+BULK_JOB_MAX = int(os.environ.get('BULK_JOB_MAX', '5000'))
+BULK_JOB_CHUNK = int(os.environ.get('BULK_JOB_CHUNK', '25'))
+# Worker time budget when the runtime does not report the remaining time
+BULK_JOB_DRAIN_SECONDS = float(os.environ.get('BULK_JOB_DRAIN_SECONDS', '20'))
+BULK_JOB_STALE_SECONDS = int(os.environ.get('BULK_JOB_STALE_SECONDS', '120'))
+# Job credentials are stored encrypted with this key and readable for BULK_JOB_CREDENTIALS_TTL seconds
+BULK_JOB_SECRET = os.environ.get('BULK_JOB_SECRET', '')
+BULK_JOB_CREDENTIALS_TTL = int(os.environ.get('BULK_JOB_CREDENTIALS_TTL', '21600'))
+# Confirm path fetches the Ecomkassa token while the LLM/DB work runs
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefetch')
+ECOMKASSA_TOKEN_DEADLINE = float(os.environ.get('ECOMKASSA_TOKEN_DEADLINE', '15'))
+# Rule parses at or above this confidence are answered without calling the LLM
+RULE_PARSE_MIN_CONFIDENCE = float(os.environ.get('RULE_PARSE_MIN_CONFIDENCE', '0.9'))
+# GPT Tunnel models that accept response_format json_object (OpenAI); Claude is prompted only
+JSON_MODE_MODEL_PREFIXES = ('gpt-',)
+# One answer for a 40-item dictation does not fit max_tokens: above
+# LONG_DICTATION_ITEMS items the text is parsed in chunks of CHUNK_ITEMS in parallel
+LONG_DICTATION_ITEMS = int(os.environ.get('LONG_DICTATION_ITEMS', '12'))
+CHUNK_ITEMS = int(os.environ.get('CHUNK_ITEMS', '8'))
+CHUNK_CONCURRENCY = int(os.environ.get('CHUNK_CONCURRENCY', '4'))
+
+
+def get_ai_completion(
+    user_text: str,
+    settings: dict,
+    context: str = '',
+    with_intent: bool = False,
+    hint: str = '',
+    examples: str = ''
+) -> Optional[Dict[str, Any]]:
+    '''
+    Universal AI completion function supporting multiple providers
+    Returns parsed receipt JSON or None if failed
+    context: previous incomplete request from user
+    with_intent: also classify the request (receipt / bulk_copy / repeat / irrelevant) in the same call
+    hint: low-confidence rule parse of the same text (JSON), for the model to check
+    examples: few-shot block from few_shot_examples
+    '''
+    active_provider = settings.get('active_ai_provider', 'gigachat')
+    messages = build_messages(user_text, context, with_intent, hint, examples)
+    
+    log.debug('Using AI provider: %s', active_provider)
+    
+    preferred = known_provider(active_provider)
+    candidates = [p for p in dict.fromkeys([preferred] + configured_providers(settings)) if provider_credential(p, settings)]
+    if not candidates:
+        log.warn('No AI provider has credentials, skipping LLM')
+        return None
+    keys = {breaker_key(p, settings): p for p in candidates}
+    chosen = PROVIDER_ROUTER.choose(next(iter(keys)), list(keys))
+    provider = keys.get(chosen)
+    if provider is None:
+        # Every breaker is open: let the caller go straight to the deterministic parser
+        log.warn('All AI providers are unavailable (circuit open), skipping LLM')
+        return None
+    if provider != active_provider:
+        log.debug('Router picked %s instead of %s', provider, active_provider)
+    
+    if is_hedging_enabled(settings):
+        return hedged_ai_completion(messages, settings, provider)
+    return tiered_call(provider, messages, settings)
+
+
+def build_messages(
+    user_text: str,
+    context: str = '',
+    with_intent: bool = False,
+    hint: str = '',
+    examples: str = ''
+) -> List[Dict[str, str]]:
+    '''Static system message (rules, formats) + short user message with this request and its examples'''
+    parts = [examples] if examples else []
+    parts.append(f'Запрос: "{user_text}"')
+    if context:
+        parts.append(f'Контекст предыдущего запроса: "{context}"\n\n{CONTEXT_INSTRUCTIONS}')
+    if hint:
+        parts.append(f'Черновой разбор по правилам (может быть неточным, проверь по запросу): {hint}')
+    parts.append('JSON:')
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT_WITH_INTENT if with_intent else SYSTEM_PROMPT},
+        {'role': 'user', 'content': '\n\n'.join(parts)}
+    ]
 
 
-def call_gigachat(prompt: str, settings: dict) -> Optional[Dict[str, Any]]:
-    '''Call GigaChat API'''
-    import requests
+def few_shot_examples(user_text: str, user_id: Optional[str] = None) -> str:
+    '''
+    Top FEW_SHOT_K seed or own-history examples closest to the request, as a
+    prompt block. History is (re)loaded in the background every
+    EXAMPLE_INDEX_REFRESH seconds; saves in this container are added at once.
+    '''
+    if EXAMPLE_INDEX.refresh_due():
+        PREFETCH_EXECUTOR.submit(refresh_example_index)
+    nearest = EXAMPLE_INDEX.search(user_text, user_id, FEW_SHOT_K)
+    if not nearest:
+        return ''
+    lines = [f'- "{utterance}" → {answer}' for utterance, answer in nearest]
+    return 'Примеры похожих запросов:\n' + '\n'.join(lines)
+
+
+def refresh_example_index() -> None:
+    try:
+        load_history(EXAMPLE_INDEX)
+    finally:
+        EXAMPLE_INDEX.refresh_done()
+
+
+def provider_credential(provider: str, settings: dict) -> str:
+    '''Secret the provider is called with; empty when it is not configured'''
+    if provider == 'gigachat':
+        return settings.get('gigachat_auth_key') or os.environ.get('GIGACHAT_AUTH_KEY', '')
+    if provider == 'yandexgpt':
+        if settings.get('yandexgpt_api_key') and settings.get('yandexgpt_folder_id'):
+            return f"{settings['yandexgpt_api_key']}:{settings['yandexgpt_folder_id']}"
+        return ''
+    if provider in ('gptunnel_chatgpt', 'gptunnel_claude'):
+        return settings.get('gptunnel_api_key', '')
+    return ''
+
+
+def breaker_key(provider: str, settings: dict) -> str:
+    '''Router key: provider plus a hash of the credential, never the credential itself'''
+    return f'{provider}:{cache_key(provider_credential(provider, settings))[:12]}'
+
+
+def known_provider(provider: str) -> str:
+    if provider in ('gigachat', 'yandexgpt', 'gptunnel_chatgpt', 'gptunnel_claude'):
+        return provider
+    log.warn('Unknown provider %s, falling back to GigaChat', provider)
+    return 'gigachat'
+
+
+def tiered_call(provider: str, messages: List[Dict[str, str]], settings: dict) -> Optional[Dict[str, Any]]:
+    '''
+    Fast model of the provider first; its answer is used when it passes local
+    validation (answer_problem), otherwise the request is asked again of the
+    strong model. With tiering off only the strong model is called.
+    '''
+    fast, strong = model_tiers(provider, settings)
+    if not is_tiering_enabled(settings) or fast == strong:
+        return call_provider(provider, messages, settings, strong)
+    
+    started = time.monotonic()
+    result = call_provider(provider, messages, settings, fast)
+    problem = answer_problem(result)
+    log_tier(provider, FAST, fast, problem is None, time.monotonic() - started)
+    if problem is None:
+        return result
+    
+    log.info('llm escalate', provider=provider, model=strong, reason=problem)
+    started = time.monotonic()
+    escalated = call_provider(provider, messages, settings, strong)
+    log_tier(provider, STRONG, strong, answer_problem(escalated) is None, time.monotonic() - started)
+    return escalated if escalated is not None else result
+
+
+def log_tier(provider: str, tier: str, model: str, accepted: bool, seconds: float) -> None:
+    '''One line per tier call with running hit rate and p50 of that provider/tier in this container'''
+    stats = TIER_STATS.record(provider, tier, accepted, seconds)
+    log.info('llm tier', provider=provider, tier=tier, model=model, ok=accepted,
+             ms=round(seconds * 1000, 1), **stats)
+
+
+def call_provider(
+    provider: str,
+    messages: List[Dict[str, str]],
+    settings: dict,
+    model: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    '''model: one of model_tiers(provider); the strong tier by default'''
+    if provider not in DEFAULT_MODEL_TIERS:
+        log.warn('Unknown provider %s, falling back to GigaChat', provider)
+        provider = 'gigachat'
+        model = None
+    model = model or model_tiers(provider, settings)[1]
+    started = time.monotonic()
+    outage = False
+    try:
+        if provider == 'gigachat':
+            result = call_gigachat(messages, settings, model)
+        elif provider == 'yandexgpt':
+            result = call_yandexgpt(messages, settings, model)
+        else:
+            result = call_gptunnel(messages, settings, model)
+    except ProviderUnavailable:
+        result, outage = None, True
+    result, repairs = repair_answer(result)
+    if repairs:
+        log.debug('Repaired %s answer: %s', provider, ', '.join(repairs))
+    if isinstance(result, dict):
+        # Router failover and hedging may answer with another provider: see cached_ai_completion
+        result[ANSWERED_BY] = provider
+    elapsed = time.monotonic() - started
+    # An answer without items, error or intent is no better than no answer
+    ok = result is not None and is_valid_completion(result)
+    PROVIDER_ROUTER.record(breaker_key(provider, settings), ok, elapsed, outage=outage)
+    # Prompt size next to latency: shows what the static prefix saves per provider
+    log.info(
+        'llm call',
+        provider=provider,
+        model=model,
+        ok=ok,
+        outage=outage,
+        ms=round(elapsed * 1000, 1),
+        system_chars=len(messages[0]['content']),
+        user_chars=len(messages[-1]['content']),
+        est_prompt_tokens=estimate_tokens(messages)
+    )
+    return result
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    '''Rough count for mostly Cyrillic text: BPE tokenizers give ~3 characters per token'''
+    return sum(len(message['content']) for message in messages) // 3
+
+
+def log_usage(provider: str, usage: Optional[Dict[str, Any]]) -> None:
+    '''Provider-reported token usage (non-streamed answers), including cached prompt tokens if any'''
+    if not usage:
+        return
+    details = usage.get('prompt_tokens_details') or {}
+    log.info(
+        'llm usage',
+        provider=provider,
+        prompt_tokens=usage.get('prompt_tokens', usage.get('inputTextTokens')),
+        cached_tokens=details.get('cached_tokens', usage.get('precached_prompt_tokens')),
+        completion_tokens=usage.get('completion_tokens', usage.get('completionTokens'))
+    )
+
+
+def configured_providers(settings: dict) -> List[str]:
+    '''Providers that have credentials in settings (GigaChat may also use the env secret)'''
+    providers = []
+    if settings.get('gigachat_auth_key') or os.environ.get('GIGACHAT_AUTH_KEY'):
+        providers.append('gigachat')
+    if settings.get('yandexgpt_api_key') and settings.get('yandexgpt_folder_id'):
+        providers.append('yandexgpt')
+    if settings.get('gptunnel_api_key'):
+        providers.append('gptunnel_chatgpt')
+    return providers
+
+
+def is_hedging_enabled(settings: dict) -> bool:
+    if 'ai_hedging' in settings:
+        return bool(settings.get('ai_hedging'))
+    return os.environ.get('AI_HEDGING', '').lower() in ('1', 'true', 'yes')
+
+
+def is_tiering_enabled(settings: dict) -> bool:
+    '''Fast model first unless ai_tiered_routing=false or AI_TIERED_ROUTING=0'''
+    if 'ai_tiered_routing' in settings:
+        return bool(settings.get('ai_tiered_routing'))
+    return os.environ.get('AI_TIERED_ROUTING', '1').lower() not in ('0', 'false', 'no')
+
+
+def is_json_mode_enabled(settings: dict) -> bool:
+    '''Provider JSON mode (where supported) unless ai_json_mode=false or AI_JSON_MODE=0'''
+    if 'ai_json_mode' in settings:
+        return bool(settings.get('ai_json_mode'))
+    return os.environ.get('AI_JSON_MODE', '1').lower() not in ('0', 'false', 'no')
+
+
+def is_streaming_enabled(settings: dict) -> bool:
+    '''Streamed completions are on unless ai_streaming=false or AI_STREAMING=0'''
+    if 'ai_streaming' in settings:
+        return bool(settings.get('ai_streaming'))
+    return os.environ.get('AI_STREAMING', '1').lower() not in ('0', 'false', 'no')
+
+
+def hedge_delay(settings: dict, provider: str) -> float:
+    '''Explicit ai_hedge_delay_ms, otherwise the primary's rolling p90, otherwise AI_HEDGE_DEFAULT_MS'''
+    if settings.get('ai_hedge_delay_ms'):
+        return float(settings['ai_hedge_delay_ms']) / 1000
+    p90 = PROVIDER_LATENCIES.percentile(breaker_key(provider, settings), 90)
+    if p90 is not None:
+        return p90
+    return float(os.environ.get('AI_HEDGE_DEFAULT_MS', '2500')) / 1000
+
+
+def is_valid_completion(parsed: Dict[str, Any]) -> bool:
+    '''Answer is usable: an explicit error for the user or at least one priced item'''
+    if not isinstance(parsed, dict):
+        return False
+    if isinstance(parsed.get('error'), str):
+        return True
+    if parsed.get('intent') in ('bulk_copy', 'repeat', 'irrelevant'):
+        return True
+    items = parsed.get('items')
+    if not isinstance(items, list) or not items:
+        return False
+    return all(isinstance(item, dict) and item.get('name') and item.get('price') is not None for item in items)
+
+
+def hedged_ai_completion(messages: List[Dict[str, str]], settings: dict, primary: str) -> Optional[Dict[str, Any]]:
+    '''Race the primary provider against one backup launched after the hedge delay'''
+    backups = [
+        p for p in configured_providers(settings)
+        if p != primary and PROVIDER_ROUTER.allows(breaker_key(p, settings))
+    ]
+    if not backups:
+        return tiered_call(primary, messages, settings)
     
+    delay = hedge_delay(settings, primary)
+    calls = [
+        (name, in_current_trace(lambda name=name: tiered_call(name, messages, settings)))
+        for name in [primary, backups[0]]
+    ]
+    winner, result = hedged_call(calls, delay, is_valid_completion)
+    log.debug('Hedged completion: winner=%s, hedge_delay=%.2fs', winner, delay)
+    return result
+
+
+def provider_model(settings: dict) -> Tuple[str, str]:
+    '''(provider, model) that get_ai_completion will use for these settings'''
+    active_provider = settings.get('active_ai_provider', 'gigachat')
+    if active_provider not in DEFAULT_MODEL_TIERS:
+        active_provider = 'gigachat'
+    fast, strong = model_tiers(active_provider, settings)
+    if not is_tiering_enabled(settings) or fast == strong:
+        return active_provider, strong
+    return active_provider, f'{fast}>{strong}'
+
+
+@traced('llm')
+def cached_ai_completion(
+    user_text: str,
+    settings: dict,
+    context: str = '',
+    with_intent: bool = False,
+    hint: str = '',
+    examples: str = ''
+) -> Optional[Dict[str, Any]]:
+    '''
+    get_ai_completion behind LLM_PARSE_CACHE. The key covers everything that
+    goes into the prompt; only complete receipts from the configured
+    provider are cached, so a failover answer is not served under its key
+    and error answers ("укажи цену") are asked again.
+    '''
+    provider, model = provider_model(settings)
+    if with_intent:
+        model = f'{model}+intent'
+    key = parse_cache_key(
+        user_text, context, provider, model, settings.get('default_vat', 'none'), prompt_extra=[hint, examples]
+    )
+    answered_by = []
+    
+    def compute() -> Optional[Dict[str, Any]]:
+        parsed = get_ai_completion(user_text, settings, context, with_intent, hint, examples)
+        if isinstance(parsed, dict):
+            answered_by.append(parsed.pop(ANSWERED_BY, None))
+        return parsed
+    
+    return LLM_PARSE_CACHE.get_or_compute(
+        key,
+        compute,
+        cacheable=lambda parsed: answered_by == [provider] and 'error' not in parsed and bool(parsed.get('items'))
+    )
+
+
+def call_gigachat(messages: List[Dict[str, str]], settings: dict, model: str = 'GigaChat') -> Optional[Dict[str, Any]]:
+    '''Call GigaChat API'''
     auth_key = settings.get('gigachat_auth_key') or os.environ.get('GIGACHAT_AUTH_KEY', '')
     if not auth_key:
         return None
     
-    access_token = get_gigachat_token(auth_key)
-    if not access_token:
-        return None
-    
     chat_url = 'https://gigachat.devices.sberbank.ru/api/v1/chat/completions'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    
+    stream = is_streaming_enabled(settings)
     payload = {
-        'model': 'GigaChat',
-        'messages': [{'role': 'user', 'content': prompt}],
+        'model': model,
+        'messages': messages,
         'temperature': 0.1,
-        'max_tokens': 1000
+        'max_tokens': 1000,
+        'stream': stream
     }
     
     try:
-        response = requests.post(chat_url, headers=headers, json=payload, verify=False, timeout=5)
+        for attempt in range(2):
+            access_token = get_gigachat_token(auth_key)
+            if not access_token:
+                return None
+            
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json',
+                # GigaChat reuses a cached prompt prefix only within one session id:
+                # derive it from the static system message
+                'X-Session-ID': str(uuid.uuid5(uuid.NAMESPACE_OID, messages[0]['content']))
+            }
+            response = http_client.post(chat_url, headers=headers, json=payload, verify=False, stream=stream)
+            if response.status_code == 401 and attempt == 0:
+                # Token revoked or expired earlier than announced: drop it and retry once
+                log.debug('GigaChat returned 401, refreshing access token')
+                response.close()
+                GIGACHAT_TOKEN_CACHE.invalidate(cache_key(auth_key), access_token)
+                continue
+            break
+        
+        if stream:
+            return read_completion_stream(response, sse_deltas(response), 'gigachat')
+        check_available(response)
         result = response.json()
+        log_usage('gigachat', result.get('usage'))
         ai_response = result.get('choices', [{}])[0].get('message', {}).get('content', '')
         return extract_json_from_text(ai_response)
+    except OUTAGE_ERRORS as e:
+        log.error('GigaChat unavailable: %s', e)
+        raise ProviderUnavailable(str(e)) from e
     except Exception as e:
-        print(f"[ERROR] GigaChat failed: {e}")
+        log.error('GigaChat failed: %s', e)
         return None
 
 
-def call_yandexgpt(prompt: str, settings: dict) -> Optional[Dict[str, Any]]:
+def call_yandexgpt(messages: List[Dict[str, str]], settings: dict, model: str = 'yandexgpt-lite') -> Optional[Dict[str, Any]]:
     '''Call YandexGPT API'''
-    import requests
-    
     api_key = settings.get('yandexgpt_api_key', '')
     folder_id = settings.get('yandexgpt_folder_id', '')
     if not api_key or not folder_id:
         return None
     
     url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
+    stream = is_streaming_enabled(settings)
     headers = {
         'Authorization': f'Api-Key {api_key}',
         'Content-Type': 'application/json'
     }
     
     payload = {
-        'modelUri': f'gpt://{folder_id}/yandexgpt-lite',
+        'modelUri': f'gpt://{folder_id}/{model}',
         'completionOptions': {
+            'stream': stream,
             'temperature': 0.1,
             'maxTokens': 1000
         },
-        'messages': [{'role': 'user', 'text': prompt}]
+        'messages': [{'role': message['role'], 'text': message['content']} for message in messages]
     }
+    if is_json_mode_enabled(settings):
+        payload['jsonObject'] = True
     
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = http_client.post(url, headers=headers, json=payload, stream=stream)
+        if stream:
+            return read_completion_stream(response, yandex_deltas(response.iter_lines()), 'yandexgpt')
+        check_available(response)
         result = response.json()
+        log_usage('yandexgpt', result.get('result', {}).get('usage'))
         ai_response = result.get('result', {}).get('alternatives', [{}])[0].get('message', {}).get('text', '')
         return extract_json_from_text(ai_response)
+    except OUTAGE_ERRORS as e:
+        log.error('YandexGPT unavailable: %s', e)
+        raise ProviderUnavailable(str(e)) from e
     except Exception as e:
-        print(f"[ERROR] YandexGPT failed: {e}")
+        log.error('YandexGPT failed: %s', e)
         return None
 
 
-def call_gptunnel(prompt: str, settings: dict, model: str) -> Optional[Dict[str, Any]]:
+def call_gptunnel(messages: List[Dict[str, str]], settings: dict, model: str) -> Optional[Dict[str, Any]]:
     '''Call GPT Tunnel API (ChatGPT or Claude)'''
-    import requests
-    
     api_key = settings.get('gptunnel_api_key', '')
     if not api_key:
         return None
@@ -205,41 +616,78 @@ def call_gptunnel(prompt: str, settings: dict, model: str) -> Optional[Dict[str,
         'Content-Type': 'application/json'
     }
     
+    stream = is_streaming_enabled(settings)
     payload = {
         'model': model,
-        'messages': [{'role': 'user', 'content': prompt}],
+        'messages': messages,
         'temperature': 0.1,
-        'max_tokens': 1000
+        'max_tokens': 1000,
+        'stream': stream
     }
+    if model.startswith(JSON_MODE_MODEL_PREFIXES) and is_json_mode_enabled(settings):
+        payload['response_format'] = {'type': 'json_object'}
     
     try:
-        print(f"[DEBUG] Calling GPT Tunnel API: {url}, model: {model}")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        print(f"[DEBUG] GPT Tunnel response status: {response.status_code}")
+        log.debug('Calling GPT Tunnel API: %s, model: %s', url, model)
+        response = http_client.post(url, headers=headers, json=payload, stream=stream)
+        log.debug('GPT Tunnel response status: %s', response.status_code)
+        if stream:
+            return read_completion_stream(response, sse_deltas(response), f'gptunnel/{model}')
+        check_available(response)
         result = response.json()
-        print(f"[DEBUG] GPT Tunnel response: {result}")
+        log.payload('GPT Tunnel response', result)
+        log_usage(f'gptunnel/{model}', result.get('usage'))
         ai_response = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-        print(f"[DEBUG] AI response text: {ai_response[:200]}")
+        log.debug('AI response text: %s', ai_response[:200])
         return extract_json_from_text(ai_response)
+    except OUTAGE_ERRORS as e:
+        log.error('GPT Tunnel (%s) unavailable: %s', model, e)
+        raise ProviderUnavailable(str(e)) from e
     except Exception as e:
-        print(f"[ERROR] GPT Tunnel ({model}) failed: {e}")
+        log.error('GPT Tunnel (%s) failed: %s', model, e)
         return None
 
 
+def check_available(response) -> None:
+    if response.status_code >= 500:
+        raise ProviderUnavailable(f'HTTP {response.status_code}: {response.text[:200]}')
+
+
 def extract_json_from_text(text: str) -> Optional[Dict[str, Any]]:
-    '''Extract and parse JSON from AI response text'''
-    import re
-    
-    json_match = re.search(r'\{.*\}', text, re.DOTALL)
-    if not json_match:
-        return None
-    
+    '''First answer-like JSON object in AI response text (answer_schema.first_json_object)'''
+    return first_json_object(text or '')
+
+
+def sse_deltas(response) -> Any:
+    '''Text deltas of an OpenAI-compatible SSE stream (GigaChat, GPT Tunnel)'''
+    return (openai_delta(data) for data in sse_data(response.iter_lines()))
+
+
+def read_completion_stream(response, deltas: Any, provider: str) -> Optional[Dict[str, Any]]:
+    '''
+    Parse a streamed completion incrementally and return as soon as the
+    top-level JSON object closes. Closing the response drops the connection,
+    which stops generation of whatever the model wanted to add after the JSON.
+    '''
+    started = time.monotonic()
     try:
-        json_str = json_match.group(0).replace('\n', ' ').replace('\r', ' ')
-        return json.loads(json_str)
-    except json.JSONDecodeError:
-        return None
+        if response.status_code != 200:
+            log.error('%s stream failed: HTTP %s %s', provider, response.status_code, response.text[:200])
+            if response.status_code >= 500:
+                raise ProviderUnavailable(f'HTTP {response.status_code}')
+            return None
+        parsed = read_json_object(deltas, on_complete=response.close)
+        elapsed_ms = int((time.monotonic() - started) * 1000)
+        if parsed is None:
+            log.debug('%s stream ended without a JSON object after %s ms', provider, elapsed_ms)
+        else:
+            log.debug('%s stream: JSON object complete after %s ms, aborting generation', provider, elapsed_ms)
+        return parsed
+    finally:
+        response.close()
 
+
+@traced_handler('process-receipt')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Process natural language receipt requests and create receipt via ecomkassa API
@@ -247,6 +695,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context - object with attributes: request_id, function_name
     Returns: HTTP response dict with receipt data
     '''
+    if 'httpMethod' not in event:
+        # Timer trigger: advance background bulk jobs
+        return run_bulk_jobs(context)
+    
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -254,13 +706,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
+    if method == 'GET':
+        return handle_bulk_job_status(event)
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -271,6 +726,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Method not allowed'})
         }
     
+    log.begin_request()
     body_data = json.loads(event.get('body', '{}'))
     user_message: str = body_data.get('message', '')
     operation_type: str = body_data.get('operation_type', '')
@@ -278,7 +734,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     settings: dict = body_data.get('settings', {})
     previous_receipt: dict = body_data.get('previous_receipt', {})
     edited_data: dict = body_data.get('edited_data')
+    request_started = time.monotonic()
     context_message: str = body_data.get('context_message', '')
+    headers = event.get('headers') or {}
+    user_id: Optional[str] = headers.get('x-user-id') or headers.get('X-User-Id') or None
     
     if not user_message:
         return {
@@ -290,31 +749,35 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Message is required'})
         }
     
-    text_lower = user_message.lower().strip()
-    
-    context_message = settings.get('context_message', '')
-    has_context = bool(context_message)
+    # Voice transcripts: spoken numbers, emails and phones become digits for the
+    # filter and the rule parser; the LLM prompt and history keep the original words
+    with span('normalize'):
+        normalized_message = normalize_message(user_message)
     
-    irrelevant_keywords = [
-        'привет', 'здравствуй', 'добрый', 'доброе', 'hello', 'hi', 'hey',
-        'расскажи', 'что такое', 'как дела', 'анекдот', 'пошути', 
-        'кто ты', 'спасибо', 'благодарю', 'помоги', 'помощь',
-        'шутка', 'история', 'сказка', 'стих', 'стоп', 'хватит', 'стой',
-        'привет', 'пока', 'досвидания', 'хай', 'хелло'
-    ]
-    
-    has_receipt_keywords = any(keyword in text_lower for keyword in [
-        'чек', 'товар', 'услуга', 'продаж', 'возврат', 'корр', 
-        'руб', '₽', 'email', '@', 'цена', 'сумма', 'отправ', 'созда',
-        'копи', 'повтор', 'дубл', 'еще раз', 'ещё раз'
-    ])
-    
-    has_copy_request = bool(re.search(r'\d{8,}', user_message)) and any(keyword in text_lower for keyword in ['копи', 'повтор', 'дубл', 'еще', 'ещё'])
-    
-    if not has_receipt_keywords and not has_context and not has_copy_request:
-        for keyword in irrelevant_keywords:
-            if keyword in text_lower:
-                print(f"[DEBUG] Irrelevant request blocked: '{user_message}' contains '{keyword}'")
+    with span('filter'):
+        # One scan answers the filter, the command detectors and the operation type
+        message_flags = scan_message(normalized_message)
+        text_lower = normalized_message.lower().strip()
+        
+        context_message = settings.get('context_message', '')
+        has_context = bool(context_message)
+        
+        if not message_flags.receipt and not has_context and not message_flags.copy:
+            if message_flags.irrelevant:
+                log.debug("Irrelevant request blocked: '%s'", user_message)
+                return {
+                    'statusCode': 400,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': '❌ Я ИИ-кассир и помогаю только с созданием чеков. Укажи товар/услугу, цену и email клиента для создания чека.'
+                    })
+                }
+            
+            if len(text_lower) < 10:
+                log.debug("Too short message without receipt keywords and no context: '%s'", user_message)
                 return {
                     'statusCode': 400,
                     'headers': {
@@ -325,19 +788,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'error': '❌ Я ИИ-кассир и помогаю только с созданием чеков. Укажи товар/услугу, цену и email клиента для создания чека.'
                     })
                 }
-        
-        if len(text_lower) < 10:
-            print(f"[DEBUG] Too short message without receipt keywords and no context: '{user_message}'")
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': '❌ Я ИИ-кассир и помогаю только с созданием чеков. Укажи товар/услугу, цену и email клиента для создания чека.'
-                })
-            }
     
     has_ecomkassa = (settings.get('ecomkassa_login') or settings.get('username')) and \
                     (settings.get('ecomkassa_password') or settings.get('password')) and \
@@ -381,38 +831,83 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
     
+    login = settings.get('ecomkassa_login') or os.environ.get('ECOMKASSA_LOGIN', '')
+    password = settings.get('ecomkassa_password') or os.environ.get('ECOMKASSA_PASSWORD', '')
+    group_code = settings.get('group_code') or os.environ.get('ECOMKASSA_GROUP_CODE', '')
+    
+    # The token is only needed for the fiscal POST: fetch it concurrently with
+    # parsing / history lookup instead of after them
+    token_future = None
+    if not preview_only and login and password and group_code:
+        token_future = prefetch_ecomkassa_token(login, password)
+    
     # CRITICAL: Check edited_data FIRST before detecting bulk commands
     # If edited_data exists, user already confirmed the preview - skip command detection
     if edited_data:
-        print(f"[DEBUG] Using edited_data: {json.dumps(edited_data, ensure_ascii=False)[:500]}")
-        print(f"[DEBUG] edited_data has bulk_count: {edited_data.get('bulk_count')}")
-        print(f"[DEBUG] edited_data has original_uuid: {edited_data.get('original_uuid')}")
+        log.payload('Using edited_data', edited_data)
+        log.debug('edited_data has bulk_count: %s', edited_data.get('bulk_count'))
+        log.debug('edited_data has original_uuid: %s', edited_data.get('original_uuid'))
         parsed_receipt = edited_data
         operation_type = edited_data.get('operation_type', operation_type)
         
+        # The confirmed preview comes back from the client: check the copy count again
+        if edited_data.get('bulk_count') is not None:
+            try:
+                bulk_count = int(edited_data['bulk_count'])
+            except (TypeError, ValueError):
+                bulk_count = 0
+            if not 1 <= bulk_count <= BULK_JOB_MAX:
+                return {
+                    'statusCode': 400,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': f'Недопустимое число копий: {edited_data["bulk_count"]}. Можно от 1 до {BULK_JOB_MAX} чеков за раз'
+                    })
+                }
+            parsed_receipt['bulk_count'] = bulk_count
+        
         # Apply price recalculation for edited_data too
-        if parsed_receipt.get('payments'):
-            total_from_payments = sum(payment.get('sum', 0) for payment in parsed_receipt['payments'])
-            if total_from_payments > 0:
-                items_total = sum(item.get('price', 0) * item.get('quantity', 1) for item in parsed_receipt.get('items', []))
-                if abs(items_total - total_from_payments) > 0.01:
-                    print(f"[DEBUG] [EDITED_DATA] Recalculating prices: items_total={items_total}, payments_total={total_from_payments}")
-                    if len(parsed_receipt.get('items', [])) == 1:
-                        parsed_receipt['items'][0]['price'] = total_from_payments / parsed_receipt['items'][0].get('quantity', 1)
-                        print(f"[DEBUG] [EDITED_DATA] Updated single item price to {parsed_receipt['items'][0]['price']}")
-                parsed_receipt['total'] = total_from_payments
+        reconcile_receipt_total(parsed_receipt)
         # Skip to email check and receipt creation - do NOT re-parse bulk commands
     else:
         # Only detect bulk commands if NO edited_data (initial request)
-        # First, try AI-based bulk detection
-        bulk_repeat = detect_bulk_with_ai(user_message, settings)
-        if not bulk_repeat:
-            # Fallback to regex-based detection
-            bulk_repeat = detect_bulk_repeat_command(user_message)
+        # Regex detectors are a zero-cost pre-filter; ambiguous messages are
+        # classified by the same LLM call that parses the receipt
+        bulk_repeat = detect_bulk_repeat_command(normalized_message, message_flags)
+        repeat_uuid = None if bulk_repeat else detect_repeat_command(normalized_message, message_flags)
+        parsed_receipt = None
+        
+        if not bulk_repeat and not repeat_uuid:
+            try:
+                parsed_receipt = parse_receipt_from_text(
+                    normalized_message, settings, with_intent=message_flags.needs_intent, flags=message_flags,
+                    user_id=user_id, raw_text=user_message
+                )
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': str(e),
+                        'message': str(e)
+                    })
+                }
+            
+            intent = parsed_receipt.get('intent')
+            if intent == 'bulk_copy':
+                bulk_repeat = (parsed_receipt['count'], parsed_receipt['uuid'])
+            elif intent == 'repeat':
+                repeat_uuid = parsed_receipt['uuid']
         
         if bulk_repeat:
             count, uuid = bulk_repeat
-            if count > 50:
+            if count > BULK_JOB_MAX:
                 return {
                     'statusCode': 400,
                     'headers': {
@@ -420,14 +915,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'Access-Control-Allow-Origin': '*'
                     },
                     'body': json.dumps({
-                        'error': f'Слишком много копий: {count}. Максимум 50 чеков за раз'
+                        'error': f'Слишком много копий: {count}. Максимум {BULK_JOB_MAX} чеков за раз'
                     })
                 }
             
             existing_receipt = get_receipt_from_db(uuid)
-            print(f"[DEBUG] Retrieved receipt from DB: {existing_receipt is not None}")
+            log.debug('Retrieved receipt from DB: %s', existing_receipt is not None)
             if not existing_receipt:
-                print(f"[DEBUG] Receipt {uuid} not found in database")
+                log.debug('Receipt %s not found in database', uuid)
                 return {
                     'statusCode': 404,
                     'headers': {
@@ -438,7 +933,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'error': f'Чек с UUID {uuid} не найден в истории'
                     })
                 }
-            print(f"[DEBUG] Receipt found! Items: {existing_receipt.get('items')}")
+            log.payload('Receipt found, items', existing_receipt.get('items'))
             
             # Use customer email from receipt, fallback to company email if empty
             customer_email = existing_receipt.get('customer_email', '').strip()
@@ -481,13 +976,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 })
             }
     
-        repeat_uuid = detect_repeat_command(user_message)
-        
         if not operation_type:
-            operation_type = detect_operation_type(user_message)
+            operation_type = detect_operation_type(normalized_message, message_flags)
         
         if repeat_uuid == 'LAST':
-            existing_receipt = get_last_receipt_from_db()
+            existing_receipt = get_last_receipt_from_db(user_id)
             if existing_receipt:
                 parsed_receipt = {
                     'items': existing_receipt['items'],
@@ -537,12 +1030,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         elif repeat_uuid:
             existing_receipt = get_receipt_from_db(repeat_uuid)
             if existing_receipt:
-                print(f"[DEBUG] Repeat receipt UUID {repeat_uuid}: existing_receipt = {existing_receipt}")
+                log.debug('Repeat receipt UUID %s found', repeat_uuid)
+                log.payload('Repeat receipt', existing_receipt)
                 parsed_receipt = existing_receipt
                 operation_type = existing_receipt.get('operation_type', 'sell')
                 
-                print(f"[DEBUG] Repeat receipt payments data: {parsed_receipt.get('payments')}")
-                
                 if 'company' not in parsed_receipt:
                     parsed_receipt['company'] = {}
                 
@@ -586,36 +1078,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     })
                 }
         else:
-            try:
-                parsed_receipt = parse_receipt_from_text(user_message, settings)
-            except ValueError as e:
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'error': str(e),
-                        'message': str(e)
-                    })
-                }
-            
             if previous_receipt:
                 parsed_receipt = merge_receipts(previous_receipt, parsed_receipt)
     
-    if parsed_receipt.get('payments'):
-        total_from_payments = sum(payment.get('sum', 0) for payment in parsed_receipt['payments'])
-        if total_from_payments > 0:
-            items_total = sum(item.get('price', 0) * item.get('quantity', 1) for item in parsed_receipt.get('items', []))
-            if abs(items_total - total_from_payments) > 0.01:
-                print(f"[DEBUG] Recalculating prices: items_total={items_total}, payments_total={total_from_payments}")
-                if len(parsed_receipt.get('items', [])) == 1:
-                    parsed_receipt['items'][0]['price'] = total_from_payments / parsed_receipt['items'][0].get('quantity', 1)
-                    print(f"[DEBUG] Updated single item price to {parsed_receipt['items'][0]['price']}")
-            parsed_receipt['total'] = total_from_payments
+    reconcile_receipt_total(parsed_receipt)
     
     if preview_only:
+        log.info('Time to preview: %s ms', int((time.monotonic() - request_started) * 1000))
         return {
             'statusCode': 200,
             'headers': {
@@ -631,13 +1100,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
     
-    print(f"[DEBUG] Before email check: parsed_receipt exists: {parsed_receipt is not None}")
-    print(f"[DEBUG] parsed_receipt type: {type(parsed_receipt)}")
-    print(f"[DEBUG] parsed_receipt.get('client'): {parsed_receipt.get('client') if isinstance(parsed_receipt, dict) else 'NOT A DICT'}")
-    
     client_email = parsed_receipt.get('client', {}).get('email', '')
     
-    print(f"[DEBUG] client_email: '{client_email}'")
+    log.debug("client_email: '%s'", client_email)
     
     invalid_emails = ['customer@example.com', 'НЕ УКАЗАН email', 'email@example.com', '']
     if not client_email or client_email in invalid_emails or '@' not in client_email or '.' not in client_email:
@@ -654,9 +1119,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
     
-    login = settings.get('ecomkassa_login') or os.environ.get('ECOMKASSA_LOGIN', '')
-    password = settings.get('ecomkassa_password') or os.environ.get('ECOMKASSA_PASSWORD', '')
-    group_code = settings.get('group_code') or os.environ.get('ECOMKASSA_GROUP_CODE', '')
+    try:
+        build_money(parsed_receipt.get('items') or [], parsed_receipt.get('payments'))
+    except MoneyError as e:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({
+                'error': 'Сумма чека не сходится с оплатой',
+                'message': str(e)
+            })
+        }
     
     external_id = f'AI_{abs(hash(user_message + str(parsed_receipt)))}'
     
@@ -668,7 +1144,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'operation_type': operation_type,
             'demo': True
         }
-        save_receipt_to_db(external_id, user_message, parsed_receipt, operation_type, None, True)
+        save_receipt_to_db(external_id, user_message, parsed_receipt, operation_type, None, True, user_id=user_id)
         return {
             'statusCode': 200,
             'headers': {
@@ -678,7 +1154,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps(demo_result)
         }
     
-    token = get_ecomkassa_token(login, password)
+    token = join_ecomkassa_token(token_future, login, password, request_started + ECOMKASSA_TOKEN_DEADLINE)
     
     if not token:
         error_result = {
@@ -688,7 +1164,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'operation_type': operation_type,
             'demo': True
         }
-        save_receipt_to_db(external_id, user_message, parsed_receipt, operation_type, None, True)
+        save_receipt_to_db(external_id, user_message, parsed_receipt, operation_type, None, True, user_id=user_id)
         return {
             'statusCode': 200,
             'headers': {
@@ -702,48 +1178,49 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     original_uuid = parsed_receipt.get('original_uuid')
     
     if bulk_count and original_uuid:
-        print(f"[DEBUG] Bulk creation confirmed: {bulk_count} copies of {original_uuid}")
-        created_receipts = []
-        failed_receipts = []
+        log.debug('Bulk creation confirmed: %s copies of %s', bulk_count, original_uuid)
+        receipt_copy = parsed_receipt.copy()
+        receipt_copy.pop('bulk_count', None)
+        receipt_copy.pop('original_uuid', None)
         
-        for i in range(bulk_count):
-            import time
-            unique_external_id = f'BULK_{original_uuid}_{int(time.time() * 1000)}_{i}'
-            print(f"[DEBUG] Creating copy {i+1}/{bulk_count} with external_id: {unique_external_id}")
-            
-            receipt_copy = parsed_receipt.copy()
-            receipt_copy.pop('bulk_count', None)
-            receipt_copy.pop('original_uuid', None)
-            
-            try:
-                result = create_ecomkassa_receipt(receipt_copy, token, group_code, operation_type)
-                print(f"[DEBUG] Copy {i+1} result: success={result.get('success')}")
-                
-                if result.get('success') or result.get('demo'):
-                    save_receipt_to_db(
-                        unique_external_id,
-                        f'Копия #{i+1} чека {original_uuid}',
-                        receipt_copy,
-                        operation_type,
-                        result.get('ecomkassa_response'),
-                        result.get('demo', False),
-                        result.get('uuid')
-                    )
-                    created_receipts.append({
-                        'index': i+1,
-                        'uuid': result.get('uuid'),
-                        'external_id': unique_external_id
-                    })
-                else:
-                    failed_receipts.append({
-                        'index': i+1,
-                        'error': result.get('error', 'Неизвестная ошибка')
+        if bulk_count > BULK_SYNC_LIMIT or body_data.get('async_bulk'):
+            job_id = create_bulk_job(
+                receipt_copy, bulk_count, original_uuid, login, password, group_code, operation_type, user_id
+            )
+            if not job_id:
+                return {
+                    'statusCode': 500,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'success': False,
+                        'error': 'Не удалось создать задание на копии чека'
                     })
-            except Exception as e:
-                print(f"[DEBUG] Copy {i+1} exception: {str(e)}")
-                failed_receipts.append({'index': i+1, 'error': str(e)})
+                }
+            log.debug('Bulk job %s created for %s copies of %s', job_id, bulk_count, original_uuid)
+            return {
+                'statusCode': 202,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({
+                    'success': True,
+                    'message': f'Создание {bulk_count} копий чека {original_uuid} запущено',
+                    'job_id': job_id,
+                    'status': 'pending',
+                    'total_requested': bulk_count
+                })
+            }
+        
+        created_receipts, failed_receipts = create_bulk_copies(
+            receipt_copy, bulk_count, original_uuid, login, password, group_code, operation_type, user_id
+        )
         
-        print(f"[DEBUG] Bulk creation finished: created={len(created_receipts)}, failed={len(failed_receipts)}")
+        log.debug('Bulk creation finished: created=%s, failed=%s', len(created_receipts), len(failed_receipts))
         
         return {
             'statusCode': 200,
@@ -763,9 +1240,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
     
-    receipt_result = create_ecomkassa_receipt(
+    receipt_result = create_ecomkassa_receipt_with_retry(
         parsed_receipt, 
-        token, 
+        login,
+        password,
         group_code,
         operation_type
     )
@@ -777,7 +1255,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         operation_type,
         receipt_result.get('ecomkassa_response'),
         receipt_result.get('demo', False),
-        receipt_result.get('uuid')
+        receipt_result.get('uuid'),
+        user_id
     )
     
     return {
@@ -791,163 +1270,699 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     }
 
 
-def get_ecomkassa_token(login: str, password: str) -> Optional[str]:
-    auth_url = 'https://app.ecomkassa.ru/fiscalorder/v5/getToken'
+def ecomkassa_token_key(login: str, password: str) -> str:
+    import hashlib
+    password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
+    return cache_key(login, password_hash)
+
+
+def handle_bulk_job_status(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''GET ?job_id=... reports bulk job progress; the copies are made by run_bulk_jobs'''
+    query_params = event.get('queryStringParameters') or {}
+    job_id = query_params.get('job_id', '')
     
-    payload = {
-        'login': login,
-        'pass': password
-    }
+    if not job_id:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': 'job_id is required'})
+        }
     
     try:
-        req = urllib.request.Request(
-            auth_url,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={'Content-Type': 'application/json; charset=utf-8'},
-            method='POST'
-        )
-        
-        print(f"[DEBUG] Getting token for login: {login[:3]}***")
-        with urllib.request.urlopen(req, timeout=10) as response:
-            response_data = json.loads(response.read().decode('utf-8'))
-            print(f"[DEBUG] Token response code: {response_data.get('code')}")
-            if response_data.get('code') == 0:
-                token = response_data.get('token')
-                print(f"[DEBUG] Token received: {token[:50] if token else 'None'}...")
-                return token
-            else:
-                print(f"[DEBUG] Token error: {response_data.get('text')}")
-                return None
-    
+        progress = get_bulk_job_progress(job_id)
     except Exception as e:
-        print(f"[DEBUG] Exception getting token: {str(e)}")
-        return None
-
-
-def merge_receipts(previous: dict, new: dict) -> dict:
-    result = previous.copy()
+        log.error('Bulk job %s error: %s', job_id, e)
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'success': False, 'error': str(e)})
+        }
     
-    if new.get('client', {}).get('email') and new['client']['email'] != 'customer@example.com':
-        if 'client' not in result:
-            result['client'] = {}
-        result['client']['email'] = new['client']['email']
+    if not progress:
+        return {
+            'statusCode': 404,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': f'Задание {job_id} не найдено'})
+        }
     
-    if new.get('items') and len(new['items']) > 0:
-        first_item = new['items'][0]
-        if first_item.get('name') != 'Товар/Услуга':
-            result['items'] = new['items']
-            result['total'] = new.get('total', result.get('total', 0))
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'isBase64Encoded': False,
+        'body': json.dumps(progress)
+    }
+
+
+def get_ecomkassa_token(login: str, password: str) -> Optional[str]:
+    '''
+    Two-tier token lookup: in-process cache, then shared ecomkassa_tokens table,
+    and only then /getToken. Tokens are valid for 24 hours.
+    '''
+    key = ecomkassa_token_key(login, password)
     
-    if new.get('company'):
-        if 'company' not in result:
-            result['company'] = {}
-        for key, value in new['company'].items():
-            if value and value not in ['example@company.ru', 'None', '']:
-                result['company'][key] = value
+    def load_or_fetch() -> Optional[Tuple[str, float]]:
+        stored = load_ecomkassa_token_from_db(key)
+        if stored and stored[1] - ECOMKASSA_TOKEN_CACHE.refresh_margin > time.time():
+            log.debug('Ecomkassa token reused from shared cache')
+            return stored
+        fetched = fetch_ecomkassa_token(login, password)
+        if fetched:
+            store_ecomkassa_token_in_db(key, fetched[0], fetched[1])
+        return fetched
     
-    return result
+    return ECOMKASSA_TOKEN_CACHE.get(key, load_or_fetch)
 
 
-def detect_bulk_with_ai(text: str, settings: dict) -> Optional[tuple]:
+def prefetch_ecomkassa_token(login: str, password: str) -> Future:
+    return PREFETCH_EXECUTOR.submit(in_current_trace(get_ecomkassa_token), login, password)
+
+
+@traced('token')
+def join_ecomkassa_token(future: Optional[Future], login: str, password: str, deadline: float) -> Optional[str]:
     '''
-    AI-powered bulk command detection
-    Returns (count, uuid) tuple or None
+    Result of prefetch_ecomkassa_token, waiting no later than deadline
+    (time.monotonic). Without a prefetch the token is fetched inline.
     '''
-    import json
+    if future is None:
+        return get_ecomkassa_token(login, password)
     
-    text_lower = text.lower()
-    bulk_keywords = ['копи', 'дубл', 'повтор', 'еще', 'ещё', 'раз', 'штук']
-    has_bulk_keyword = any(kw in text_lower for kw in bulk_keywords)
-    has_number = any(char.isdigit() for char in text)
+    started = time.monotonic()
+    try:
+        token = future.result(timeout=max(0.0, deadline - started))
+    except FutureTimeoutError:
+        future.cancel()
+        log.warn('Ecomkassa token prefetch missed its deadline')
+        return None
+    except Exception as e:
+        log.error('Ecomkassa token prefetch failed: %s', e)
+        return None
+    log.debug('Ecomkassa token ready, waited %s ms at join', int((time.monotonic() - started) * 1000))
+    return token
+
+
+def invalidate_ecomkassa_token(login: str, password: str, token: Optional[str] = None) -> None:
+    key = ecomkassa_token_key(login, password)
+    ECOMKASSA_TOKEN_CACHE.invalidate(key, token)
+    delete_ecomkassa_token_from_db(key, token)
+
+
+def fetch_ecomkassa_token(login: str, password: str) -> Optional[Tuple[str, float]]:
+    auth_url = 'https://app.ecomkassa.ru/fiscalorder/v5/getToken'
+    
+    payload = {
+        'login': login,
+        'pass': password
+    }
+    
+    try:
+        log.debug('Getting token for login: %s***', login[:3])
+        response = http_client.post(
+            auth_url,
+            json=payload,
+            headers={'Content-Type': 'application/json; charset=utf-8'},
+            timeout=10
+        )
+        response.raise_for_status()
+        response_data = response.json()
+        log.debug('Token response code: %s', response_data.get('code'))
+        if response_data.get('code') == 0:
+            token = response_data.get('token')
+            log.debug('Token received: %s', bool(token))
+            if not token:
+                return None
+            return token, time.time() + ECOMKASSA_TOKEN_TTL
+        else:
+            log.warn('Token error: %s', response_data.get('text'))
+            return None
+    
+    except Exception as e:
+        log.error('Exception getting token: %s', e)
+        return None
+
+
+def load_ecomkassa_token_from_db(key: str) -> Optional[Tuple[str, float]]:
+    database_url = os.environ.get('DATABASE_URL', '')
+    if not database_url:
+        return None
     
-    if not (has_bulk_keyword and has_number):
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT token, EXTRACT(EPOCH FROM expires_at) FROM ecomkassa_tokens "
+                "WHERE cache_key = %s AND expires_at > (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')",
+                (key,)
+            )
+            row = cursor.fetchone()
+            cursor.close()
+        
+        if row:
+            return row[0], float(row[1])
+        return None
+    except Exception as e:
+        log.error('Error loading ecomkassa token from DB: %s', e)
         return None
+
+
+def store_ecomkassa_token_in_db(key: str, token: str, expires_at: float) -> None:
+    database_url = os.environ.get('DATABASE_URL', '')
+    if not database_url:
+        return
     
-    print(f"[DEBUG] AI bulk detection for: {text}")
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO ecomkassa_tokens (cache_key, token, expires_at) "
+                "VALUES (%s, %s, TO_TIMESTAMP(%s) AT TIME ZONE 'UTC') "
+                "ON CONFLICT (cache_key) DO UPDATE SET "
+                "token = EXCLUDED.token, "
+                "expires_at = EXCLUDED.expires_at, "
+                "updated_at = CURRENT_TIMESTAMP",
+                (key, token, expires_at)
+            )
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        log.error('Error saving ecomkassa token to DB: %s', e)
+
+
+def delete_ecomkassa_token_from_db(key: str, token: Optional[str] = None) -> None:
+    database_url = os.environ.get('DATABASE_URL', '')
+    if not database_url:
+        return
     
-    active_provider = settings.get('active_ai_provider', '')
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            if token:
+                cursor.execute("DELETE FROM ecomkassa_tokens WHERE cache_key = %s AND token = %s", (key, token))
+            else:
+                cursor.execute("DELETE FROM ecomkassa_tokens WHERE cache_key = %s", (key,))
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        log.error('Error deleting ecomkassa token from DB: %s', e)
+
+
+@traced('fiscal')
+def create_ecomkassa_receipt_with_retry(
+    receipt_data: Dict[str, Any],
+    login: str,
+    password: str,
+    group_code: str,
+    operation_type: str = 'sell',
+    ecomkassa_payload: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    '''Fiscalize with cached token; on token rejection evict it and retry once with a fresh one'''
+    if ecomkassa_payload is None:
+        ecomkassa_payload = build_ecomkassa_payload(receipt_data)
     
-    prompt = f"""Ты ИИ-помощник. Анализируй запрос и определи, просит ли пользователь создать копии/дубли чека.
+    token = get_ecomkassa_token(login, password)
+    if not token:
+        return {
+            'success': False,
+            'message': 'Не удалось авторизоваться в екомкасса',
+            'receipt': receipt_data,
+            'demo': True
+        }
+    
+    result = send_ecomkassa_payload(ecomkassa_payload, receipt_data, token, group_code, operation_type)
+    if result.pop('token_expired', False):
+        log.debug('Ecomkassa rejected cached token, fetching a new one')
+        invalidate_ecomkassa_token(login, password, token)
+        token = get_ecomkassa_token(login, password)
+        if token:
+            result = send_ecomkassa_payload(ecomkassa_payload, receipt_data, token, group_code, operation_type)
+            result.pop('token_expired', None)
+    return result
 
-Запрос: "{text}"
 
-Если это команда на создание копий чека:
-1. Найди КОЛИЧЕСТВО копий (число)
-2. Найди UUID/ID чека (последовательность цифр и букв, обычно 8+ символов)
+def fiscalize_copies(
+    receipt_copy: Dict[str, Any],
+    payloads: List[Tuple[int, Dict[str, Any]]],
+    login: str,
+    password: str,
+    group_code: str,
+    operation_type: str,
+    bulk_count: int
+) -> List[Dict[str, Any]]:
+    '''Send prebuilt (copy index, payload) pairs through a bounded worker pool, results keep input order'''
+    def create_copy(item: Tuple[int, Dict[str, Any]]) -> Dict[str, Any]:
+        i, ecomkassa_payload = item
+        log.debug('Creating copy %s/%s', i+1, bulk_count)
+        try:
+            result = create_ecomkassa_receipt_with_retry(
+                receipt_copy, login, password, group_code, operation_type,
+                ecomkassa_payload=ecomkassa_payload
+            )
+            log.debug('Copy %s result: success=%s', i+1, result.get('success'))
+            return result
+        except Exception as e:
+            log.error('Copy %s exception: %s', i+1, e)
+            return {'exception': str(e)}
+    
+    if not payloads:
+        return []
+    workers = max(1, min(BULK_CONCURRENCY, len(payloads)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(in_current_trace(create_copy), payloads))
 
-Примеры:
-- "105000516 сделай 2 дубля" → {{"bulk": true, "count": 2, "uuid": "105000516"}}
-- "создай 5 копий чека 12345678" → {{"bulk": true, "count": 5, "uuid": "12345678"}}
-- "повтори 3 раза abc123def" → {{"bulk": true, "count": 3, "uuid": "abc123def"}}
-- "еще 10 штук номер 999888" → {{"bulk": true, "count": 10, "uuid": "999888"}}
 
-Если это НЕ команда на копирование:
-{{"bulk": false}}
+def copy_result_error(result: Dict[str, Any]) -> Optional[str]:
+    '''None when the copy counts as created (success or demo), error text otherwise'''
+    if 'exception' in result:
+        return result['exception']
+    if result.get('success') or result.get('demo'):
+        return None
+    return result.get('error', 'Неизвестная ошибка')
 
-ВАЖНО: Отвечай ТОЛЬКО валидным JSON, без дополнительного текста."""
 
-    if active_provider == 'gptunnel_chatgpt':
-        import requests
-        api_key = settings.get('gptunnel_api_key', '')
-        model = settings.get('gptunnel_selected_model', 'gpt-4')
+@traced('bulk')
+def create_bulk_copies(
+    receipt_copy: Dict[str, Any],
+    bulk_count: int,
+    original_uuid: str,
+    login: str,
+    password: str,
+    group_code: str,
+    operation_type: str,
+    user_id: Optional[str] = None
+) -> Tuple[list, list]:
+    '''
+    Fiscalize bulk_count copies of one receipt through a bounded worker pool.
+    The Ecomkassa payload is built once; copies only differ by external_id/timestamp.
+    History rows are written with one multi-row insert at the end.
+    Returns (created, failed) lists ordered by copy index.
+    '''
+    payload_template = build_ecomkassa_payload(receipt_copy)
+    batch_ms = int(time.time() * 1000)
+    
+    payloads = [(i, with_fresh_external_id(payload_template, f'_{i}')) for i in range(bulk_count)]
+    results = fiscalize_copies(receipt_copy, payloads, login, password, group_code, operation_type, bulk_count)
+    
+    created_receipts = []
+    failed_receipts = []
+    db_rows = []
+    for i, result in enumerate(results):
+        error = copy_result_error(result)
+        if error is None:
+            unique_external_id = f'BULK_{original_uuid}_{batch_ms}_{i}'
+            db_rows.append(receipt_db_row(
+                unique_external_id,
+                f'Копия #{i+1} чека {original_uuid}',
+                receipt_copy,
+                operation_type,
+                result.get('ecomkassa_response'),
+                result.get('demo', False),
+                result.get('uuid'),
+                user_id
+            ))
+            created_receipts.append({
+                'index': i+1,
+                'uuid': result.get('uuid'),
+                'external_id': unique_external_id
+            })
+        else:
+            failed_receipts.append({'index': i+1, 'error': error})
+    
+    save_receipts_to_db(db_rows)
+    return created_receipts, failed_receipts
+
+
+@traced('db_save')
+def create_bulk_job(
+    receipt_copy: Dict[str, Any],
+    bulk_count: int,
+    original_uuid: str,
+    login: str,
+    password: str,
+    group_code: str,
+    operation_type: str,
+    user_id: Optional[str] = None
+) -> Optional[str]:
+    '''Register a bulk_jobs row with bulk_count pending copies, returns job id'''
+    database_url = os.environ.get('DATABASE_URL', '')
+    if not database_url:
+        return None
+    if not BULK_JOB_SECRET:
+        log.error('BULK_JOB_SECRET is not set, bulk jobs are disabled')
+        return None
+    
+    job_id = str(uuid.uuid4())
+    payload_template = build_ecomkassa_payload(receipt_copy)
+    
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO bulk_jobs (id, original_uuid, operation_type, receipt, ecomkassa_payload, "
+                "group_code, ecomkassa_credentials, credentials_expire_at, total_count, user_id) "
+                "VALUES (%s, %s, %s, %s, %s, %s, pgp_sym_encrypt(%s, %s), "
+                "CURRENT_TIMESTAMP + make_interval(secs => %s), %s, %s)",
+                (
+                    job_id,
+                    original_uuid,
+                    operation_type,
+                    json.dumps(receipt_copy),
+                    json.dumps(payload_template),
+                    group_code,
+                    json.dumps({'login': login, 'password': password}),
+                    BULK_JOB_SECRET,
+                    BULK_JOB_CREDENTIALS_TTL,
+                    bulk_count,
+                    user_id
+                )
+            )
+            cursor.execute(
+                "INSERT INTO bulk_job_copies (job_id, copy_index) "
+                "SELECT %s, i FROM generate_series(0, %s - 1) AS i",
+                (job_id, bulk_count)
+            )
+            conn.commit()
+            cursor.close()
+        return job_id
+    except Exception as e:
+        log.error('Error creating bulk job: %s', e)
+        return None
+
+
+def claim_bulk_job_chunk(job_id: str) -> Tuple[Optional[Dict[str, Any]], List[int]]:
+    '''
+    Mark next chunk of pending copies as processing. Copies stuck in processing
+    longer than BULK_JOB_STALE_SECONDS are reclaimed; SKIP LOCKED keeps
+    concurrent workers from taking the same copies. Credentials come back
+    decrypted as job['credentials'], None once they expired or were wiped.
+    '''
+    from psycopg2.extras import RealDictCursor
+    
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(
+            "SELECT id, status, original_uuid, operation_type, receipt, ecomkassa_payload, "
+            "group_code, total_count, user_id, "
+            "CASE WHEN credentials_expire_at > CURRENT_TIMESTAMP "
+            "THEN pgp_sym_decrypt(ecomkassa_credentials, %s) END AS credentials "
+            "FROM bulk_jobs WHERE id = %s",
+            (BULK_JOB_SECRET, job_id)
+        )
+        job = cursor.fetchone()
+        if not job or job['status'] == 'done':
+            cursor.close()
+            return job, []
         
-        if not api_key:
-            return None
+        cursor.execute(
+            "UPDATE bulk_job_copies SET status = 'processing', updated_at = CURRENT_TIMESTAMP "
+            "WHERE job_id = %s AND copy_index IN ("
+            "SELECT copy_index FROM bulk_job_copies "
+            "WHERE job_id = %s AND (status = 'pending' OR "
+            "(status = 'processing' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s))) "
+            "ORDER BY copy_index LIMIT %s FOR UPDATE SKIP LOCKED) "
+            "RETURNING copy_index",
+            (job_id, job_id, BULK_JOB_STALE_SECONDS, BULK_JOB_CHUNK)
+        )
+        indices = sorted(row['copy_index'] for row in cursor.fetchall())
+        if indices:
+            cursor.execute(
+                "UPDATE bulk_jobs SET status = 'running', "
+                "started_at = COALESCE(started_at, CURRENT_TIMESTAMP), updated_at = CURRENT_TIMESTAMP "
+                "WHERE id = %s",
+                (job_id,)
+            )
+        conn.commit()
+        cursor.close()
+        return job, indices
+
+
+def record_bulk_job_results(job: Dict[str, Any], results: List[Tuple[int, Dict[str, Any]]]) -> None:
+    '''Store per-copy outcome, save history rows and refresh job counters'''
+    from psycopg2.extras import execute_values
+    
+    job_id = job['id']
+    original_uuid = job['original_uuid']
+    receipt_copy = job['receipt']
+    
+    copy_rows = []
+    db_rows = []
+    for i, result in results:
+        error = copy_result_error(result)
+        external_id = f'BULK_{original_uuid}_{job_id[:8]}_{i}'
+        if error is None:
+            copy_rows.append((job_id, i, 'created', external_id, result.get('uuid'), None))
+            db_rows.append(receipt_db_row(
+                external_id,
+                f'Копия #{i+1} чека {original_uuid}',
+                receipt_copy,
+                job['operation_type'],
+                result.get('ecomkassa_response'),
+                result.get('demo', False),
+                result.get('uuid'),
+                job.get('user_id')
+            ))
+        else:
+            copy_rows.append((job_id, i, 'failed', None, None, error))
+    
+    save_receipts_to_db(db_rows)
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        execute_values(
+            cursor,
+            "UPDATE bulk_job_copies AS c SET status = v.status, external_id = v.external_id, "
+            "uuid = v.uuid, error = v.error, updated_at = CURRENT_TIMESTAMP "
+            "FROM (VALUES %s) AS v(job_id, copy_index, status, external_id, uuid, error) "
+            "WHERE c.job_id = v.job_id AND c.copy_index = v.copy_index",
+            copy_rows
+        )
+        cursor.execute(
+            "UPDATE bulk_jobs SET "
+            "done_count = (SELECT COUNT(*) FROM bulk_job_copies WHERE job_id = %s AND status = 'created'), "
+            "failed_count = (SELECT COUNT(*) FROM bulk_job_copies WHERE job_id = %s AND status = 'failed'), "
+            "updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = %s",
+            (job_id, job_id, job_id)
+        )
+        cursor.execute(
+            "UPDATE bulk_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, "
+            "ecomkassa_credentials = NULL "
+            "WHERE id = %s AND done_count + failed_count >= total_count",
+            (job_id,)
+        )
+        conn.commit()
+        cursor.close()
+
+
+def fail_bulk_job(job_id: str, error: str) -> None:
+    '''Mark all unfinished copies failed and close the job'''
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE bulk_job_copies SET status = 'failed', error = %s, updated_at = CURRENT_TIMESTAMP "
+            "WHERE job_id = %s AND status IN ('pending', 'processing')",
+            (error, job_id)
+        )
+        cursor.execute(
+            "UPDATE bulk_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, ecomkassa_credentials = NULL, "
+            "failed_count = (SELECT COUNT(*) FROM bulk_job_copies WHERE job_id = %s AND status = 'failed'), "
+            "updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = %s",
+            (job_id, job_id)
+        )
+        conn.commit()
+        cursor.close()
+
+
+@traced('bulk')
+def drain_bulk_job(job_id: str, deadline: float) -> None:
+    '''Process chunks of pending copies until the job is finished or time.monotonic() reaches deadline'''
+    while time.monotonic() < deadline:
+        job, indices = claim_bulk_job_chunk(job_id)
+        if not job or not indices:
+            return
+        if not job['credentials']:
+            log.warn('Bulk job %s: Ecomkassa credentials expired before the job finished', job_id)
+            fail_bulk_job(job_id, 'Истёк срок хранения доступа к екомкасса, копия не создана')
+            return
+        credentials = json.loads(job['credentials'])
         
+        template = job['ecomkassa_payload']
+        payloads = [
+            (i, {**template, 'external_id': f'JOB_{job_id}_{i}', 'timestamp': datetime_now_ecomkassa()})
+            for i in indices
+        ]
+        results = fiscalize_copies(
+            job['receipt'], payloads, credentials['login'], credentials['password'],
+            job['group_code'], job['operation_type'], job['total_count']
+        )
+        record_bulk_job_results(job, list(zip(indices, results)))
+
+
+def run_bulk_jobs(context: Any) -> Dict[str, Any]:
+    '''
+    Bulk job worker, started by a timer trigger. Drains unfinished jobs oldest
+    first while the invocation has time left; overlapping runs share the work
+    through claim_bulk_job_chunk. Credentials of jobs nobody finished before
+    their expiry are wiped here.
+    '''
+    if not os.environ.get('DATABASE_URL', ''):
+        return {'statusCode': 200, 'body': json.dumps({'jobs': 0})}
+    
+    remaining_ms = getattr(context, 'get_remaining_time_in_millis', None)
+    if callable(remaining_ms):
+        # Leave time to record the last chunk before the runtime stops us
+        budget = remaining_ms() / 1000 - BULK_JOB_STALE_SECONDS / 4
+    else:
+        budget = BULK_JOB_DRAIN_SECONDS
+    deadline = time.monotonic() + max(budget, 0)
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE bulk_jobs SET ecomkassa_credentials = NULL "
+            "WHERE ecomkassa_credentials IS NOT NULL AND credentials_expire_at <= CURRENT_TIMESTAMP"
+        )
+        cursor.execute(
+            "SELECT id FROM bulk_jobs WHERE status IN ('pending', 'running') ORDER BY created_at"
+        )
+        job_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        cursor.close()
+    
+    for job_id in job_ids:
+        if time.monotonic() >= deadline:
+            break
         try:
-            response = requests.post(
-                'https://gptunnel.ru/v1/chat/completions',
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'model': model,
-                    'messages': [{'role': 'user', 'content': prompt}],
-                    'temperature': 0.1,
-                    'max_tokens': 150
-                },
-                timeout=10
-            )
-            
-            if response.status_code != 200:
-                return None
-            
-            result = response.json()
-            ai_text = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-            print(f"[DEBUG] AI bulk detection response: {ai_text}")
-            
-            parsed = extract_json_from_text(ai_text)
-            if parsed and parsed.get('bulk'):
-                count = int(parsed.get('count', 0))
-                uuid = str(parsed.get('uuid', ''))
-                if count > 0 and uuid:
-                    print(f"[DEBUG] AI detected bulk: count={count}, uuid={uuid}")
-                    return (count, uuid)
+            drain_bulk_job(job_id, deadline)
         except Exception as e:
-            print(f"[ERROR] AI bulk detection failed: {e}")
+            log.error('Bulk job %s error: %s', job_id, e)
+    
+    return {'statusCode': 200, 'body': json.dumps({'jobs': len(job_ids)})}
+
+
+def get_bulk_job_progress(job_id: str) -> Optional[Dict[str, Any]]:
+    from psycopg2.extras import RealDictCursor
+    
+    with db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(
+            "SELECT id, status, original_uuid, total_count, done_count, failed_count, created_at, finished_at, "
+            "EXTRACT(EPOCH FROM (COALESCE(finished_at, CURRENT_TIMESTAMP) - started_at)) AS elapsed "
+            "FROM bulk_jobs WHERE id = %s",
+            (job_id,)
+        )
+        job = cursor.fetchone()
+        if not job:
+            cursor.close()
             return None
+        cursor.execute(
+            "SELECT copy_index, error FROM bulk_job_copies "
+            "WHERE job_id = %s AND status = 'failed' ORDER BY copy_index LIMIT 100",
+            (job_id,)
+        )
+        failed = [{'index': row['copy_index'] + 1, 'error': row['error']} for row in cursor.fetchall()]
+        cursor.close()
     
-    return None
+    processed = job['done_count'] + job['failed_count']
+    remaining = job['total_count'] - processed
+    elapsed = float(job['elapsed']) if job['elapsed'] is not None else None
+    eta_seconds = None
+    if job['status'] != 'done' and elapsed and processed > 0:
+        eta_seconds = round(elapsed / processed * remaining, 1)
+    
+    if job['status'] == 'done':
+        message = f"Копии чека {job['original_uuid']} были отправлены: {job['done_count']} штук"
+    else:
+        message = f"Создаю копии чека {job['original_uuid']}: {processed} из {job['total_count']}"
+    
+    return {
+        'success': True,
+        'message': message,
+        'job_id': job['id'],
+        'status': job['status'],
+        'original_uuid': job['original_uuid'],
+        'total_requested': job['total_count'],
+        'total_created': job['done_count'],
+        'total_failed': job['failed_count'],
+        'pending': remaining,
+        'eta_seconds': eta_seconds,
+        'elapsed_seconds': round(elapsed, 1) if elapsed is not None else None,
+        'failed': failed,
+        'created_at': job['created_at'].isoformat() if job['created_at'] else None,
+        'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None
+    }
 
 
-def detect_bulk_repeat_command(text: str) -> Optional[tuple]:
-    import re
-    text_lower = text.lower()
+def datetime_now_ecomkassa() -> str:
+    from datetime import datetime
+    return datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+
+
+def merge_receipts(previous: dict, new: dict) -> dict:
+    result = previous.copy()
     
-    bulk_patterns = [
-        r'(?:создай|сделай|отправ[иь])\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|чек[ао]в?)\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
-        r'(\d+)\s+(?:копи[йи]|дубл[ей]я?|раз[аы]?)\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
-        r'(?:создай|сделай)\s+(\d+)\s+штук\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
-        r'(\d+)\s+(?:копи[йи]|дубл[ей]я?)\s+№?\s*([a-zA-Z0-9_-]+)',
-        r'([a-zA-Z0-9_-]{8,})\s+(?:создай|сделай)\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|чек[ао]в?)',
-        r'([a-zA-Z0-9_-]{8,})\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|раз[аы]?)'
-    ]
+    if new.get('client', {}).get('email') and new['client']['email'] != 'customer@example.com':
+        if 'client' not in result:
+            result['client'] = {}
+        result['client']['email'] = new['client']['email']
+    
+    if new.get('items') and len(new['items']) > 0:
+        first_item = new['items'][0]
+        if first_item.get('name') != 'Товар/Услуга':
+            result['items'] = new['items']
+            result['total'] = new.get('total', result.get('total', 0))
+    
+    if new.get('company'):
+        if 'company' not in result:
+            result['company'] = {}
+        for key, value in new['company'].items():
+            if value and value not in ['example@company.ru', 'None', '']:
+                result['company'][key] = value
+    
+    return result
+
+
+# The last two patterns put the receipt number before the count
+BULK_PATTERNS = [re.compile(pattern) for pattern in (
+    r'(?:создай|сделай|отправ[иь])\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|чек[ао]в?)\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
+    r'(\d+)\s+(?:копи[йи]|дубл[ей]я?|раз[аы]?)\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
+    r'(?:создай|сделай)\s+(\d+)\s+штук\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
+    r'(\d+)\s+(?:копи[йи]|дубл[ей]я?)\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'([a-zA-Z0-9_-]{8,})\s+(?:создай|сделай)\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|чек[ао]в?)',
+    r'([a-zA-Z0-9_-]{8,})\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|раз[аы]?)'
+)]
+REPEAT_WITH_UUID_PATTERNS = [re.compile(pattern) for pattern in (
+    r'повтор[иь]\s+чек\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'повтор[иь]\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'отправ[иь]\s+снова\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'пересоздай\s+чек\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'создай\s+заново\s+№?\s*([a-zA-Z0-9_-]+)'
+)]
+REPEAT_LAST_PATTERN = re.compile(r'повтор[иь]\s+чек|повтор[иь]\s+последний|отправ[иь]\s+снова|пересоздай\s+чек|создай\s+заново')
+UUID_PATTERN = re.compile(r'\b([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}|[a-zA-Z0-9]{8,})\b')
+UUID_JUNK_PATTERN = re.compile(r'[^a-zA-Z0-9-]')
+
+
+def detect_bulk_repeat_command(text: str, flags: Optional[MessageFlags] = None) -> Optional[tuple]:
+    if not (flags or scan_message(text)).bulk:
+        return None
+    text_lower = text.lower()
     
-    print(f"[DEBUG] Detecting bulk command in: {text_lower}")
+    log.debug('Detecting bulk command in: %s', text_lower)
     
-    for i, pattern in enumerate(bulk_patterns):
-        match = re.search(pattern, text_lower)
+    for i, pattern in enumerate(BULK_PATTERNS):
+        match = pattern.search(text_lower)
         if match:
             if i >= 4:
                 uuid_raw = match.group(1)
@@ -955,84 +1970,71 @@ def detect_bulk_repeat_command(text: str) -> Optional[tuple]:
             else:
                 count = int(match.group(1))
                 uuid_raw = match.group(2)
-            print(f"[DEBUG] Pattern {i} matched! Count: {count}, UUID raw: {uuid_raw}")
+            log.debug('Pattern %s matched! Count: %s, UUID raw: %s', i, count, uuid_raw)
             uuid_clean = extract_uuid_with_ai(uuid_raw)
             result_uuid = uuid_clean if uuid_clean else uuid_raw
-            print(f"[DEBUG] Final UUID: {result_uuid}")
+            log.debug('Final UUID: %s', result_uuid)
             return (count, result_uuid)
     
-    print(f"[DEBUG] No bulk pattern matched")
+    log.debug('No bulk pattern matched')
     return None
 
 
-def detect_repeat_command(text: str) -> Optional[str]:
-    import re
+def detect_repeat_command(text: str, flags: Optional[MessageFlags] = None) -> Optional[str]:
+    if not (flags or scan_message(text)).repeat:
+        return None
     text_lower = text.lower()
     
-    repeat_with_uuid_patterns = [
-        r'повтор[иь]\s+чек\s+№?\s*([a-zA-Z0-9_-]+)',
-        r'повтор[иь]\s+№?\s*([a-zA-Z0-9_-]+)',
-        r'отправ[иь]\s+снова\s+№?\s*([a-zA-Z0-9_-]+)',
-        r'пересоздай\s+чек\s+№?\s*([a-zA-Z0-9_-]+)',
-        r'создай\s+заново\s+№?\s*([a-zA-Z0-9_-]+)'
-    ]
-    
-    for pattern in repeat_with_uuid_patterns:
-        match = re.search(pattern, text_lower)
+    for pattern in REPEAT_WITH_UUID_PATTERNS:
+        match = pattern.search(text_lower)
         if match:
             uuid_raw = match.group(1)
             uuid_clean = extract_uuid_with_ai(uuid_raw)
             return uuid_clean if uuid_clean else uuid_raw
     
-    repeat_without_uuid_patterns = [
-        r'повтор[иь]\s+чек',
-        r'повтор[иь]\s+последний',
-        r'отправ[иь]\s+снова',
-        r'пересоздай\s+чек',
-        r'создай\s+заново'
-    ]
-    
-    for pattern in repeat_without_uuid_patterns:
-        if re.search(pattern, text_lower):
-            return 'LAST'
+    if REPEAT_LAST_PATTERN.search(text_lower):
+        return 'LAST'
     
     return None
 
 
 def extract_uuid_with_ai(text: str) -> Optional[str]:
-    import re
-    uuid_pattern = r'\b([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}|[a-zA-Z0-9]{8,})\b'
-    match = re.search(uuid_pattern, text.lower())
+    match = UUID_PATTERN.search(text.lower())
     if match:
         return match.group(1)
-    cleaned = re.sub(r'[^a-zA-Z0-9-]', '', text)
+    cleaned = UUID_JUNK_PATTERN.sub('', text)
     if len(cleaned) >= 8:
         return cleaned
     return None
 
 
+@traced('db_lookup')
 def get_receipt_from_db(uuid_search: str) -> Optional[Dict[str, Any]]:
     database_url = os.environ.get('DATABASE_URL', '')
     if not database_url:
         return None
     
-    import psycopg2
     from psycopg2.extras import RealDictCursor
     
     try:
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(
-            "SELECT external_id, user_message, operation_type, items, total, "
-            "payment_type, payments, customer_email, ecomkassa_response FROM t_p7891941_voice_ai_agent_1.receipts "
-            "WHERE ecomkassa_response->>'uuid' = %s LIMIT 1",
-            (uuid_search,)
-        )
-        
-        receipt = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            
+            columns = (
+                "SELECT external_id, user_message, operation_type, items, total, "
+                "payment_type, payments, customer_email, ecomkassa_response FROM t_p7891941_voice_ai_agent_1.receipts "
+            )
+            cursor.execute(columns + "WHERE uuid = %s LIMIT 1", (uuid_search,))
+            receipt = cursor.fetchone()
+            
+            if not receipt:
+                # Rows saved before the uuid column was filled (idx_receipts_legacy_response_uuid)
+                cursor.execute(
+                    columns + "WHERE uuid IS NULL AND ecomkassa_response->>'uuid' = %s LIMIT 1",
+                    (uuid_search,)
+                )
+                receipt = cursor.fetchone()
+            cursor.close()
         
         if receipt:
             payments_data = receipt.get('payments') or [{
@@ -1055,33 +2057,48 @@ def get_receipt_from_db(uuid_search: str) -> Optional[Dict[str, Any]]:
         
         return None
     except Exception as e:
-        print(f"[DEBUG] Error getting receipt from DB: {str(e)}")
+        log.error('Error getting receipt from DB: %s', e)
         return None
 
 
-def get_last_receipt_from_db() -> Optional[Dict[str, Any]]:
+@traced('db_lookup')
+def get_last_receipt_from_db(user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''
+    Caller's last successful receipt: primary-key read through last_receipt,
+    falling back to idx_receipts_user_last_success. Without X-User-Id there
+    is no caller to scope to and nothing is returned (404 in the handler).
+    '''
     database_url = os.environ.get('DATABASE_URL', '')
-    if not database_url:
+    if not database_url or not user_id:
         return None
     
-    import psycopg2
     from psycopg2.extras import RealDictCursor
     
+    columns = (
+        "SELECT r.external_id, r.user_message, r.operation_type, r.items, r.total, "
+        "r.payment_type, r.payments, r.customer_email, r.ecomkassa_response "
+    )
+    
     try:
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(
-            "SELECT external_id, user_message, operation_type, items, total, "
-            "payment_type, payments, customer_email, ecomkassa_response "
-            "FROM t_p7891941_voice_ai_agent_1.receipts "
-            "WHERE status = 'success' AND demo_mode = false "
-            "ORDER BY created_at DESC LIMIT 1"
-        )
-        
-        receipt = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            
+            cursor.execute(
+                columns + "FROM last_receipt l "
+                "JOIN t_p7891941_voice_ai_agent_1.receipts r ON r.id = l.receipt_id "
+                "WHERE l.user_id = %s",
+                (user_id,)
+            )
+            receipt = cursor.fetchone()
+            if not receipt:
+                cursor.execute(
+                    columns + "FROM t_p7891941_voice_ai_agent_1.receipts r "
+                    "WHERE r.user_id = %s AND r.status = 'success' AND NOT r.demo_mode "
+                    "ORDER BY r.created_at DESC LIMIT 1",
+                    (user_id,)
+                )
+                receipt = cursor.fetchone()
+            cursor.close()
         
         if receipt:
             payments_data = receipt.get('payments') or [{
@@ -1102,52 +2119,22 @@ def get_last_receipt_from_db() -> Optional[Dict[str, Any]]:
         
         return None
     except Exception as e:
-        print(f"[DEBUG] Error getting last receipt from DB: {str(e)}")
+        log.error('Error getting last receipt from DB: %s', e)
         return None
 
 
-def detect_operation_type(text: str) -> str:
-    text_lower = text.lower()
-    
-    refund_keywords = [
-        'возврат', 'верни', 'вернуть', 'refund', 'отмен',
-        'верну', 'возвращ', 'отказ'
-    ]
-    
-    correction_keywords = [
-        'коррекция', 'исправ', 'корректир', 'ошибк'
-    ]
-    
-    refund_correction_keywords = [
-        'коррекция расход', 'исправить расход', 'под отчет'
-    ]
-    
-    sell_correction_keywords = [
-        'коррекция прихода', 'исправить приход', 'коррекция продаж'
-    ]
-    
-    for keyword in refund_correction_keywords:
-        if keyword in text_lower:
-            return 'refund_correction'
-    
-    for keyword in sell_correction_keywords:
-        if keyword in text_lower:
-            return 'sell_correction'
-    
-    for keyword in refund_keywords:
-        if keyword in text_lower:
-            return 'refund'
-    
-    for keyword in correction_keywords:
-        if keyword in text_lower:
-            return 'sell_correction'
-    
-    return 'sell'
+def detect_operation_type(text: str, flags: Optional[MessageFlags] = None) -> str:
+    '''Correction phrases win over refund words, refund words over bare corrections'''
+    return (flags or scan_message(text)).operation_type
 
 
 def get_gigachat_token(auth_key: str) -> Optional[str]:
-    import requests
-    
+    '''Cached GigaChat access token; OAuth is only hit shortly before expiry'''
+    return GIGACHAT_TOKEN_CACHE.get(cache_key(auth_key), lambda: fetch_gigachat_token(auth_key))
+
+
+def fetch_gigachat_token(auth_key: str) -> Optional[Tuple[str, float]]:
+    '''Request a new access token, returns (token, expires_at unix seconds)'''
     token_url = 'https://ngw.devices.sberbank.ru:9443/api/v2/oauth'
     
     headers = {
@@ -1161,40 +2148,41 @@ def get_gigachat_token(auth_key: str) -> Optional[str]:
     }
     
     try:
-        response = requests.post(token_url, headers=headers, data=data, verify=False, timeout=10)
+        response = http_client.post(token_url, headers=headers, data=data, verify=False)
         response_data = response.json()
-        return response_data.get('access_token')
+        access_token = response_data.get('access_token')
+        if not access_token:
+            return None
+        # expires_at comes in milliseconds; tokens live 30 minutes
+        expires_at = response_data.get('expires_at')
+        expires_at = expires_at / 1000 if expires_at else time.time() + 1800
+        return access_token, expires_at
     except Exception as e:
         return None
 
 
-def parse_receipt_from_text(text: str, settings: dict = None) -> Dict[str, Any]:
-    import re
-    
+@traced('parse')
+def parse_receipt_from_text(
+    text: str,
+    settings: dict = None,
+    with_intent: bool = False,
+    flags: Optional[MessageFlags] = None,
+    user_id: Optional[str] = None,
+    raw_text: str = ''
+) -> Dict[str, Any]:
+    '''
+    with_intent: one LLM call both classifies and parses. Besides a receipt the
+    result may then be {'intent': 'bulk_copy', 'count', 'uuid'} or
+    {'intent': 'repeat', 'uuid'} (uuid 'LAST' for the last receipt).
+    flags: scan_message(text) when the caller already has it
+    user_id: few-shot examples come from this user's history
+    raw_text: the message before normalize_message, sent to the LLM instead of text
+    '''
     if settings is None:
         settings = {}
     
-    text_lower = text.lower().strip()
-    greeting_patterns = [
-        r'^привет',
-        r'^здравствуй',
-        r'^добр[ыо]',
-        r'^hello',
-        r'^hi\b',
-        r'^hey\b',
-        r'^расскажи',
-        r'^что такое',
-        r'^как дела',
-        r'^анекдот',
-        r'^пошути',
-        r'^кто ты',
-        r'^помоги',
-        r'^спасибо'
-    ]
-    
-    for pattern in greeting_patterns:
-        if re.match(pattern, text_lower):
-            raise ValueError(
+    if (flags or scan_message(text)).greeting:
+        raise ValueError(
                 'Я ИИ-кассир и помогаю только с созданием чеков. '
                 'Укажи товар/услугу, цену и email клиента для создания чека.'
             )
@@ -1209,33 +2197,124 @@ def parse_receipt_from_text(text: str, settings: dict = None) -> Dict[str, Any]:
         settings.get('gptunnel_api_key')
     ])
     
+    context = settings.get('context_message', '')
+    with span('rules'):
+        rule_parse, confidence = parse_with_rules(text)
+    # Follow-ups merge with the previous request and copy commands need
+    # classification: both stay with the LLM
+    if rule_parse and confidence >= RULE_PARSE_MIN_CONFIDENCE and not context and not with_intent:
+        log.debug('Rule parser answered, confidence %.2f', confidence)
+        return finalize_parsed_receipt(rule_parse, settings)
+    
     if not has_any_ai and not active_provider:
-        print("[INFO] No AI provider configured, using fallback")
+        log.info('No AI provider configured, using fallback')
         return fallback_parse_receipt(text, settings)
     
-    print(f"[DEBUG] === AI Request ===")
-    print(f"[DEBUG] User message: {text[:100]}")
-    print(f"[DEBUG] Active provider: {active_provider}")
+    log.debug('=== AI Request ===')
+    log.debug('User message: %s', text[:100])
+    log.debug('Active provider: %s, rule parse confidence %.2f', active_provider, confidence)
+    
+    log.debug("Context from previous request: '%s'", context)
+    if not context:
+        # A dictation this long is a receipt even when it says "штук": no intent needed
+        with span('chunks'):
+            chunked = parse_long_dictation(text, settings, user_id)
+        if chunked:
+            return finalize_parsed_receipt(chunked, settings)
+    
+    hint = json.dumps(rule_parse, ensure_ascii=False) if rule_parse else ''
+    prompt_text = raw_text or text
+    with span('examples'):
+        examples = few_shot_examples(prompt_text, user_id)
+    parsed_data = cached_ai_completion(prompt_text, settings, context, with_intent, hint, examples)
+    
+    if not parsed_data or not is_valid_completion(parsed_data):
+        log.warn('AI parsing failed, using fallback')
+        return fallback_parse_receipt(text, settings)
     
-    context = settings.get('context_message', '')
-    print(f"[DEBUG] Context from previous request: '{context}'")
-    parsed_data = get_ai_completion(text, settings, context)
+    log.payload('Parsed data', parsed_data)
     
-    if not parsed_data:
-        print("[WARN] AI parsing failed, using fallback")
+    intent = parsed_data.pop('intent', 'receipt') if with_intent else 'receipt'
+    if intent == 'irrelevant':
+        raise ValueError(
+            'Я ИИ-кассир и помогаю только с созданием чеков. '
+            'Укажи товар/услугу, цену и email клиента для создания чека.'
+        )
+    if intent == 'bulk_copy':
+        try:
+            count = int(parsed_data.get('count', 0))
+        except (TypeError, ValueError):
+            count = 0
+        uuid_raw = str(parsed_data.get('uuid') or '')
+        if count > 0 and uuid_raw:
+            log.debug('AI detected bulk: count=%s, uuid=%s', count, uuid_raw)
+            return {'intent': 'bulk_copy', 'count': count, 'uuid': uuid_raw}
+        log.warn('AI bulk intent without count/uuid, using fallback')
         return fallback_parse_receipt(text, settings)
-    
-    print(f"[DEBUG] Parsed data: {parsed_data}")
+    if intent == 'repeat':
+        uuid_raw = parsed_data.get('uuid')
+        return {'intent': 'repeat', 'uuid': str(uuid_raw) if uuid_raw else 'LAST'}
     
     if 'error' in parsed_data:
         raise ValueError(parsed_data.get('error', 'Не хватает данных для создания чека'))
     
+    return finalize_parsed_receipt(parsed_data, settings)
+
+
+def parse_long_dictation(text: str, settings: dict, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''
+    Receipt of a dictation with more than LONG_DICTATION_ITEMS items: item
+    phrases (split_items) are parsed CHUNK_ITEMS at a time in parallel and
+    merged under one payments block built from the receipt-level rest.
+    None when the text is short, needs whole-receipt reasoning (credit,
+    discounts) or a chunk could not be parsed.
+    '''
+    lowered = text.lower()
+    if any(stem in lowered for stem in UNSUPPORTED_STEMS):
+        return None
+    phrases, rest = split_items(text)
+    if len(phrases) <= LONG_DICTATION_ITEMS:
+        return None
+    chunks = [', '.join(phrases[i:i + CHUNK_ITEMS]) for i in range(0, len(phrases), CHUNK_ITEMS)]
+    
+    def parse_chunk(chunk: str) -> Optional[List[Dict[str, Any]]]:
+        rule_parse, confidence = parse_with_rules(chunk)
+        if rule_parse and confidence >= RULE_PARSE_MIN_CONFIDENCE:
+            return rule_parse['items']
+        hint = json.dumps(rule_parse, ensure_ascii=False) if rule_parse else ''
+        parsed = cached_ai_completion(chunk, settings, '', False, hint, few_shot_examples(chunk, user_id))
+        if parsed and answer_problem({'items': parsed.get('items')}) is None:
+            return parsed['items']
+        return rule_parse['items'] if rule_parse else None
+    
+    workers = max(1, min(CHUNK_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(in_current_trace(parse_chunk), chunks))
+    failed = [i + 1 for i, part in enumerate(parts) if part is None]
+    if failed:
+        log.warn('Dictation chunks %s of %s not parsed, parsing it whole', failed, len(chunks))
+        return None
+    
+    items = [item for part in parts for item in part]
+    total = sum(line_sum(to_kopecks(item.get('price')), to_qty(item.get('quantity', 1))) for item in items)
+    payments, penalty = receipt_payments(rest, total)
+    if penalty:
+        log.warn('Payments of a chunked dictation do not add up to %s: %s', rubles(total), rest)
+    tokens = tokenize(text)
+    email = next((value for kind, value in tokens if kind == 'email'), None)
+    phone = next((value for kind, value in tokens if kind == 'phone'), None)
+    log.info('chunked dictation', phrases=len(phrases), chunks=len(chunks), items=len(items))
+    return {'items': items, 'client': {'email': email, 'phone': phone}, 'payments': payments}
+
+
+def finalize_parsed_receipt(parsed_data: Dict[str, Any], settings: dict) -> Dict[str, Any]:
+    '''LLM or rule parse -> receipt: default email and VAT, total, payments, company'''
     client_data = parsed_data.get('client', {})
     client_email = client_data.get('email', '') or ''
     
     if not client_email or client_email.strip() == '':
         client_email = settings.get('company_email', 'company@example.com')
-        print(f"[DEBUG] Client email empty, using default: {client_email}")
+        log.debug('Client email empty, using default: %s', client_email)
     
     items = parsed_data.get('items', [])
     default_vat = settings.get('default_vat', 'none')
@@ -1277,33 +2356,10 @@ def parse_receipt_from_text(text: str, settings: dict = None) -> Dict[str, Any]:
 
 
 def fallback_parse_receipt(text: str, settings: dict = None) -> Dict[str, Any]:
-    import re
-    
+    # Only reached from parse_receipt_from_text, which has already rejected greetings
     if settings is None:
         settings = {}
     
-    text_lower = text.lower().strip()
-    greeting_patterns = [
-        r'^привет',
-        r'^здравствуй',
-        r'^добр[ыо]',
-        r'^hello',
-        r'^hi\b',
-        r'^hey\b',
-        r'^расскажи',
-        r'^что такое',
-        r'^как дела',
-        r'^анекдот',
-        r'^пошути'
-    ]
-    
-    for pattern in greeting_patterns:
-        if re.match(pattern, text_lower):
-            raise ValueError(
-                'Я ИИ-кассир и помогаю только с созданием чеков. '
-                'Укажи товар/услугу, цену и email клиента для создания чека.'
-            )
-    
     email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', text)
     customer_email = email_match.group(0) if email_match else settings.get('company_email', '')
     
@@ -1408,26 +2464,17 @@ def fallback_parse_receipt(text: str, settings: dict = None) -> Dict[str, Any]:
     }
 
 
-def create_ecomkassa_receipt(
-    receipt_data: Dict[str, Any], 
-    token: str,
-    group_code: str,
-    operation_type: str = 'sell'
-) -> Dict[str, Any]:
-    
-    operation_mapping = {
-        'sell': 'sell',
-        'refund': 'sell_refund',
-        'sell_correction': 'sell_correction',
-        'refund_correction': 'buy_refund_correction'
+def with_fresh_external_id(ecomkassa_payload: Dict[str, Any], suffix: str = '') -> Dict[str, Any]:
+    '''Shallow copy of a built payload with its own external_id and timestamp'''
+    return {
+        **ecomkassa_payload,
+        'external_id': f'AI_{int(time.time() * 1000000)}{suffix}',
+        'timestamp': datetime_now_ecomkassa()
     }
-    
-    api_operation_type = operation_mapping.get(operation_type, 'sell')
-    
-    api_url = f'https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/{api_operation_type}'
-    
+
+
+def build_ecomkassa_payload(receipt_data: Dict[str, Any]) -> Dict[str, Any]:
     from datetime import datetime
-    import time
     
     client_data = receipt_data.get('client', {})
     company_data = receipt_data.get('company', {})
@@ -1451,116 +2498,33 @@ def create_ecomkassa_receipt(
         'сутки': '24'
     }
     
-    # Build items, split fractional quantities to ensure price * quantity = sum
-    from decimal import Decimal, ROUND_HALF_UP
-    import math
-    
-    items_for_payload = []
-    for item in receipt_data['items']:
-        qty_decimal = Decimal(str(item.get('quantity', 1)))
-        price_decimal = Decimal(str(item['price']))
-        total_sum = float((price_decimal * qty_decimal).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
-        
-        # If quantity has fractional part, split into integer + fraction
-        qty_float = float(qty_decimal)
-        qty_int = math.floor(qty_float)
-        qty_frac = qty_float - qty_int
-        
-        if qty_frac > 0.001:  # Has fractional part
-            # Integer part
-            if qty_int > 0:
-                price_rounded = float(price_decimal.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
-                int_sum = float((Decimal(str(price_rounded)) * Decimal(str(qty_int))).quantize(Decimal('0.01')))
-                
-                items_for_payload.append({
-                    'name': item['name'],
-                    'price': price_rounded,
-                    'quantity': qty_int,
-                    'sum': int_sum,
-                    'measure': int(measure_map.get(item.get('measure', 'шт'), '0')),
-                    'payment_method': item.get('payment_method', 'full_payment'),
-                    'payment_object': {
-                        'commodity': 1,
-                        'excise': 2,
-                        'job': 3,
-                        'service': 4
-                    }.get(item.get('payment_object'), 4),
-                    'vat': {'type': item.get('vat', 'none')}
-                })
-            else:
-                int_sum = 0
-            
-            # Fractional part with adjusted price to match total
-            frac_sum = round(total_sum - int_sum, 2)
-            frac_price = float((Decimal(str(frac_sum)) / Decimal(str(qty_frac))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
-            
-            items_for_payload.append({
-                'name': item['name'],
-                'price': frac_price,
-                'quantity': qty_frac,
-                'sum': frac_sum,
-                'measure': int(measure_map.get(item.get('measure', 'шт'), '0')),
-                'payment_method': item.get('payment_method', 'full_payment'),
-                'payment_object': {
-                    'commodity': 1,
-                    'excise': 2,
-                    'job': 3,
-                    'service': 4
-                }.get(item.get('payment_object'), 4),
-                'vat': {'type': item.get('vat', 'none')}
-            })
-        else:
-            # No fractional part - simple calculation
-            price_rounded = float(price_decimal.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
-            item_sum = float((Decimal(str(price_rounded)) * qty_decimal).quantize(Decimal('0.01')))
-            
-            items_for_payload.append({
-                'name': item['name'],
-                'price': price_rounded,
-                'quantity': float(qty_decimal),
-                'sum': item_sum,
-                'measure': int(measure_map.get(item.get('measure', 'шт'), '0')),
-                'payment_method': item.get('payment_method', 'full_payment'),
-                'payment_object': {
-                    'commodity': 1,
-                    'excise': 2,
-                    'job': 3,
-                    'service': 4
-                }.get(item.get('payment_object'), 4),
-                'vat': {'type': item.get('vat', 'none')}
-            })
-    
-    calculated_total = round(sum(item['sum'] for item in items_for_payload), 2)
-    
-    # Get payment total from actual payments
-    payments_list = receipt_data.get('payments', [{'type': 1, 'sum': calculated_total}])
-    payment_total = round(sum(float(p.get('sum', 0)) for p in payments_list), 2)
-    
-    # Fix rounding: adjust last item price to match payment total
-    # Ecomkassa validates: price * quantity == sum for each item
-    # Use Decimal for precise money calculations
-    from decimal import Decimal, ROUND_HALF_UP
+    payment_object_map = {
+        'commodity': 1,
+        'excise': 2,
+        'job': 3,
+        'service': 4
+    }
     
-    items_total = round(sum(item['sum'] for item in items_for_payload), 2)
-    if items_total != payment_total and len(items_for_payload) > 0:
-        difference = round(payment_total - items_total, 2)
-        last_item = items_for_payload[-1]
-        # Recalculate last item: new_sum = old_sum + difference, new_price = new_sum / quantity
-        new_sum = round(last_item['sum'] + difference, 2)
-        last_item['sum'] = new_sum
-        
-        # Use Decimal for exact calculation
-        sum_decimal = Decimal(str(new_sum))
-        qty_decimal = Decimal(str(last_item['quantity']))
-        price_decimal = sum_decimal / qty_decimal
-        
-        # Round to 2 decimals
-        price_rounded = float(price_decimal.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
-        last_item['price'] = price_rounded
-        
-        # Verify: recalculate sum with rounded price
-        verify_sum = round(price_rounded * last_item['quantity'], 2)
-        print(f"[DEBUG] Adjusted last item: price={price_rounded}, sum={new_sum}, verify_sum={verify_sum}, payment_total={payment_total}")
+    # Exact kopeck arithmetic; every line satisfies price * quantity == sum
+    # and the lines add up to the payments total
+    payments_list = receipt_data.get('payments')
+    lines, payment_sums, payment_total = build_money(receipt_data['items'], payments_list)
+    if not payments_list:
+        payments_list = [{'type': 1}]
+    
+    items_for_payload = [
+        {
+            'name': line.item['name'],
+            'price': rubles(line.price),
+            'quantity': qty_value(line.qty),
+            'sum': rubles(line.sum),
+            'measure': int(measure_map.get(line.item.get('measure', 'шт'), '0')),
+            'payment_method': line.item.get('payment_method', 'full_payment'),
+            'payment_object': payment_object_map.get(line.item.get('payment_object'), 4),
+            'vat': {'type': line.item.get('vat', 'none')}
+        }
+        for line in lines
+    ]
     
     unique_id = f'AI_{int(time.time() * 1000000)}'
     
@@ -1581,54 +2545,74 @@ def create_ecomkassa_receipt(
             'payments': [
                 {
                     'type': int(payment.get('type', 1)) if isinstance(payment.get('type'), str) and payment.get('type').isdigit() else 1,
-                    'sum': float(payment.get('sum', payment_total))
+                    'sum': rubles(payment_sum)
                 }
-                for payment in payments_list
+                for payment, payment_sum in zip(payments_list, payment_sums)
             ],
-            'total': payment_total
+            'total': rubles(payment_total)
         }
     }
     
-    print(f"[DEBUG] Sending to ecomkassa: {api_url}")
-    print(f"[DEBUG] Payload: {json.dumps(ecomkassa_payload, ensure_ascii=False, indent=2)}")
+    return ecomkassa_payload
+
+
+def send_ecomkassa_payload(
+    ecomkassa_payload: Dict[str, Any],
+    receipt_data: Dict[str, Any],
+    token: str,
+    group_code: str,
+    operation_type: str = 'sell'
+) -> Dict[str, Any]:
+    operation_mapping = {
+        'sell': 'sell',
+        'refund': 'sell_refund',
+        'sell_correction': 'sell_correction',
+        'refund_correction': 'buy_refund_correction'
+    }
+    
+    api_operation_type = operation_mapping.get(operation_type, 'sell')
+    
+    api_url = f'https://app.ecomkassa.ru/fiscalorder/v5/{group_code}/{api_operation_type}'
+    
+    log.debug('Sending to ecomkassa: %s', api_url)
+    log.payload('Ecomkassa payload', ecomkassa_payload)
     
     try:
-        req = urllib.request.Request(
+        response = http_client.post(
             api_url,
-            data=json.dumps(ecomkassa_payload).encode('utf-8'),
+            json=ecomkassa_payload,
             headers={
                 'Content-Type': 'application/json',
                 'Token': token
-            },
-            method='POST'
+            }
         )
         
-        with urllib.request.urlopen(req, timeout=15) as response:
-            response_data = json.loads(response.read().decode('utf-8'))
-            print(f"[DEBUG] Ecomkassa success response: {json.dumps(response_data, ensure_ascii=False)}")
-            
-            uuid = response_data.get('uuid', '')
-            permalink = response_data.get('permalink', '')
-            
+        if response.status_code >= 400:
+            error_body = response.text
+            log.warn('Ecomkassa HTTP error %s: %s', response.status_code, error_body)
             return {
-                'success': True,
-                'message': 'Чек успешно создан в екомкасса',
-                'uuid': uuid,
-                'permalink': permalink,
+                'success': False,
+                'message': f'Ошибка API екомкасса: {response.status_code}',
                 'receipt': receipt_data,
-                'ecomkassa_response': response_data,
-                'operation_type': operation_type
+                'error': error_body,
+                'demo': True,
+                'token_expired': is_ecomkassa_token_error(response.status_code, error_body)
             }
-    
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        print(f"[DEBUG] Ecomkassa HTTP error {e.code}: {error_body}")
+        
+        response_data = response.json()
+        log.payload('Ecomkassa success response', response_data)
+        
+        uuid = response_data.get('uuid', '')
+        permalink = response_data.get('permalink', '')
+        
         return {
-            'success': False,
-            'message': f'Ошибка API екомкасса: {e.code}',
+            'success': True,
+            'message': 'Чек успешно создан в екомкасса',
+            'uuid': uuid,
+            'permalink': permalink,
             'receipt': receipt_data,
-            'error': error_body,
-            'demo': True
+            'ecomkassa_response': response_data,
+            'operation_type': operation_type
         }
     
     except Exception as e:
@@ -1640,6 +2624,70 @@ def create_ecomkassa_receipt(
         }
 
 
+def is_ecomkassa_token_error(status_code: int, error_body: str) -> bool:
+    '''ATOL v5: 401 or error codes 10/11 mean missing/expired token'''
+    if status_code == 401:
+        return True
+    try:
+        error = json.loads(error_body).get('error') or {}
+        return error.get('code') in (10, 11)
+    except (ValueError, AttributeError):
+        return False
+
+
+RECEIPT_INSERT_SQL = (
+    'INSERT INTO receipts (external_id, user_message, operation_type, items, total, '
+    'payment_type, payments, customer_email, ecomkassa_response, status, demo_mode, uuid, user_id) '
+    'VALUES %s '
+    'ON CONFLICT (external_id) DO UPDATE SET '
+    'ecomkassa_response = EXCLUDED.ecomkassa_response, '
+    'payments = EXCLUDED.payments, '
+    'status = EXCLUDED.status, '
+    'uuid = EXCLUDED.uuid, '
+    'user_id = COALESCE(EXCLUDED.user_id, receipts.user_id), '
+    'updated_at = CURRENT_TIMESTAMP '
+    'RETURNING id, external_id'
+)
+
+LAST_RECEIPT_UPSERT_SQL = (
+    'INSERT INTO last_receipt (user_id, receipt_id) VALUES %s '
+    'ON CONFLICT (user_id) DO UPDATE SET '
+    'receipt_id = EXCLUDED.receipt_id, '
+    'updated_at = CURRENT_TIMESTAMP'
+)
+
+
+def receipt_db_row(
+    external_id: str,
+    user_message: str,
+    receipt_data: Dict[str, Any],
+    operation_type: str,
+    ecomkassa_response: Optional[Dict[str, Any]],
+    demo_mode: bool,
+    uuid: Optional[str] = None,
+    user_id: Optional[str] = None
+) -> tuple:
+    # Определяем payment_type для отображения (первый тип оплаты)
+    payments = receipt_data.get('payments', [])
+    payment_type_display = payments[0].get('type', '1') if payments else receipt_data.get('payment_type', 'card')
+    
+    return (
+        external_id,
+        user_message,
+        operation_type,
+        json.dumps(receipt_data['items']),
+        receipt_data['total'],
+        payment_type_display,
+        json.dumps(payments) if payments else None,
+        receipt_data.get('customer_email'),
+        json.dumps(ecomkassa_response) if ecomkassa_response else None,
+        'success' if not demo_mode else 'demo',
+        demo_mode,
+        uuid or None,
+        user_id
+    )
+
+
 def save_receipt_to_db(
     external_id: str,
     user_message: str,
@@ -1647,52 +2695,78 @@ def save_receipt_to_db(
     operation_type: str,
     ecomkassa_response: Optional[Dict[str, Any]],
     demo_mode: bool,
-    uuid: Optional[str] = None
+    uuid: Optional[str] = None,
+    user_id: Optional[str] = None
 ) -> None:
+    save_receipts_to_db([
+        receipt_db_row(external_id, user_message, receipt_data, operation_type, ecomkassa_response, demo_mode, uuid, user_id)
+    ])
+
+
+@traced('db_save')
+def save_receipts_to_db(rows: list) -> None:
+    '''
+    Write receipt history rows (see receipt_db_row) in a single multi-row insert
+    and move each user's last_receipt pointer in the same transaction
+    '''
     database_url = os.environ.get('DATABASE_URL', '')
     
-    if not database_url:
+    if not database_url or not rows:
         return
     
-    import psycopg2
+    from psycopg2.extras import execute_values
     
     try:
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        
-        # Определяем payment_type для отображения (первый тип оплаты)
-        payments = receipt_data.get('payments', [])
-        payment_type_display = payments[0].get('type', '1') if payments else receipt_data.get('payment_type', 'card')
-        
-        cursor.execute(
-            'INSERT INTO receipts (external_id, user_message, operation_type, items, total, '
-            'payment_type, payments, customer_email, ecomkassa_response, status, demo_mode, uuid) '
-            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) '
-            'ON CONFLICT (external_id) DO UPDATE SET '
-            'ecomkassa_response = EXCLUDED.ecomkassa_response, '
-            'payments = EXCLUDED.payments, '
-            'status = EXCLUDED.status, '
-            'uuid = EXCLUDED.uuid, '
-            'updated_at = CURRENT_TIMESTAMP',
-            (
-                external_id,
-                user_message,
-                operation_type,
-                json.dumps(receipt_data['items']),
-                receipt_data['total'],
-                payment_type_display,
-                json.dumps(payments) if payments else None,
-                receipt_data.get('customer_email'),
-                json.dumps(ecomkassa_response) if ecomkassa_response else None,
-                'success' if not demo_mode else 'demo',
-                demo_mode,
-                uuid
-            )
-        )
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            rows = without_taken_uuids(cursor, rows)
+            saved = execute_values(cursor, RECEIPT_INSERT_SQL, rows, page_size=100, fetch=True) if rows else []
+            ids = {external_id: receipt_id for receipt_id, external_id in saved}
+            
+            last_by_user = {}
+            for row in rows:
+                external_id, status, demo_mode, user_id = row[0], row[9], row[10], row[12]
+                if user_id and status == 'success' and not demo_mode and external_id in ids:
+                    last_by_user[user_id] = ids[external_id]
+            if last_by_user:
+                execute_values(cursor, LAST_RECEIPT_UPSERT_SQL, list(last_by_user.items()))
+            conn.commit()
+            cursor.close()
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        # A new receipt becomes a few-shot example in this container right away;
+        # one per batch, bulk copies would otherwise fill the index with one answer
+        for row in rows:
+            external_id, user_message, items, payments = row[0], row[1], row[3], row[6]
+            if row[9] == 'success' and not row[10] and external_id in ids:
+                answer = example_answer(items, payments)
+                if answer:
+                    EXAMPLE_INDEX.add(ids[external_id], user_message, answer, row[12])
+                break
     
-    except Exception:
-        pass
\ No newline at end of file
+    except Exception as e:
+        log.error('Error saving %s receipts to DB: %s', len(rows), e)
+
+
+def without_taken_uuids(cursor, rows: list) -> list:
+    '''
+    ON CONFLICT DO NOTHING for idx_receipts_uuid: an insert can arbitrate on
+    one constraint only and RECEIPT_INSERT_SQL already upserts by
+    external_id, so rows whose Ecomkassa uuid belongs to another receipt
+    are dropped here and logged instead of failing the whole batch.
+    '''
+    uuids = [row[11] for row in rows if row[11]]
+    if not uuids:
+        return rows
+    cursor.execute('SELECT uuid, external_id FROM receipts WHERE uuid = ANY(%s)', (uuids,))
+    owners = dict(cursor.fetchall())
+    kept = []
+    for row in rows:
+        owner = owners.get(row[11]) if row[11] else None
+        if owner is not None and owner != row[0]:
+            log.warn('Receipt %s not saved: uuid %s already belongs to %s', row[0], row[11], owner)
+            continue
+        if row[11]:
+            # Two rows of one batch with the same uuid: keep the first
+            owners[row[11]] = row[0]
+        kept.append(row)
+    return kept
@@ -0,0 +1,159 @@
+import re
+from typing import Any, Dict, FrozenSet, Iterable, List
+
+# Keyword lists of the request filter and command detectors. Matching keeps
+# their original substring semantics ("кофе" in text_lower), but all lists are
+# searched by one precompiled pattern in a single pass over the message.
+KEYWORDS: Dict[str, List[str]] = {
+    'irrelevant': [
+        'привет', 'здравствуй', 'добрый', 'доброе', 'hello', 'hi', 'hey',
+        'расскажи', 'что такое', 'как дела', 'анекдот', 'пошути',
+        'кто ты', 'спасибо', 'благодарю', 'помоги', 'помощь',
+        'шутка', 'история', 'сказка', 'стих', 'стоп', 'хватит', 'стой',
+        'пока', 'досвидания', 'хай', 'хелло'
+    ],
+    'receipt': [
+        'чек', 'товар', 'услуга', 'продаж', 'возврат', 'корр',
+        'руб', '₽', 'email', '@', 'цена', 'сумма', 'отправ', 'созда',
+        'копи', 'повтор', 'дубл', 'еще раз', 'ещё раз'
+    ],
+    # Copy request next to a long receipt number passes the filter
+    'copy': ['копи', 'повтор', 'дубл', 'еще', 'ещё'],
+    # Digit plus one of these: the LLM decides between receipt and bulk copy
+    'intent': ['копи', 'дубл', 'повтор', 'еще', 'ещё', 'раз', 'штук'],
+    # Every bulk and repeat command pattern contains one of these
+    'bulk': ['копи', 'дубл', 'раз', 'чек', 'штук'],
+    'repeat': ['повтор', 'снова', 'пересоздай', 'заново'],
+    'refund_correction': ['коррекция расход', 'исправить расход', 'под отчет'],
+    'sell_correction': ['коррекция прихода', 'исправить приход', 'коррекция продаж'],
+    'refund': ['возврат', 'верни', 'вернуть', 'refund', 'отмен', 'верну', 'возвращ', 'отказ'],
+    'correction': ['коррекция', 'исправ', 'корректир', 'ошибк']
+}
+
+# Only count at the very start of the message; True: must end on a word boundary
+GREETINGS: Dict[str, bool] = {
+    'привет': False, 'здравствуй': False, 'добры': False, 'добро': False, 'hello': False,
+    'hi': True, 'hey': True, 'расскажи': False, 'что такое': False, 'как дела': False,
+    'анекдот': False, 'пошути': False, 'кто ты': False, 'помоги': False, 'спасибо': False
+}
+
+LONG_NUMBER = 8
+
+
+class MessageFlags:
+    '''Everything the handler asks about a message, from one scan'''
+    __slots__ = ('categories', 'greeting', 'has_digit', 'long_number')
+
+    def __init__(self, categories: FrozenSet[str], greeting: bool, has_digit: bool, long_number: bool):
+        self.categories = categories
+        self.greeting = greeting
+        self.has_digit = has_digit
+        self.long_number = long_number
+
+    @property
+    def irrelevant(self) -> bool:
+        return 'irrelevant' in self.categories
+
+    @property
+    def receipt(self) -> bool:
+        return 'receipt' in self.categories
+
+    @property
+    def copy(self) -> bool:
+        '''Copy/repeat word next to a receipt number ("повтори 12345678")'''
+        return self.long_number and 'copy' in self.categories
+
+    @property
+    def needs_intent(self) -> bool:
+        return self.has_digit and 'intent' in self.categories
+
+    @property
+    def bulk(self) -> bool:
+        return self.has_digit and 'bulk' in self.categories
+
+    @property
+    def repeat(self) -> bool:
+        return 'repeat' in self.categories
+
+    @property
+    def operation_type(self) -> str:
+        categories = self.categories
+        if 'refund_correction' in categories:
+            return 'refund_correction'
+        if 'sell_correction' in categories:
+            return 'sell_correction'
+        if 'refund' in categories:
+            return 'refund'
+        if 'correction' in categories:
+            return 'sell_correction'
+        return 'sell'
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    '''
+    Alternation factored by common prefixes ("ко(?:пи|рр(?:екция)?)"): the
+    engine rejects a position after one character instead of trying every
+    keyword. Optional tails are greedy, so the longest keyword wins.
+    '''
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def emit(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else f'(?:{"|".join(branches)})'
+        return f'(?:{body})?' if '' in node else body
+
+    return emit(trie)
+
+
+def _build(keywords: Dict[str, List[str]], greetings: Iterable[str]):
+    '''
+    One alternation inside a lookahead: the scan visits every position, so
+    keywords overlapping each other are all seen. At one position only the
+    longest keyword is reported, hence each keyword also carries the
+    categories of every keyword contained in it ("коррекция продаж" -> корр).
+    '''
+    words = set(greetings)
+    for items in keywords.values():
+        words.update(items)
+    implied: Dict[str, FrozenSet[str]] = {}
+    for word in words:
+        implied[word] = frozenset(
+            category for category, items in keywords.items() if any(item in word for item in items)
+        )
+    # Greeting a reported word starts with ("добрый" -> "добры")
+    greeting_prefix = {}
+    for word in words:
+        prefixes = [greeting for greeting in greetings if word.startswith(greeting)]
+        if prefixes:
+            greeting_prefix[word] = max(prefixes, key=len)
+    pattern = re.compile(rf'(?=({_trie_pattern(words)}|\d{{{LONG_NUMBER}}}|\d))')
+    return pattern, implied, greeting_prefix
+
+
+_PATTERN, _IMPLIED, _GREETING_PREFIX = _build(KEYWORDS, GREETINGS)
+
+
+def scan_message(text: str) -> MessageFlags:
+    text = text.lower().strip()
+    categories = set()
+    greeting = has_digit = long_number = False
+    for match in _PATTERN.finditer(text):
+        word = match.group(1)
+        if word[0].isdigit():
+            has_digit = True
+            if len(word) == LONG_NUMBER:
+                long_number = True
+            continue
+        categories |= _IMPLIED[word]
+        if match.start() == 0 and word in _GREETING_PREFIX:
+            prefix = _GREETING_PREFIX[word]
+            end = len(prefix)
+            greeting = not GREETINGS[prefix] or end == len(text) or not (text[end].isalnum() or text[end] == '_')
+    return MessageFlags(frozenset(categories), greeting, has_digit, long_number)
@@ -0,0 +1,119 @@
+import json
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class JSONObjectScanner:
+    '''
+    Incremental scanner over streamed model output. Tracks brace depth
+    outside of string literals and returns the first top-level {...} that
+    parses, as soon as its closing brace arrives.
+    '''
+
+    def __init__(self):
+        self._chars = []
+        self._start: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._chars)
+
+    def feed(self, chunk: str) -> Optional[Dict[str, Any]]:
+        for ch in chunk:
+            self._chars.append(ch)
+            if self._start is None:
+                if ch == '{':
+                    self._start = len(self._chars) - 1
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == '{':
+                self._depth += 1
+            elif ch == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = ''.join(self._chars[self._start:])
+                    self._start = None
+                    try:
+                        parsed = json.loads(candidate, strict=False)
+                    except json.JSONDecodeError:
+                        # Stray brace in prose: keep scanning for the next object
+                        continue
+                    if isinstance(parsed, dict):
+                        return parsed
+        return None
+
+
+def sse_data(lines: Iterable[bytes]) -> Iterable[str]:
+    '''Payloads of "data:" lines of a server-sent events stream, stops at [DONE]'''
+    for raw in lines:
+        if not raw:
+            continue
+        line = raw.decode('utf-8', errors='replace')
+        if not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return
+        yield data
+
+
+def openai_delta(data: str) -> str:
+    '''Text delta of an OpenAI-compatible chat.completion.chunk (GigaChat and GPTunnel)'''
+    try:
+        chunk = json.loads(data)
+    except json.JSONDecodeError:
+        return ''
+    choices = chunk.get('choices') or [{}]
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+
+def yandex_deltas(lines: Iterable[bytes]) -> Iterable[str]:
+    '''
+    YandexGPT streams one JSON document per line, each carrying the full
+    text generated so far: turn it into deltas.
+    '''
+    previous = ''
+    for raw in lines:
+        if not raw:
+            continue
+        try:
+            chunk = json.loads(raw.decode('utf-8', errors='replace'))
+        except json.JSONDecodeError:
+            continue
+        alternatives = (chunk.get('result') or {}).get('alternatives') or [{}]
+        text = (alternatives[0].get('message') or {}).get('text') or ''
+        if text.startswith(previous):
+            yield text[len(previous):]
+        else:
+            yield text
+        previous = text
+
+
+def read_json_object(deltas: Iterable[str], on_complete: Callable[[], None] = None) -> Optional[Dict[str, Any]]:
+    '''
+    Feed text deltas into the scanner and stop at the first complete object.
+    on_complete lets the caller abort generation (close the HTTP stream).
+    Returns None if the stream ended without a complete object.
+    '''
+    scanner = JSONObjectScanner()
+    for delta in deltas:
+        parsed = scanner.feed(delta)
+        if parsed is not None:
+            if on_complete:
+                on_complete()
+            return parsed
+    return None
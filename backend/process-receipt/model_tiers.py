@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+import log
+from hedging import LatencyWindow
+
+FAST = 'fast'
+STRONG = 'strong'
+
+# provider -> (fast model, strong model); AI_MODEL_TIERS (JSON) or settings.ai_model_tiers override
+DEFAULT_MODEL_TIERS: Dict[str, Tuple[str, str]] = {
+    'gigachat': ('GigaChat', 'GigaChat-Pro'),
+    'yandexgpt': ('yandexgpt-lite', 'yandexgpt'),
+    'gptunnel_chatgpt': ('gpt-4o-mini', 'gpt-4o'),
+    'gptunnel_claude': ('claude-3-haiku', 'claude-3.5-sonnet')
+}
+
+
+def _env_tiers() -> Dict[str, Tuple[str, str]]:
+    raw = os.environ.get('AI_MODEL_TIERS', '')
+    if not raw:
+        return {}
+    try:
+        return {provider: tuple(models) for provider, models in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError):
+        log.warn('AI_MODEL_TIERS is not valid JSON, using defaults')
+        return {}
+
+
+ENV_MODEL_TIERS = _env_tiers()
+
+
+def model_tiers(provider: str, settings: dict) -> Tuple[str, str]:
+    override = (settings.get('ai_model_tiers') or {}).get(provider) or ENV_MODEL_TIERS.get(provider)
+    if override and len(override) == 2:
+        return override[0], override[1]
+    return DEFAULT_MODEL_TIERS[provider]
+
+
+class TierStats:
+    '''Per provider and tier: calls, answers accepted without escalation, latency'''
+
+    def __init__(self):
+        self.latencies = LatencyWindow(size=200)
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, tier: str, accepted: bool, seconds: float) -> Dict[str, Any]:
+        key = f'{provider}/{tier}'
+        self.latencies.record(key, seconds)
+        with self._lock:
+            counts = self._counts.setdefault(key, {'calls': 0, 'accepted': 0})
+            counts['calls'] += 1
+            counts['accepted'] += int(accepted)
+            snapshot = dict(counts)
+        snapshot['hit_rate'] = round(snapshot['accepted'] / snapshot['calls'], 3)
+        snapshot['p50_ms'] = round((self.latencies.percentile(key, 50, min_samples=1) or 0) * 1000, 1)
+        return snapshot
@@ -0,0 +1,212 @@
+import math
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, List, Optional, Tuple
+
+import log
+
+# Amounts are integer kopecks, quantities integer thousandths of a unit
+KOPECKS = 100
+QTY_SCALE = 1000
+
+
+def _scaled(value: Any, digits: int) -> int:
+    '''value * 10**digits rounded half-up as its decimal literal reads: 1.005 -> 1.01, not 1.00'''
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return value * 10 ** digits
+    if isinstance(value, float) and -1e12 < value < 1e12:
+        # Float product is exact enough unless it sits right on a half
+        scaled = value * 10 ** digits
+        floor = math.floor(scaled)
+        fraction = scaled - floor
+        if abs(fraction - 0.5) > 1e-6:
+            return floor + 1 if fraction > 0.5 else floor
+    text = repr(value) if isinstance(value, float) else str(value).strip().replace(',', '.')
+    if not text:
+        return 0
+    if 'e' in text or 'E' in text or text in ('nan', 'inf', '-inf'):
+        quantum = Decimal(1).scaleb(-digits)
+        return int(Decimal(text).quantize(quantum, rounding=ROUND_HALF_UP).scaleb(digits))
+
+    negative = text.startswith('-')
+    whole, _, frac = text.lstrip('+-').partition('.')
+    frac = (frac + '0' * (digits + 1))[:digits + 1]
+    scaled = int(whole or '0') * 10 ** digits + int(frac[:digits] or '0')
+    if frac[digits] >= '5':
+        scaled += 1
+    return -scaled if negative else scaled
+
+
+def to_kopecks(value: Any) -> int:
+    return _scaled(value if value is not None else 0, 2)
+
+
+def to_qty(value: Any) -> int:
+    return _scaled(value if value is not None else 1, 3)
+
+
+def rubles(kopecks: int) -> float:
+    return kopecks / KOPECKS
+
+
+def qty_value(qty: int) -> Any:
+    '''Whole quantities stay int in the payload (3, not 3.0)'''
+    return qty // QTY_SCALE if qty % QTY_SCALE == 0 else qty / QTY_SCALE
+
+
+def div_half_up(numerator: int, denominator: int) -> int:
+    if numerator < 0:
+        return -div_half_up(-numerator, denominator)
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def line_sum(price: int, qty: int) -> int:
+    '''Kopeck sum of price (kopecks) x qty (thousandths), the way Ecomkassa checks it'''
+    return div_half_up(price * qty, QTY_SCALE)
+
+
+def fit_price(target_sum: int, qty: int) -> Optional[int]:
+    '''Price whose line_sum with qty is exactly target_sum; always exists for qty < 1 unit'''
+    guess = div_half_up(target_sum * QTY_SCALE, qty)
+    for price in (guess, guess - 1, guess + 1):
+        if price >= 0 and line_sum(price, qty) == target_sum:
+            return price
+    return None
+
+
+class Line:
+    '''One payload position: source item plus exact price, quantity and sum'''
+    __slots__ = ('item', 'price', 'qty', 'sum')
+
+    def __init__(self, item: Dict[str, Any], price: int, qty: int, total: int):
+        self.item = item
+        self.price = price
+        self.qty = qty
+        self.sum = total
+
+
+def item_lines(item: Dict[str, Any]) -> List[Line]:
+    '''
+    Whole quantities give one line. A fractional quantity is split into the
+    whole part at the item price and the fraction with a price fitted so the
+    two lines add up to round(price * quantity).
+    '''
+    price = to_kopecks(item.get('price'))
+    qty = to_qty(item.get('quantity', 1))
+    whole, frac = divmod(qty, QTY_SCALE)
+    if not frac:
+        return [Line(item, price, qty, price * whole)]
+    if qty <= 0:
+        return [Line(item, price, qty, line_sum(price, qty))]
+
+    total = line_sum(price, qty)
+    lines = []
+    whole_sum = 0
+    if whole:
+        whole_sum = price * whole
+        lines.append(Line(item, price, whole * QTY_SCALE, whole_sum))
+    frac_sum = total - whole_sum
+    frac_price = fit_price(frac_sum, frac)
+    lines.append(Line(item, frac_price if frac_price is not None else price, frac, frac_sum))
+    return lines
+
+
+class MoneyError(ValueError):
+    '''Lines cannot add up to the payments total: the receipt must not be sent'''
+
+
+def _absorb(lines: List[Line], index: int, difference: int) -> bool:
+    '''
+    Add difference to lines[index] keeping price * quantity == sum: a single
+    or fractional line gets a re-fitted price, a multi-unit line gives up one
+    unit that takes the difference, or is re-priced as two lines whose unit
+    prices differ by one kopeck when that unit cannot.
+    '''
+    line = lines[index]
+    new_sum = line.sum + difference
+    if new_sum < 0:
+        return False
+    if line.qty <= QTY_SCALE:
+        price = fit_price(new_sum, line.qty)
+        if price is not None:
+            line.price, line.sum = price, new_sum
+            return True
+    if line.qty % QTY_SCALE:
+        return False
+
+    units = line.qty // QTY_SCALE
+    unit_price = line.price + difference
+    if unit_price >= 0:
+        line.qty -= QTY_SCALE
+        line.sum = line_sum(line.price, line.qty)
+        lines.insert(index + 1, Line(line.item, unit_price, QTY_SCALE, unit_price))
+        return True
+    price, extra = divmod(new_sum, units)
+    line.price, line.qty, line.sum = price, (units - extra) * QTY_SCALE, price * (units - extra)
+    if extra:
+        lines.insert(index + 1, Line(line.item, price + 1, extra * QTY_SCALE, (price + 1) * extra))
+    return True
+
+
+def adjust_lines(lines: List[Line], target: int) -> None:
+    '''
+    Make the lines add up to target. The last line takes the whole rounding
+    difference when it can; a larger reduction is spread over earlier lines,
+    each going down to zero at most. Raises MoneyError when nothing fits.
+    '''
+    difference = target - sum(line.sum for line in lines)
+    if not difference:
+        return
+    for index in range(len(lines) - 1, -1, -1):
+        if _absorb(lines, index, difference):
+            return
+        if difference < 0 and _absorb(lines, index, -lines[index].sum):
+            difference = target - sum(line.sum for line in lines)
+    raise MoneyError(f'Сумма позиций не сходится с оплатой на {rubles(difference)} руб.')
+
+
+def build_money(items: List[Dict[str, Any]], payments: Optional[List[Dict[str, Any]]]) -> Tuple[List[Line], List[int], int]:
+    '''
+    Single pass over items and payments: (lines, payment sums, total) in
+    kopecks. Payments define the total, the lines are adjusted to it
+    (MoneyError when they cannot be).
+    '''
+    lines = []
+    for item in items:
+        lines.extend(item_lines(item))
+    items_total = sum(line.sum for line in lines)
+
+    if payments:
+        payment_sums = [to_kopecks(p.get('sum', 0)) for p in payments]
+        total = sum(payment_sums)
+    else:
+        payment_sums = [items_total]
+        total = items_total
+
+    if total != items_total:
+        adjust_lines(lines, total)
+    return lines, payment_sums, total
+
+
+def reconcile_receipt_total(receipt: Dict[str, Any]) -> None:
+    '''
+    Payments, when given, define the receipt total; a single item's price is
+    recalculated from it. Modifies receipt in place.
+    '''
+    payments = receipt.get('payments')
+    if not payments:
+        return
+    total = sum(to_kopecks(p.get('sum', 0)) for p in payments)
+    if total <= 0:
+        return
+
+    items = receipt.get('items') or []
+    items_total = sum(line_sum(to_kopecks(i.get('price')), to_qty(i.get('quantity', 1))) for i in items)
+    if items_total != total:
+        log.debug('Recalculating prices: items_total=%s, payments_total=%s', rubles(items_total), rubles(total))
+        qty = to_qty(items[0].get('quantity', 1)) if len(items) == 1 else 0
+        if qty > 0:
+            items[0]['price'] = rubles(div_half_up(total * QTY_SCALE, qty))
+            log.debug('Updated single item price to %s', items[0]['price'])
+    receipt['total'] = rubles(total)
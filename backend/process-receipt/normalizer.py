@@ -0,0 +1,286 @@
+import re
+from decimal import Decimal
+from typing import List, Optional, Tuple
+
+from rule_parser import MULTIPLY_WORDS, UNIT_WORDS
+
+# Voice transcripts spell out numbers and emails; the parsers only read digits
+# and "@". Tables and patterns are built once at import.
+
+_UNITS = {
+    'ноль': 0, 'один': 1, 'одна': 1, 'одно': 1, 'одну': 1, 'два': 2, 'две': 2, 'три': 3,
+    'четыре': 4, 'пять': 5, 'шесть': 6, 'семь': 7, 'восемь': 8, 'девять': 9
+}
+_TEENS = {
+    'десять': 10, 'одиннадцать': 11, 'двенадцать': 12, 'тринадцать': 13, 'четырнадцать': 14,
+    'пятнадцать': 15, 'шестнадцать': 16, 'семнадцать': 17, 'восемнадцать': 18, 'девятнадцать': 19
+}
+_TENS = {
+    'двадцать': 20, 'тридцать': 30, 'сорок': 40, 'пятьдесят': 50, 'шестьдесят': 60,
+    'семьдесят': 70, 'восемьдесят': 80, 'девяносто': 90, 'полтинник': 50, 'полтос': 50
+}
+_HUNDREDS = {
+    'сто': 100, 'двести': 200, 'триста': 300, 'четыреста': 400, 'пятьсот': 500, 'шестьсот': 600,
+    'семьсот': 700, 'восемьсот': 800, 'девятьсот': 900, 'пятихатка': 500, 'пятихатку': 500
+}
+_SCALES = {
+    'сотня': 100, 'сотни': 100, 'сотню': 100, 'сотен': 100, 'сотка': 100, 'сотку': 100, 'сотки': 100,
+    'тысяча': 1000, 'тысячи': 1000, 'тысячу': 1000, 'тысяч': 1000, 'тыс': 1000,
+    'тыща': 1000, 'тыщи': 1000, 'тыщу': 1000, 'тыщ': 1000,
+    'косарь': 1000, 'косаря': 1000, 'косарей': 1000,
+    'миллион': 1000000, 'миллиона': 1000000, 'миллионов': 1000000, 'млн': 1000000,
+    'лям': 1000000, 'ляма': 1000000, 'лямов': 1000000
+}
+_HALF_WORDS = frozenset(['полтора', 'полторы'])
+# A number right before one of these is a quantity of its own: "2 тысячи 3 штуки"
+# is 2000 and 3, "сто два раза" is 100 and 2
+_QUANTITY_WORDS = frozenset(UNIT_WORDS) | MULTIPLY_WORDS | frozenset([
+    'раз', 'штучки', 'штучек', 'порция', 'порции', 'порций', 'пачка', 'пачки', 'пачек',
+    'упаковка', 'упаковки', 'упаковок', 'бутылка', 'бутылки', 'бутылок', 'килограмм', 'кило'
+])
+_HALF = Decimal('0.5')
+
+# word -> (value, slot it fills, lowest free slot it needs): hundreds 3, tens 2,
+# units 1. Teens fill tens and units at once, so they need the tens slot free.
+_WORD_LEVELS = {}
+for _table, _fills, _needs in ((_UNITS, 1, 1), (_TEENS, 1, 2), (_TENS, 2, 2), (_HUNDREDS, 3, 3)):
+    for _word, _value in _table.items():
+        _WORD_LEVELS[_word] = (_value, _fills, _needs)
+
+_TOKEN_RE = re.compile(
+    r'(?P<num>\d+(?:[.,]\d+)?)(?:(?P<k>[кk])(?!\w))?'
+    r'|(?P<word>[^\W\d_]+)',
+    re.IGNORECASE
+)
+_GAP_RE = re.compile(r'\s*')
+
+_RUB_KOP_RE = re.compile(r'(\d+)\s*(руб[а-яё]*\.?|р\.|₽)\s*(\d{1,2})\s*коп[а-яё]*\.?', re.IGNORECASE)
+_PHONE_RUN_RE = re.compile(r'(?<![\d.,])(\+\s*)?(\d+(?:[\s-]+\d+)*)(?![\d.,])')
+_PHONE_GAP_RE = re.compile(r'[\s-]+')
+_PLUS_RE = re.compile(r'\bплюс\s+(?=\d)', re.IGNORECASE)
+
+_AT = r'(?:собака|собачка|at|эт|@)'
+_DOT = r'(?:точка|dot)'
+_LOCAL_SEP = r'(?:точка|dot|дефис|тире|нижнее\s+подч[её]ркивание|подч[её]ркивание|underscore)'
+_EMAIL_SPOKEN_RE = re.compile(
+    rf'(?<![\w@.-])([\w-]+(?:\s+{_LOCAL_SEP}\s+[\w-]+)*)\s+{_AT}\s+'
+    rf'([\w-]+(?:(?:\s+{_DOT}\s+|\.)[\w-]+)+)',
+    re.IGNORECASE
+)
+_SEP_WORDS_RE = re.compile(rf'\s+({_LOCAL_SEP})\s+', re.IGNORECASE)
+_DOMAIN_SPLIT_RE = re.compile(rf'\s+{_DOT}\s+|\.', re.IGNORECASE)
+
+_SEP_CHARS = {'точка': '.', 'dot': '.', 'дефис': '-', 'тире': '-'}
+_DOMAIN_WORDS = {
+    'мейл': 'mail', 'майл': 'mail', 'мэйл': 'mail', 'маил': 'mail',
+    'гмейл': 'gmail', 'джимейл': 'gmail', 'гмаил': 'gmail', 'джимэйл': 'gmail',
+    'яндекс': 'yandex', 'я': 'ya', 'рамблер': 'rambler', 'инбокс': 'inbox', 'лист': 'list',
+    'бк': 'bk', 'аутлук': 'outlook', 'хотмейл': 'hotmail', 'иклауд': 'icloud',
+    'ру': 'ru', 'ком': 'com', 'нет': 'net', 'орг': 'org', 'су': 'su', 'инфо': 'info',
+    'бай': 'by', 'кз': 'kz', 'рф': 'рф'
+}
+_TLDS = frozenset(['ru', 'com', 'net', 'org', 'su', 'info', 'by', 'kz', 'ua', 'io', 'me', 'biz', 'pro', 'рф'])
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+})
+
+
+class _Numeral:
+    '''Accumulator for one spoken number: total of closed scale groups plus the open group'''
+    __slots__ = ('start', 'end', 'total', 'small', 'level', 'scale', 'words')
+
+    def __init__(self, start: int):
+        self.start = start
+        self.end = start
+        self.total = Decimal(0)
+        self.small: Optional[Decimal] = None
+        self.level = 4          # lowest slot filled in the open group
+        self.scale = 10 ** 12   # last scale applied; the next one must be smaller
+        self.words = 0          # spoken words consumed: a lone digit literal is left as is
+
+    def value(self) -> Decimal:
+        return self.total + (self.small or 0)
+
+    def add_word(self, value: int, fills: int, needs: int) -> bool:
+        if needs >= self.level:
+            return False
+        self.small = (self.small or Decimal(0)) + value
+        self.level = fills
+        self.words += 1
+        return True
+
+    def add_scale(self, scale: int) -> bool:
+        if scale >= self.scale or (self.small is not None and self.small >= scale):
+            return False
+        self.total += (self.small if self.small is not None else 1) * scale
+        self.small = None
+        self.level = 4
+        self.scale = scale
+        self.words += 1
+        return True
+
+
+def _format_number(value: Decimal) -> str:
+    if value == value.to_integral_value():
+        return str(int(value))
+    return format(value.normalize(), 'f')
+
+
+def _numerals(text: str) -> List[Tuple[int, int, str]]:
+    '''(start, end, digits) for every spoken number, scanned in one pass'''
+    replacements = []
+    current: Optional[_Numeral] = None
+    half_at: Optional[int] = None  # end of "с" after a number: "половиной" may follow
+
+    matches = list(_TOKEN_RE.finditer(text))
+
+    def quantity_follows(index: int) -> bool:
+        following = matches[index + 1] if index + 1 < len(matches) else None
+        return following is not None and following.group().lower() in _QUANTITY_WORDS
+
+    def close():
+        nonlocal current
+        if current is not None and current.words:
+            replacements.append((current.start, current.end, _format_number(current.value())))
+        current = None
+
+    for index, match in enumerate(matches):
+        kind = match.lastgroup if match.group('k') is None else 'k'
+        word = match.group().lower()
+        if half_at is not None:
+            if word == 'половиной' and _GAP_RE.fullmatch(text, half_at, match.start()) is not None:
+                half_at = None
+                current.small += _HALF
+                current.level = 0
+                current.words += 1
+                current.end = match.end()
+                continue
+            half_at = None
+            close()
+        if current is not None and _GAP_RE.fullmatch(text, current.end, match.start()) is None:
+            close()
+
+        if kind in ('num', 'k'):
+            number = Decimal(match.group('num').replace(',', '.'))
+            if current is not None and current.small is None and current.scale < 10 ** 12 \
+                    and number == number.to_integral_value() and number < current.scale \
+                    and not quantity_follows(index):
+                # "2 тысячи 500"
+                current.small = number
+                current.level = 0
+                current.end = match.end()
+                continue
+            close()
+            current = _Numeral(match.start())
+            current.small = number
+            current.level = 0
+            current.end = match.end()
+            if kind == 'k':
+                current.add_scale(1000)
+            continue
+
+        if word in _WORD_LEVELS:
+            value, fills, needs = _WORD_LEVELS[word]
+            if current is not None and current.words and quantity_follows(index) and current.level != 2:
+                # Only tens + unit ("двадцать два кг") stays one number before a quantity word
+                close()
+            if current is None or not current.add_word(value, fills, needs):
+                close()
+                current = _Numeral(match.start())
+                current.add_word(value, fills, needs)
+            current.end = match.end()
+            continue
+        if word in _HALF_WORDS:
+            close()
+            current = _Numeral(match.start())
+            current.small = Decimal('1.5')
+            current.level = 0
+            current.words = 1
+            current.end = match.end()
+            continue
+        if word in _SCALES:
+            if current is None or not current.add_scale(_SCALES[word]):
+                close()
+                current = _Numeral(match.start())
+                current.add_scale(_SCALES[word])
+            current.end = match.end()
+            continue
+        if word == 'с' and current is not None and current.small is not None \
+                and current.small == current.small.to_integral_value():
+            half_at = match.end()
+            continue
+        close()
+    close()
+    return replacements
+
+
+def _replace_spans(text: str, replacements: List[Tuple[int, int, str]]) -> str:
+    parts = []
+    position = 0
+    for start, end, replacement in replacements:
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def _rub_kop(match: re.Match) -> str:
+    return f'{match.group(1)}.{int(match.group(3)):02d} {match.group(2)}'
+
+
+def _email_part(word: str) -> str:
+    word = word.lower()
+    return _DOMAIN_WORDS.get(word) or word.translate(_TRANSLIT)
+
+
+def _spoken_email(match: re.Match) -> str:
+    domain_parts = [_email_part(part) for part in _DOMAIN_SPLIT_RE.split(match.group(2))]
+    if domain_parts[-1] not in _TLDS:
+        return match.group()
+    local = _SEP_WORDS_RE.split(match.group(1))
+    local_text = ''.join(
+        _SEP_CHARS.get(part.lower(), '_') if index % 2 else part.lower().translate(_TRANSLIT)
+        for index, part in enumerate(local)
+    )
+    return f'{local_text}@{".".join(domain_parts)}'
+
+
+def _phone(match: re.Match) -> str:
+    '''Digit groups dictated as a phone ("8 916 123 45 67") -> +79161234567'''
+    plus = bool(match.group(1))
+    groups = _PHONE_GAP_RE.split(match.group(2))
+    if not plus and len(groups) < 3:
+        return match.group()
+    for index in range(len(groups)):
+        digits = ''.join(groups[index:])
+        if len(digits) < 11:
+            break
+        if len(digits) == 11 and digits[0] in '78' and (len(groups) - index >= 3 or plus and index == 0):
+            prefix = ' '.join(groups[:index])
+            phone = '+7' + digits[1:]
+            if index == 0:
+                return phone
+            return f'{match.group(1) or ""}{prefix} {phone}'
+    return match.group()
+
+
+def normalize_message(text: str) -> str:
+    '''
+    Spoken numbers, rubles with kopecks, emails and phones -> digits and
+    canonical forms: "тысяча триста рублей двенадцать копеек" ->
+    "1300.12 рублей", "иван собака мейл точка ру" -> "ivan@mail.ru".
+    Text without anything to normalize is returned unchanged.
+    '''
+    replacements = _numerals(text)
+    if replacements:
+        text = _replace_spans(text, replacements)
+    if 'коп' in text:
+        text = _RUB_KOP_RE.sub(_rub_kop, text)
+    if 'плюс' in text.lower():
+        text = _PLUS_RE.sub('+', text)
+    text = _PHONE_RUN_RE.sub(_phone, text)
+    return _EMAIL_SPOKEN_RE.sub(_spoken_email, text)
@@ -0,0 +1,178 @@
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import log
+from db import db_connection
+
+LLM_CACHE_MEMORY_SIZE = int(os.environ.get('LLM_CACHE_MEMORY_SIZE', '512'))
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+LLM_CACHE_DB_MAX = int(os.environ.get('LLM_CACHE_DB_MAX', '50000'))
+# Run DB eviction on roughly one insert out of LLM_CACHE_EVICT_EVERY
+LLM_CACHE_EVICT_EVERY = int(os.environ.get('LLM_CACHE_EVICT_EVERY', '50'))
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_EDGE_PUNCT_RE = re.compile(r'^[\s.,!?;:]+|[\s.,!?;:]+$')
+
+
+def normalize_utterance(text: str) -> str:
+    '''Case, ё, whitespace and trailing punctuation do not change the parse'''
+    text = (text or '').lower().replace('ё', 'е')
+    text = _WHITESPACE_RE.sub(' ', text)
+    return _EDGE_PUNCT_RE.sub('', text)
+
+
+def parse_cache_key(text: str, context: str, provider: str, model: str, default_vat: str,
+                    prompt_extra: Sequence[str] = ()) -> str:
+    '''prompt_extra: the rest of the user message (rule hint, few-shot examples), verbatim'''
+    raw = json.dumps(
+        [normalize_utterance(text), normalize_utterance(context), provider, model, default_vat, list(prompt_extra)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ParseCache:
+    '''
+    LLM parse results: in-process LRU in front of the shared llm_parse_cache
+    table. Concurrent misses on one key wait for a single computation.
+    '''
+
+    def __init__(self, max_entries: int = LLM_CACHE_MEMORY_SIZE, ttl: int = LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, threading.Event] = {}
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'saved_ms': 0}
+
+    def _memory_get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if entry[1] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key: str, value: Dict[str, Any], expires_at: float, latency_ms: int) -> None:
+        with self._lock:
+            self._entries[key] = (value, expires_at, latency_ms)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _record(self, outcome: str, latency_ms: int) -> None:
+        '''Count a lookup and log it at info with the running hit rate of this container'''
+        with self._lock:
+            self.stats[outcome] += 1
+            if outcome != 'misses':
+                self.stats['saved_ms'] += latency_ms
+            snapshot = dict(self.stats)
+        lookups = snapshot['memory_hits'] + snapshot['db_hits'] + snapshot['misses']
+        snapshot['hit_rate'] = round((lookups - snapshot['misses']) / lookups, 3)
+        log.info('llm cache', outcome=outcome, ms=latency_ms, **snapshot)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Optional[Dict[str, Any]]],
+                       cacheable: Callable[[Dict[str, Any]], bool] = bool) -> Optional[Dict[str, Any]]:
+        while True:
+            entry = self._memory_get(key)
+            if entry:
+                self._record('memory_hits', entry[2])
+                return copy.deepcopy(entry[0])
+
+            with self._lock:
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    done = self._inflight[key] = threading.Event()
+                    break
+            # Someone else computes this key: wait and re-check the memory tier
+            if not waiter.wait(timeout=30):
+                return compute()
+
+        try:
+            stored = load_parse_from_db(key)
+            if stored:
+                value, expires_at, latency_ms = stored
+                self._memory_put(key, value, expires_at, latency_ms)
+                self._record('db_hits', latency_ms)
+                return copy.deepcopy(value)
+
+            started = time.monotonic()
+            value = compute()
+            latency_ms = int((time.monotonic() - started) * 1000)
+            if value and cacheable(value):
+                expires_at = time.time() + self.ttl
+                self._memory_put(key, copy.deepcopy(value), expires_at, latency_ms)
+                store_parse_in_db(key, value, self.ttl, latency_ms)
+            self._record('misses', latency_ms)
+            return value
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+            done.set()
+
+
+def load_parse_from_db(key: str) -> Optional[tuple]:
+    if not os.environ.get('DATABASE_URL', ''):
+        return None
+
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE llm_parse_cache SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP "
+                "WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP "
+                "RETURNING response, EXTRACT(EPOCH FROM (expires_at - CURRENT_TIMESTAMP)), latency_ms",
+                (key,)
+            )
+            row = cursor.fetchone()
+            conn.commit()
+            cursor.close()
+
+        if row:
+            return row[0], time.time() + float(row[1]), row[2] or 0
+        return None
+    except Exception as e:
+        log.error('Error reading LLM cache from DB: %s', e)
+        return None
+
+
+def store_parse_in_db(key: str, value: Dict[str, Any], ttl: int, latency_ms: int) -> None:
+    if not os.environ.get('DATABASE_URL', ''):
+        return
+
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO llm_parse_cache (cache_key, response, latency_ms, expires_at) "
+                "VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s)) "
+                "ON CONFLICT (cache_key) DO UPDATE SET "
+                "response = EXCLUDED.response, "
+                "latency_ms = EXCLUDED.latency_ms, "
+                "expires_at = EXCLUDED.expires_at, "
+                "last_hit_at = CURRENT_TIMESTAMP",
+                (key, json.dumps(value, ensure_ascii=False), latency_ms, ttl)
+            )
+            if random.randrange(LLM_CACHE_EVICT_EVERY) == 0:
+                cursor.execute("DELETE FROM llm_parse_cache WHERE expires_at <= CURRENT_TIMESTAMP")
+                cursor.execute(
+                    "DELETE FROM llm_parse_cache WHERE cache_key IN ("
+                    "SELECT cache_key FROM llm_parse_cache ORDER BY last_hit_at DESC OFFSET %s)",
+                    (LLM_CACHE_DB_MAX,)
+                )
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        log.error('Error writing LLM cache to DB: %s', e)
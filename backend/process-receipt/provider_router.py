@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import log
+from db import db_connection
+from hedging import LatencyWindow
+
+CB_FAILURE_THRESHOLD = int(os.environ.get('CB_FAILURE_THRESHOLD', '3'))
+CB_OPEN_SECONDS = float(os.environ.get('CB_OPEN_SECONDS', '30'))
+CB_SYNC_SECONDS = float(os.environ.get('CB_SYNC_SECONDS', '5'))
+# Error rate above which a closed provider loses its place as primary
+CB_MAX_ERROR_RATE = float(os.environ.get('CB_MAX_ERROR_RATE', '0.5'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProviderUnavailable(Exception):
+    '''Timeout, transport error or 5xx from a provider: the only outcome that trips a breaker'''
+
+
+class Breaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.updated_at = 0.0
+        self.probe_in_flight = False
+        self.outcomes: Deque[bool] = deque(maxlen=20)
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+
+class ProviderRouter:
+    '''
+    Circuit breakers plus rolling latency/error windows, keyed by provider
+    and credential hash (breaker_key in index.py) so one tenant's bad key
+    never opens the circuit for others. Breaker state is mirrored to
+    ai_provider_breakers so other instances skip a provider that is known
+    to be down.
+    '''
+
+    def __init__(self, latencies: LatencyWindow):
+        self.latencies = latencies
+        self._breakers: Dict[str, Breaker] = {}
+        self._lock = threading.Lock()
+        self._synced_at = 0.0
+
+    def _breaker(self, provider: str) -> Breaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = Breaker()
+        return breaker
+
+    def _state(self, breaker: Breaker, now: float) -> str:
+        if breaker.state == OPEN and now >= breaker.opened_until:
+            breaker.state = HALF_OPEN
+            breaker.probe_in_flight = False
+        return breaker.state
+
+    def _score(self, provider: str, breaker: Breaker) -> float:
+        latency = self.latencies.percentile(provider, 50, min_samples=1)
+        # Unknown latency ranks behind measured fast providers but ahead of failing ones
+        return (latency if latency is not None else 5.0) * (1 + 4 * breaker.error_rate())
+
+    def choose(self, preferred: str, candidates: List[str]) -> Optional[str]:
+        '''
+        Provider for the next request: preferred while it is healthy, else the
+        healthiest closed breaker, else a half-open one as a single probe.
+        None means every breaker is open.
+        '''
+        self.sync_from_db()
+        now = time.time()
+        providers = [preferred] + [p for p in candidates if p != preferred]
+        with self._lock:
+            closed = [p for p in providers if self._state(self._breaker(p), now) == CLOSED]
+            preferred_breaker = self._breaker(preferred)
+            if preferred in closed and preferred_breaker.error_rate() <= CB_MAX_ERROR_RATE:
+                return preferred
+            if closed:
+                return min(closed, key=lambda p: self._score(p, self._breaker(p)))
+            for provider in providers:
+                breaker = self._breaker(provider)
+                if self._state(breaker, now) == HALF_OPEN and not breaker.probe_in_flight:
+                    breaker.probe_in_flight = True
+                    log.debug('Circuit breaker %s: sending probe', provider)
+                    return provider
+        return None
+
+    def allows(self, provider: str) -> bool:
+        with self._lock:
+            return self._state(self._breaker(provider), time.time()) == CLOSED
+
+    def record(self, provider: str, ok: bool, seconds: float, outage: bool = False) -> None:
+        '''
+        ok: usable answer, feeds the error rate used to rank providers.
+        outage: ProviderUnavailable; anything else (rejected key, bad
+        output) proves the provider is reachable and closes the breaker.
+        '''
+        now = time.time()
+        changed = False
+        with self._lock:
+            breaker = self._breaker(provider)
+            state = self._state(breaker, now)
+            breaker.outcomes.append(ok)
+            breaker.probe_in_flight = False
+            if ok:
+                self.latencies.record(provider, seconds)
+            if not outage:
+                breaker.consecutive_failures = 0
+                if state != CLOSED:
+                    breaker.state = CLOSED
+                    changed = True
+            else:
+                breaker.consecutive_failures += 1
+                if state == HALF_OPEN or breaker.consecutive_failures >= CB_FAILURE_THRESHOLD:
+                    changed = state != OPEN or breaker.opened_until < now + CB_OPEN_SECONDS / 2
+                    breaker.state = OPEN
+                    breaker.opened_until = now + CB_OPEN_SECONDS
+            if changed:
+                breaker.updated_at = now
+                snapshot = (breaker.state, breaker.consecutive_failures, breaker.opened_until)
+        if changed:
+            log.info('Circuit breaker %s: %s', provider, snapshot[0])
+            store_breaker_in_db(provider, *snapshot)
+
+    def sync_from_db(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._synced_at < CB_SYNC_SECONDS:
+            return
+        self._synced_at = now
+        for provider, state, failures, opened_until, updated_at in load_breakers_from_db():
+            with self._lock:
+                breaker = self._breaker(provider)
+                if updated_at > breaker.updated_at:
+                    breaker.state = state
+                    breaker.consecutive_failures = failures
+                    breaker.opened_until = opened_until
+                    breaker.updated_at = updated_at
+
+
+def load_breakers_from_db() -> list:
+    if not os.environ.get('DATABASE_URL', ''):
+        return []
+
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT provider, state, consecutive_failures, "
+                "EXTRACT(EPOCH FROM opened_until), EXTRACT(EPOCH FROM updated_at) "
+                "FROM ai_provider_breakers"
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+        return [(r[0], r[1], r[2], float(r[3] or 0), float(r[4] or 0)) for r in rows]
+    except Exception as e:
+        log.error('Error loading circuit breakers from DB: %s', e)
+        return []
+
+
+def store_breaker_in_db(provider: str, state: str, failures: int, opened_until: float) -> None:
+    if not os.environ.get('DATABASE_URL', ''):
+        return
+
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO ai_provider_breakers (provider, state, consecutive_failures, opened_until, updated_at) "
+                "VALUES (%s, %s, %s, TO_TIMESTAMP(%s) AT TIME ZONE 'UTC', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') "
+                "ON CONFLICT (provider) DO UPDATE SET "
+                "state = EXCLUDED.state, "
+                "consecutive_failures = EXCLUDED.consecutive_failures, "
+                "opened_until = EXCLUDED.opened_until, "
+                "updated_at = EXCLUDED.updated_at",
+                (provider, state, failures, opened_until)
+            )
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        log.error('Error saving circuit breaker to DB: %s', e)
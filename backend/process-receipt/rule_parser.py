@@ -0,0 +1,392 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from money import QTY_SCALE, div_half_up, line_sum, qty_value, rubles, to_kopecks, to_qty
+
+# One alternation, scanned once left to right: no nested quantifiers to backtrack on
+_TOKEN_RE = re.compile(
+    r'(?P<email>[\w.+-]+@[\w-]+(?:\.[\w-]+)+)'
+    r'|(?P<phone>\+?[78][\s-]?\(?\d{3}\)?[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}(?!\d))'
+    r'|(?P<number>\d+(?:[.,]\d+)?)'
+    r'|(?P<currency>₽|руб[а-яё]*\.?|р\.)'
+    r'|(?P<word>[^\W\d_]+(?:-[^\W\d_]+)*)'
+    r'|(?P<sep>[,;\n])',
+    re.IGNORECASE
+)
+
+# Command words that never belong to an item name
+COMMAND_WORDS = frozenset([
+    'чек', 'чека', 'создай', 'создать', 'сделай', 'сделать', 'оформи', 'оформить',
+    'пробей', 'пробить', 'выбей', 'отправь', 'отправить', 'продажа', 'продажу', 'продажи',
+    'продаю', 'продал', 'продали', 'возврат', 'клиенту', 'покупателю', 'почта', 'почту',
+    'почтой', 'email', 'емейл', 'имейл', 'телефон', 'итого', 'всего', 'пожалуйста'
+])
+# Only skipped before an item name starts ("на кофе"), kept inside it ("мебель на заказ")
+LEADING_WORDS = frozenset(['на', 'для', 'мне', 'я', 'нужен', 'нужно'])
+# An item that starts with one of these continues the previous phrase ("доставка 500 на адрес 25")
+CONTINUATION_WORDS = frozenset(['на', 'в', 'во', 'с', 'со', 'до', 'от', 'к', 'из', 'у'])
+
+# Several readings of the numbers are possible: leave the receipt to the LLM
+PRICE_CONFLICT_PENALTY = 0.6
+
+# Receipts the grammar does not model: leave them to the LLM
+UNSUPPORTED_STEMS = (
+    'кредит', 'рассроч', 'аванс', 'предопл', 'взнос', 'скидк', 'процент', 'ндс', 'акциз',
+    'агент', 'коррекц', 'копи', 'повтор', 'дубл', 'еще', 'ещё', 'вчера', 'отмен', 'сдач'
+)
+
+PAYMENT_WORDS = {
+    'наличными': '0', 'наличные': '0', 'наличка': '0', 'наличкой': '0', 'нал': '0', 'налом': '0',
+    'кэш': '0', 'кеш': '0',
+    'картой': '1', 'карта': '1', 'карту': '1', 'безнал': '1', 'безналом': '1',
+    'безналичные': '1', 'безналичными': '1', 'переводом': '1', 'сбп': '1'
+}
+REMAINDER_WORDS = frozenset(['остальное', 'остальные', 'остаток', 'оставшееся'])
+
+# Spoken unit -> measure key understood by build_ecomkassa_payload
+UNIT_WORDS = {
+    'шт': 'шт', 'штук': 'шт', 'штуки': 'шт', 'штука': 'шт', 'штуку': 'шт',
+    'кг': 'кг', 'кило': 'кг', 'килограмм': 'кг', 'килограмма': 'кг', 'килограммов': 'кг',
+    'г': 'г', 'гр': 'г', 'грамм': 'г', 'грамма': 'г', 'граммов': 'г',
+    'т': 'т', 'тонна': 'т', 'тонны': 'т', 'тонн': 'т',
+    'см': 'см', 'м': 'м', 'метр': 'м', 'метра': 'м', 'метров': 'м', 'км': 'км',
+    'л': 'л', 'литр': 'л', 'литра': 'л', 'литров': 'л',
+    'час': 'час', 'часа': 'час', 'часов': 'час', 'ч': 'час',
+    'мин': 'мин', 'минута': 'мин', 'минуты': 'мин', 'минут': 'мин',
+    'сутки': 'сутки', 'суток': 'сутки'
+}
+MULTIPLY_WORDS = frozenset(['x', 'х', 'раза'])
+
+# Trailing remarks like "без почты", "не отправлять чек": dropped, not an unpriced item
+CHATTER_WORDS = frozenset(['без', 'почты', 'не', 'отправлять', 'отправляй', 'надо', 'нужно', 'нужен', 'чек', 'email'])
+
+SERVICE_STEMS = (
+    'консультац', 'стрижк', 'доставк', 'ремонт', 'услуг',
+    'обучени', 'тренинг', 'коучинг', 'массаж', 'сервис',
+    'поддержк', 'настройк', 'установк', 'монтаж', 'укладк'
+)
+
+
+class _Item:
+    __slots__ = ('words', 'qty', 'unit', 'price', 'price_is_total')
+
+    def __init__(self):
+        self.words: List[str] = []
+        self.qty: Optional[int] = None
+        self.unit: Optional[str] = None
+        self.price: Optional[int] = None
+        self.price_is_total = False
+
+
+def tokenize(text: str) -> List[Tuple[str, str]]:
+    return [(match.lastgroup, match.group()) for match in _TOKEN_RE.finditer(text)]
+
+
+def parse_with_rules(text: str) -> Tuple[Optional[Dict[str, Any]], float]:
+    '''
+    Deterministic parse of common cashier phrases ("кофе 2 шт по 150, булка 50
+    руб, 100 наличными остальное картой, a@b.ru"). Returns (receipt in the
+    LLM answer format, confidence 0..1); (None, 0.0) when nothing usable.
+    '''
+    lowered = text.lower()
+    if any(stem in lowered for stem in UNSUPPORTED_STEMS) or '%' in text:
+        return None, 0.0
+
+    items: List[_Item] = []
+    current = _Item()
+    payments: List[List[Any]] = []  # [type, kopecks or None for "the rest"]
+    email = phone = None
+    pending: Optional[str] = None   # number whose role depends on the next token
+    expect: Optional[str] = None    # 'unit_price' after "по", 'total_price' after "за"
+    payment_type: Optional[str] = None
+    penalty = 0.0
+
+    def close_item():
+        nonlocal current
+        chatter = current.price is None and all(w.lower() in CHATTER_WORDS for w in current.words)
+        if not chatter:
+            items.append(current)
+        current = _Item()
+
+    def take_price(value: str, is_total: Optional[bool] = None):
+        '''is_total None: a bare number, the line total when the item already has a quantity'''
+        nonlocal penalty
+        if current.price is not None:
+            close_item()
+            penalty += PRICE_CONFLICT_PENALTY  # second price candidate for one item
+        current.price = to_kopecks(value)
+        # "10 пицц 5000", "пицца 10 шт 5000": dictated as what the line costs
+        current.price_is_total = is_total if is_total is not None else current.qty is not None
+
+    def resolve_pending():
+        nonlocal pending
+        if pending is not None:
+            take_price(pending)
+            pending = None
+
+    tokens = tokenize(text)
+    for index, (kind, value) in enumerate(tokens):
+        word = value.lower()
+        if kind == 'email':
+            email = value
+            continue
+        if kind == 'phone':
+            phone = value
+            continue
+
+        if kind == 'number':
+            if expect == 'unit_price':
+                take_price(value, is_total=False)
+            elif expect == 'total_price':
+                take_price(value, is_total=True)
+            elif payment_type is not None:
+                payments.append([payment_type, to_kopecks(value)])
+                payment_type = None
+            else:
+                if pending is not None:
+                    penalty += PRICE_CONFLICT_PENALTY  # two bare numbers in a row
+                    resolve_pending()
+                pending = value
+            expect = None
+            continue
+
+        if kind == 'currency':
+            resolve_pending()
+            continue
+
+        if kind == 'sep' or word == 'и':
+            resolve_pending()
+            if current.price is not None:
+                close_item()
+            elif word == 'и' and current.words:
+                current.words.append(value)
+            continue
+
+        if word in PAYMENT_WORDS:
+            if pending is not None and current.words and current.price is None:
+                # "кофе 200 наличными": the number is the price, the whole receipt is paid that way
+                resolve_pending()
+                payments.append([PAYMENT_WORDS[word], None])
+            elif pending is not None:
+                payments.append([PAYMENT_WORDS[word], to_kopecks(pending)])
+                pending = None
+            elif payments and payments[-1][0] is None:
+                payments[-1][0] = PAYMENT_WORDS[word]
+            else:
+                payment_type = PAYMENT_WORDS[word]
+            continue
+        if word in REMAINDER_WORDS:
+            resolve_pending()
+            payments.append([None, None])
+            continue
+
+        if word in UNIT_WORDS and (pending is not None or current.qty is None and current.words):
+            if pending is not None:
+                current.qty = to_qty(pending)
+                pending = None
+            current.unit = UNIT_WORDS[word]
+            continue
+        if word in MULTIPLY_WORDS and pending is not None:
+            current.qty = to_qty(pending)
+            pending = None
+            continue
+        if word == 'по':
+            if pending is not None:
+                current.qty = to_qty(pending)
+                pending = None
+            expect = 'unit_price'
+            continue
+        if word == 'за' and index + 1 < len(tokens) and tokens[index + 1][0] == 'number':
+            # "хлеб за 50", "3 кг за 270": price of the whole line; "плата за доставку" stays a name
+            if pending is not None:
+                current.qty = to_qty(pending)
+                pending = None
+            expect = 'total_price'
+            continue
+
+        if word in COMMAND_WORDS:
+            continue
+        if word in LEADING_WORDS and not current.words:
+            continue
+
+        # Plain word: part of an item name
+        if pending is not None and current.price is None and not current.words:
+            current.qty = to_qty(pending)  # "2 кофе по 150"
+            pending = None
+        elif pending is not None:
+            if word not in CHATTER_WORDS and word not in LEADING_WORDS:
+                # "iphone 15 pro 100000": a bare number between name words may be part of the name
+                penalty += PRICE_CONFLICT_PENALTY
+            resolve_pending()
+        if current.price is not None:
+            close_item()
+            if word in CONTINUATION_WORDS:
+                penalty += PRICE_CONFLICT_PENALTY
+            elif word in LEADING_WORDS:
+                continue  # "кофе 200 для a@b.ru": not the start of another item
+        current.words.append(value)
+
+    resolve_pending()
+    close_item()
+    if payment_type is not None:
+        payments.append([payment_type, None])
+
+    return _assemble(items, payments, email, phone, penalty)
+
+
+def _assemble(items: List[_Item], payments: List[List[Any]], email: Optional[str], phone: Optional[str],
+              penalty: float) -> Tuple[Optional[Dict[str, Any]], float]:
+    priced = [item for item in items if item.price is not None]
+    if not priced:
+        return None, 0.0
+
+    confidence = 1.0 - penalty
+    result_items = []
+    total = 0
+    for item in items:
+        if item.price is None:
+            confidence -= 0.5  # words that never got a price
+            continue
+        qty = item.qty if item.qty else QTY_SCALE
+        price = div_half_up(item.price * QTY_SCALE, qty) if item.price_is_total else item.price
+        if item.price_is_total and line_sum(price, qty) != item.price:
+            # "3 кг 100": no unit price gives that total, the reading may be wrong
+            confidence -= PRICE_CONFLICT_PENALTY
+        if not item.words:
+            confidence -= 0.5
+        elif len(item.words) > 6:
+            confidence -= 0.3
+        if price <= 0:
+            confidence -= 0.5
+
+        name = ' '.join(item.words) or 'Товар'
+        name_lower = name.lower()
+        is_service = any(stem in name_lower for stem in SERVICE_STEMS)
+        total += line_sum(price, qty)
+        result_items.append({
+            'name': name,
+            'price': rubles(price),
+            'quantity': qty_value(qty),
+            'measure': item.unit or ('услуга' if is_service else 'шт'),
+            'vat': 'none',
+            'payment_method': 'full_payment',
+            'payment_object': 'service' if is_service else 'commodity'
+        })
+
+    result_payments, payment_penalty = _payments(payments, total)
+    confidence -= payment_penalty
+    return {
+        'items': result_items,
+        'client': {'email': email, 'phone': phone},
+        'payments': result_payments
+    }, max(0.0, min(1.0, confidence))
+
+
+def _payments(payments: List[List[Any]], total: int) -> Tuple[List[Dict[str, Any]], float]:
+    '''Fixed amounts plus at most one "the rest" payment; penalty when they do not add up'''
+    if not payments:
+        return [{'type': '1', 'sum': rubles(total)}], 0.0
+
+    fixed = sum(amount for _, amount in payments if amount is not None)
+    rest = [p for p in payments if p[1] is None]
+    penalty = 0.0
+    if len(rest) > 1 or fixed > total:
+        penalty = 0.6
+    elif not rest and fixed != total:
+        if len(payments) == 1:
+            # "кофе 200 наличными" names the amount and the type at once
+            payments[0][1] = total
+            fixed = total
+        else:
+            penalty = 0.4
+
+    result = []
+    for payment_type, amount in payments:
+        if amount is None:
+            amount = max(0, total - fixed)
+        if amount:
+            result.append({'type': payment_type or '1', 'sum': rubles(amount)})
+    return result or [{'type': '1', 'sum': rubles(total)}], penalty
+
+
+# Not part of an item name when deciding where the next item starts
+_NON_NAME_WORDS = frozenset(UNIT_WORDS) | MULTIPLY_WORDS | frozenset(PAYMENT_WORDS) | REMAINDER_WORDS \
+    | COMMAND_WORDS | LEADING_WORDS | CHATTER_WORDS | frozenset(['по', 'за'])
+
+
+def split_items(text: str) -> Tuple[List[str], str]:
+    '''
+    Item phrases of a dictation, cut with the rule tokenizer where the next
+    item starts: at a separator or "и" after a priced item, or at a name
+    word after one ("хлеб 50 2 кофе по 150" -> "хлеб 50", "2 кофе по 150").
+    Phrases without a name of their own (payments, contacts, commands) are
+    returned joined as the receipt-level rest.
+    '''
+    items: List[str] = []
+    rest: List[str] = []
+    start = 0
+    has_name = has_price = False
+    prev_kind: Optional[str] = None
+    next_start: Optional[int] = None  # second bare number in a row: quantity of the next item
+
+    def cut(end: int, resume: int):
+        nonlocal start, has_name, has_price, next_start
+        phrase = text[start:end].strip(' ,;\n')
+        if phrase:
+            (items if has_name else rest).append(phrase)
+        start = resume
+        has_name = has_price = False
+        next_start = None
+
+    for match in _TOKEN_RE.finditer(text):
+        kind, word = match.lastgroup, match.group().lower()
+        if kind == 'sep' or word == 'и':
+            if has_price or not has_name:
+                cut(match.start(), match.end())
+        elif kind == 'number':
+            if has_price and prev_kind == 'number' and next_start is None:
+                next_start = match.start()
+            elif has_name:
+                has_price = True
+        elif kind == 'word' and word not in _NON_NAME_WORDS:
+            if has_price:
+                resume = next_start if next_start is not None else match.start()
+                cut(resume, resume)
+            has_name = True
+        if kind != 'currency':
+            # "хлеб 50 руб 2 кофе": the currency does not separate the two numbers
+            prev_kind = kind
+    cut(len(text), len(text))
+    return items, ', '.join(rest)
+
+
+def receipt_payments(text: str, total: int) -> Tuple[List[Dict[str, Any]], float]:
+    '''
+    Payments block for items worth total kopecks from the receipt-level
+    phrases of split_items ("500 наличными остальное картой"); whole total
+    by card when none is named. Same penalty as parse_with_rules.
+    '''
+    payments: List[List[Any]] = []
+    pending: Optional[str] = None
+    payment_type: Optional[str] = None
+    for kind, value in tokenize(text):
+        word = value.lower()
+        if kind == 'number':
+            if payment_type is not None:
+                payments.append([payment_type, to_kopecks(value)])
+                payment_type = None
+            else:
+                pending = value
+        elif word in PAYMENT_WORDS:
+            if pending is not None:
+                payments.append([PAYMENT_WORDS[word], to_kopecks(pending)])
+                pending = None
+            elif payments and payments[-1][0] is None:
+                payments[-1][0] = PAYMENT_WORDS[word]
+            else:
+                payment_type = PAYMENT_WORDS[word]
+        elif word in REMAINDER_WORDS:
+            payments.append([None, None])
+    if payment_type is not None:
+        payments.append([payment_type, None])
+    return _payments(payments, total)
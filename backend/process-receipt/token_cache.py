@@ -0,0 +1,82 @@
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# fetch() returns (token, expires_at as unix seconds) or None on failure
+TokenFetcher = Callable[[], Optional[Tuple[str, float]]]
+
+
+def cache_key(*parts: str) -> str:
+    '''Stable key for secrets: never keep raw credentials as dict keys'''
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    '''
+    In-process cache of access tokens that lives across warm invocations.
+    Refreshes proactively refresh_margin seconds before expiry; only one
+    caller per key performs the refresh, others reuse the still valid token
+    or wait for the refresh to finish.
+    '''
+
+    def __init__(self, refresh_margin: float = 60.0):
+        self.refresh_margin = refresh_margin
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def peek(self, key: str) -> Optional[str]:
+        '''Return cached token if it has not expired yet, without fetching'''
+        entry = self._tokens.get(key)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def put(self, key: str, token: str, expires_at: float) -> None:
+        self._tokens[key] = (token, expires_at)
+
+    def get(self, key: str, fetch: TokenFetcher) -> Optional[str]:
+        entry = self._tokens.get(key)
+        now = time.time()
+        if entry and entry[1] - self.refresh_margin > now:
+            return entry[0]
+
+        lock = self._lock_for(key)
+        if entry and entry[1] > now:
+            # Token still usable: refresh in this caller only if nobody else is
+            if not lock.acquire(blocking=False):
+                return entry[0]
+        else:
+            lock.acquire()
+
+        try:
+            entry = self._tokens.get(key)
+            if entry and entry[1] - self.refresh_margin > time.time():
+                return entry[0]
+
+            fetched = fetch()
+            if not fetched:
+                # Keep serving the old token until it really expires
+                if entry and entry[1] > time.time():
+                    return entry[0]
+                return None
+
+            token, expires_at = fetched
+            self._tokens[key] = (token, expires_at)
+            return token
+        finally:
+            lock.release()
+
+    def invalidate(self, key: str, token: Optional[str] = None) -> None:
+        '''Drop cached token; if token is given, only drop it when it is still the cached one'''
+        entry = self._tokens.get(key)
+        if entry and (token is None or entry[0] == token):
+            self._tokens.pop(key, None)
@@ -0,0 +1,133 @@
+'''
+Message classification: one-pass intent lexer (backend/process-receipt/intent_lexer.py)
+against the keyword loops and per-call regexes it replaced in the handler.
+
+    python benchmarks/bench_intent.py [repeats]
+'''
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+from intent_lexer import scan_message  # noqa: E402
+
+# Messages from the UI examples, tests.json, the prompt and support logs
+CORPUS = [
+    'Создай чек на хлеб за 50 рублей и молоко за 80 рублей',
+    'Консультация 5000₽ для ivan@mail.ru',
+    'консультация по бизнесу 5000 рублей',
+    'кофе 200₽ без почты',
+    'услуга 1500₽ не отправлять чек',
+    'Я продаю мебель на заказ за 1300.12 в кредит первоначальный взнос 500',
+    'товар 1000₽, 600 наличными остальное картой',
+    'стрижка и укладка 2500₽',
+    'кофе 2 шт по 150, булка 50 руб',
+    'яблоки 1.5 кг по 120 картой',
+    '2 кофе ещё раз по 150',
+    'создай 10 копий чека 5f3a9c1e-7b2d-4c8e-9a1f-0d6e2b4c8a7f',
+    'еще 10 штук номер 999888',
+    'повтори последний чек',
+    'повтори чек 12345678',
+    'отправь снова',
+    'возврат кофе 200 рублей клиенту test@mail.ru',
+    'коррекция прихода 5000 руб',
+    'исправить расход 300',
+    'привет, как дела?',
+    'расскажи анекдот',
+    'Добрый день! Пробей пожалуйста доставку 350 рублей на почту anna.petrova@yandex.ru',
+    'изготовление шкафа 25000₽ телефон +79161234567',
+    'сахар 3 кг за 270 наличными',
+]
+
+
+IRRELEVANT = [
+    'привет', 'здравствуй', 'добрый', 'доброе', 'hello', 'hi', 'hey',
+    'расскажи', 'что такое', 'как дела', 'анекдот', 'пошути',
+    'кто ты', 'спасибо', 'благодарю', 'помоги', 'помощь',
+    'шутка', 'история', 'сказка', 'стих', 'стоп', 'хватит', 'стой',
+    'привет', 'пока', 'досвидания', 'хай', 'хелло'
+]
+RECEIPT = [
+    'чек', 'товар', 'услуга', 'продаж', 'возврат', 'корр',
+    'руб', '₽', 'email', '@', 'цена', 'сумма', 'отправ', 'созда',
+    'копи', 'повтор', 'дубл', 'еще раз', 'ещё раз'
+]
+GREETING_PATTERNS = [
+    r'^привет', r'^здравствуй', r'^добр[ыо]', r'^hello', r'^hi\b', r'^hey\b', r'^расскажи',
+    r'^что такое', r'^как дела', r'^анекдот', r'^пошути', r'^кто ты', r'^помоги', r'^спасибо'
+]
+BULK_PATTERNS = [
+    r'(?:создай|сделай|отправ[иь])\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|чек[ао]в?)\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
+    r'(\d+)\s+(?:копи[йи]|дубл[ей]я?|раз[аы]?)\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
+    r'(?:создай|сделай)\s+(\d+)\s+штук\s+(?:чека?)?\s*№?\s*([a-zA-Z0-9_-]+)',
+    r'(\d+)\s+(?:копи[йи]|дубл[ей]я?)\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'([a-zA-Z0-9_-]{8,})\s+(?:создай|сделай)\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|чек[ао]в?)',
+    r'([a-zA-Z0-9_-]{8,})\s+(\d+)\s+(?:копи[йи]|дубл[ей]я?|раз[аы]?)'
+]
+REPEAT_PATTERNS = [
+    r'повтор[иь]\s+чек\s+№?\s*([a-zA-Z0-9_-]+)', r'повтор[иь]\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'отправ[иь]\s+снова\s+№?\s*([a-zA-Z0-9_-]+)', r'пересоздай\s+чек\s+№?\s*([a-zA-Z0-9_-]+)',
+    r'создай\s+заново\s+№?\s*([a-zA-Z0-9_-]+)', r'повтор[иь]\s+чек', r'повтор[иь]\s+последний',
+    r'отправ[иь]\s+снова', r'пересоздай\s+чек', r'создай\s+заново'
+]
+
+
+def legacy_operation_type(text_lower):
+    for keyword in ['коррекция расход', 'исправить расход', 'под отчет']:
+        if keyword in text_lower:
+            return 'refund_correction'
+    for keyword in ['коррекция прихода', 'исправить приход', 'коррекция продаж']:
+        if keyword in text_lower:
+            return 'sell_correction'
+    for keyword in ['возврат', 'верни', 'вернуть', 'refund', 'отмен', 'верну', 'возвращ', 'отказ']:
+        if keyword in text_lower:
+            return 'refund'
+    for keyword in ['коррекция', 'исправ', 'корректир', 'ошибк']:
+        if keyword in text_lower:
+            return 'sell_correction'
+    return 'sell'
+
+
+def legacy_classify(message):
+    '''Flags the way the previous handler computed them, regex cache warm as in a hot container'''
+    text_lower = message.lower().strip()
+    receipt = any(keyword in text_lower for keyword in RECEIPT)
+    copy = bool(re.search(r'\d{8,}', message)) and any(k in text_lower for k in ['копи', 'повтор', 'дубл', 'еще', 'ещё'])
+    irrelevant = any(keyword in text_lower for keyword in IRRELEVANT)
+    bulk = any(re.search(pattern, text_lower) for pattern in BULK_PATTERNS)
+    repeat = any(re.search(pattern, text_lower) for pattern in REPEAT_PATTERNS)
+    intent = any(k in text_lower for k in ['копи', 'дубл', 'повтор', 'еще', 'ещё', 'раз', 'штук']) \
+        and any(char.isdigit() for char in message)
+    greeting = any(re.match(pattern, text_lower) for pattern in GREETING_PATTERNS)
+    return irrelevant, receipt, copy, bulk, repeat, intent, greeting, legacy_operation_type(text_lower)
+
+
+def lexer_classify(message):
+    flags = scan_message(message)
+    return (flags.irrelevant, flags.receipt, flags.copy, flags.bulk, flags.repeat, flags.needs_intent,
+            flags.greeting, flags.operation_type)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for name, fn in (('legacy (keyword loops)', legacy_classify), ('one-pass lexer', lexer_classify)):
+        best = min(timeit.repeat(lambda: [fn(m) for m in CORPUS], number=1, repeat=repeats))
+        print(f'{name:24s} {len(CORPUS)} messages: {best * 1e6:8.1f} us ({best * 1e6 / len(CORPUS):.1f} us/message)')
+
+    # bulk/repeat: the lexer is a pre-filter, a hit still runs the command patterns
+    mismatches = [
+        m for m in CORPUS
+        if legacy_classify(m)[:3] + legacy_classify(m)[5:] != lexer_classify(m)[:3] + lexer_classify(m)[5:]
+        or (legacy_classify(m)[3] and not lexer_classify(m)[3])
+        or (legacy_classify(m)[4] and not lexer_classify(m)[4])
+    ]
+    print(f'flag mismatches against legacy: {len(mismatches)}')
+    for message in mismatches:
+        print(f'  {message!r}: legacy={legacy_classify(message)} lexer={lexer_classify(message)}')
+
+
+if __name__ == '__main__':
+    main()
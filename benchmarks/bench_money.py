@@ -0,0 +1,96 @@
+'''
+Payload money building: integer-kopeck engine (backend/process-receipt/money.py)
+against the Decimal/float implementation it replaced in build_ecomkassa_payload.
+
+    python benchmarks/bench_money.py [lines] [repeats]
+'''
+import math
+import os
+import random
+import sys
+import timeit
+from decimal import Decimal, ROUND_HALF_UP
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+from money import QTY_SCALE, build_money, line_sum  # noqa: E402
+
+
+def legacy_build(items, payments):
+    '''Item/total part of the previous build_ecomkassa_payload, without the dict fields'''
+    items_for_payload = []
+    for item in items:
+        qty_decimal = Decimal(str(item.get('quantity', 1)))
+        price_decimal = Decimal(str(item['price']))
+        total_sum = float((price_decimal * qty_decimal).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+        qty_float = float(qty_decimal)
+        qty_int = math.floor(qty_float)
+        qty_frac = qty_float - qty_int
+
+        if qty_frac > 0.001:
+            if qty_int > 0:
+                price_rounded = float(price_decimal.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+                int_sum = float((Decimal(str(price_rounded)) * Decimal(str(qty_int))).quantize(Decimal('0.01')))
+                items_for_payload.append({'price': price_rounded, 'quantity': qty_int, 'sum': int_sum})
+            else:
+                int_sum = 0
+            frac_sum = round(total_sum - int_sum, 2)
+            frac_price = float((Decimal(str(frac_sum)) / Decimal(str(qty_frac))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+            items_for_payload.append({'price': frac_price, 'quantity': qty_frac, 'sum': frac_sum})
+        else:
+            price_rounded = float(price_decimal.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+            item_sum = float((Decimal(str(price_rounded)) * qty_decimal).quantize(Decimal('0.01')))
+            items_for_payload.append({'price': price_rounded, 'quantity': float(qty_decimal), 'sum': item_sum})
+
+    payment_total = round(sum(float(p.get('sum', 0)) for p in payments), 2)
+    items_total = round(sum(item['sum'] for item in items_for_payload), 2)
+    if items_total != payment_total and items_for_payload:
+        difference = round(payment_total - items_total, 2)
+        last_item = items_for_payload[-1]
+        new_sum = round(last_item['sum'] + difference, 2)
+        last_item['sum'] = new_sum
+        price_decimal = Decimal(str(new_sum)) / Decimal(str(last_item['quantity']))
+        last_item['price'] = float(price_decimal.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+    return items_for_payload, payment_total
+
+
+def make_receipt(lines, seed=1):
+    rng = random.Random(seed)
+    items = []
+    for _ in range(lines):
+        quantity = rng.choice([1, 2, 3, 7, 0.5, 1.25, 2.333, 0.125])
+        items.append({'name': 'товар', 'price': round(rng.uniform(1, 5000), 2), 'quantity': quantity})
+    # Payments slightly off from the items total, like a rounded LLM answer
+    total = sum(Decimal(str(i['price'])) * Decimal(str(i['quantity'])) for i in items)
+    paid = float(total.quantize(Decimal('1'))) + 0.03
+    return items, [{'type': '1', 'sum': paid}]
+
+
+def legacy_violations(lines):
+    return sum(
+        1 for line in lines
+        if Decimal(str(line['price'])) * Decimal(str(line['quantity'])) - Decimal(str(line['sum'])) >= Decimal('0.005')
+        or Decimal(str(line['sum'])) - Decimal(str(line['price'])) * Decimal(str(line['quantity'])) > Decimal('0.005')
+    )
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    items, payments = make_receipt(size)
+
+    for name, fn in (('legacy (Decimal/float)', legacy_build), ('kopecks (money.py)', build_money)):
+        best = min(timeit.repeat(lambda: fn(items, payments), number=1, repeat=repeats))
+        print(f'{name:24s} {size} lines: {best * 1e6:10.1f} us')
+
+    legacy_lines, legacy_total = legacy_build(items, payments)
+    lines, _, total = build_money(items, payments)
+    print(f'legacy: total={legacy_total}, lines sum={round(sum(l["sum"] for l in legacy_lines), 2)}, '
+          f'price*quantity!=sum lines: {legacy_violations(legacy_lines)}')
+    print(f'kopecks: total={total / 100}, lines sum={sum(l.sum for l in lines) / 100}, '
+          f'price*quantity!=sum lines: {sum(1 for l in lines if line_sum(l.price, l.qty) != l.sum)} '
+          f'(qty scale {QTY_SCALE})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+Prompt layout: static system message + short user message (build_messages)
+against the previous single user message with the request interpolated near
+the top. Prints estimated prompt tokens and how much of the prompt is a
+prefix shared by all requests, i.e. what provider prompt caching can reuse.
+
+    python benchmarks/bench_prompt.py
+
+Latency is provider-side: compare the "llm call" log lines (ms,
+est_prompt_tokens) and "llm usage" (cached_tokens) before and after.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+from index import CONTEXT_INSTRUCTIONS, INTENT_INSTRUCTIONS, SYSTEM_PROMPT, build_messages, estimate_tokens  # noqa: E402
+
+REQUESTS = [
+    ('кофе 200₽ без почты', ''),
+    ('Консультация 5000₽ для ivan@mail.ru', ''),
+    ('Я продаю мебель на заказ за 1300.12 в кредит первоначальный взнос 500', ''),
+    ('anna@yandex.ru', 'стрижка 1500₽'),
+]
+SPLIT_AFTER = 'dokumentacija_cheki_12).\n\n'
+
+
+def legacy_messages(user_text, context='', with_intent=False):
+    '''Previous layout: one user message, the request right after the two-line preamble'''
+    context_part = f'\n\nКонтекст предыдущего запроса: "{context}"\n\n{CONTEXT_INSTRUCTIONS}' if context else ''
+    head, tail = SYSTEM_PROMPT.split(SPLIT_AFTER, 1)
+    prompt = f'{head}{SPLIT_AFTER}Запрос: "{user_text}"{context_part}\n\n{tail}\n'
+    prompt += (INTENT_INSTRUCTIONS if with_intent else '') + '\nJSON:'
+    return [{'role': 'user', 'content': prompt}]
+
+
+def shared_prefix(texts):
+    first = texts[0]
+    length = len(first)
+    for text in texts[1:]:
+        length = min(length, next((i for i, (a, b) in enumerate(zip(first, text)) if a != b), len(first)))
+    return length
+
+
+def flat(messages):
+    return ''.join(f'{message["role"]}:{message["content"]}' for message in messages)
+
+
+def main():
+    for name, build in (('legacy single message', legacy_messages), ('system + user', build_messages)):
+        prompts = [build(text, context) for text, context in REQUESTS]
+        tokens = [estimate_tokens(messages) for messages in prompts]
+        prefix = shared_prefix([flat(messages) for messages in prompts]) // 3
+        print(f'{name:22s} est. prompt tokens {min(tokens)}-{max(tokens)}, shared prefix ~{prefix} tokens '
+              f'({prefix * 100 // max(tokens)}% cacheable)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS ecomkassa_tokens (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    token TEXT NOT NULL,
+    expires_at TIMESTAMP NOT NULL, -- UTC
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ecomkassa_tokens_expires_at ON ecomkassa_tokens(expires_at);
+
+COMMENT ON TABLE ecomkassa_tokens IS 'Общий кеш токенов Екомкасса между экземплярами функций (токен живёт 24 часа)';
+COMMENT ON COLUMN ecomkassa_tokens.cache_key IS 'sha256 от логина и хеша пароля, сам пароль не хранится';
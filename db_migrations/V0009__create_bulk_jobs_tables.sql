@@ -0,0 +1,37 @@
+CREATE TABLE IF NOT EXISTS bulk_jobs (
+    id VARCHAR(36) PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    original_uuid VARCHAR(255) NOT NULL,
+    operation_type VARCHAR(50) DEFAULT 'sell',
+    receipt JSONB NOT NULL,
+    ecomkassa_payload JSONB NOT NULL,
+    group_code VARCHAR(255) NOT NULL,
+    ecomkassa_login VARCHAR(255),
+    ecomkassa_password VARCHAR(255),
+    total_count INTEGER NOT NULL,
+    done_count INTEGER NOT NULL DEFAULT 0,
+    failed_count INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS bulk_job_copies (
+    job_id VARCHAR(36) NOT NULL REFERENCES bulk_jobs(id),
+    copy_index INTEGER NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    external_id VARCHAR(255),
+    uuid VARCHAR(255),
+    error TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (job_id, copy_index)
+);
+
+CREATE INDEX IF NOT EXISTS idx_bulk_job_copies_pending ON bulk_job_copies(job_id, copy_index) WHERE status IN ('pending', 'processing');
+CREATE INDEX IF NOT EXISTS idx_bulk_jobs_status ON bulk_jobs(status);
+
+COMMENT ON TABLE bulk_jobs IS 'Фоновые задания на создание большого числа копий чека';
+COMMENT ON COLUMN bulk_jobs.ecomkassa_payload IS 'Собранный один раз payload Екомкасса, копии отличаются только external_id и timestamp';
+COMMENT ON COLUMN bulk_jobs.ecomkassa_password IS 'Хранится до завершения задания, затем обнуляется';
+COMMENT ON TABLE bulk_job_copies IS 'Результат по каждой копии: pending/processing/created/failed';
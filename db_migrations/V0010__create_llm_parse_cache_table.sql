@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS llm_parse_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    response JSONB NOT NULL,
+    latency_ms INTEGER DEFAULT 0,
+    hit_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_parse_cache_expires_at ON llm_parse_cache(expires_at);
+CREATE INDEX IF NOT EXISTS idx_llm_parse_cache_last_hit_at ON llm_parse_cache(last_hit_at DESC);
+
+COMMENT ON TABLE llm_parse_cache IS 'Кеш разбора чеков LLM: ключ = sha256(нормализованный текст, контекст, провайдер, модель, default_vat)';
+COMMENT ON COLUMN llm_parse_cache.latency_ms IS 'Время исходного запроса к LLM; hit_count * latency_ms = сэкономленное время';
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS ai_provider_breakers (
+    provider VARCHAR(50) PRIMARY KEY,
+    state VARCHAR(20) NOT NULL DEFAULT 'closed',
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    opened_until TIMESTAMP, -- UTC
+    updated_at TIMESTAMP -- UTC
+);
+
+COMMENT ON TABLE ai_provider_breakers IS 'Состояние circuit breaker по AI провайдерам, общее для всех экземпляров функции';
+COMMENT ON COLUMN ai_provider_breakers.state IS 'closed / open / half_open';
@@ -0,0 +1,18 @@
+UPDATE receipts SET uuid = NULL WHERE uuid = '';
+
+UPDATE receipts
+SET uuid = ecomkassa_response->>'uuid'
+WHERE uuid IS NULL AND COALESCE(ecomkassa_response->>'uuid', '') <> '';
+
+-- Один UUID ЕкомКасса может встречаться в нескольких старых строках: оставляем его у самой новой
+UPDATE receipts older
+SET uuid = NULL
+FROM receipts newer
+WHERE newer.uuid = older.uuid AND newer.id > older.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_receipts_uuid ON receipts(uuid) WHERE uuid IS NOT NULL;
+
+-- Запасной поиск по ответу ЕкомКасса только для строк без заполненной колонки uuid
+CREATE INDEX IF NOT EXISTS idx_receipts_legacy_response_uuid ON receipts ((ecomkassa_response->>'uuid')) WHERE uuid IS NULL;
+
+COMMENT ON COLUMN receipts.uuid IS 'UUID чека в ЕкомКасса (уникальный), по нему ищутся повторы и копии';
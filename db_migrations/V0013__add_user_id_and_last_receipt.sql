@@ -0,0 +1,14 @@
+ALTER TABLE receipts ADD COLUMN IF NOT EXISTS user_id VARCHAR(255);
+ALTER TABLE bulk_jobs ADD COLUMN IF NOT EXISTS user_id VARCHAR(255);
+
+CREATE INDEX IF NOT EXISTS idx_receipts_user_last_success ON receipts(user_id, created_at DESC)
+WHERE status = 'success' AND NOT demo_mode;
+
+CREATE TABLE IF NOT EXISTS last_receipt (
+    user_id VARCHAR(255) PRIMARY KEY,
+    receipt_id INTEGER NOT NULL REFERENCES receipts(id),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON COLUMN receipts.user_id IS 'Анонимный ID пользователя из заголовка X-User-Id';
+COMMENT ON TABLE last_receipt IS 'Последний успешный (не демо) чек пользователя для команды «повтори последний», обновляется в одной транзакции с записью чека';
@@ -0,0 +1,5 @@
+-- Breakers are now keyed by provider and credential hash ("gptunnel_chatgpt:6ab9f1eb8f7d");
+-- rows keyed by the bare provider name are shared by all tenants and no longer read
+DELETE FROM ai_provider_breakers WHERE provider NOT LIKE '%:%';
+
+COMMENT ON COLUMN ai_provider_breakers.provider IS 'Провайдер и первые 12 символов sha256 ключа доступа, без самого ключа';
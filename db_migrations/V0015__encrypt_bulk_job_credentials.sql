@@ -0,0 +1,14 @@
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+
+ALTER TABLE bulk_jobs ADD COLUMN IF NOT EXISTS ecomkassa_credentials BYTEA;
+ALTER TABLE bulk_jobs ADD COLUMN IF NOT EXISTS credentials_expire_at TIMESTAMP;
+
+-- Plaintext login/password are no longer kept; unfinished jobs fail on the next worker run
+ALTER TABLE bulk_jobs DROP COLUMN IF EXISTS ecomkassa_login;
+ALTER TABLE bulk_jobs DROP COLUMN IF EXISTS ecomkassa_password;
+
+CREATE INDEX IF NOT EXISTS idx_bulk_jobs_credentials_expire ON bulk_jobs(credentials_expire_at)
+WHERE ecomkassa_credentials IS NOT NULL;
+
+COMMENT ON COLUMN bulk_jobs.ecomkassa_credentials IS 'Логин и пароль Екомкасса, зашифрованные pgp_sym_encrypt ключом BULK_JOB_SECRET; обнуляются по завершении задания или по истечении срока';
+COMMENT ON COLUMN bulk_jobs.credentials_expire_at IS 'После этого момента доступ к Екомкасса не расшифровывается, оставшиеся копии помечаются ошибкой';
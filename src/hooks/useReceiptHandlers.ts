@@ -2,7 +2,7 @@ import { useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { toast } from 'sonner';
 import { Message } from '@/types/message';
-import { sendReceiptPreview, confirmReceipt } from '@/services/receiptApi';
+import { sendReceiptPreview, confirmReceipt, getBulkJobStatus } from '@/services/receiptApi';
 
 const OPERATION_NAMES: Record<string, string> = {
   sell: 'Продажа',
@@ -11,6 +11,10 @@ const OPERATION_NAMES: Record<string, string> = {
   refund_correction: 'Коррекция расхода'
 };
 
+// Bulk copy jobs are advanced by a backend timer every minute or so
+const BULK_POLL_INTERVAL_MS = 3000;
+const BULK_POLL_TIMEOUT_MS = 30 * 60 * 1000;
+
 export const useReceiptHandlers = (
   setMessages: React.Dispatch<React.SetStateAction<Message[]>>,
   pendingReceipt: any,
@@ -24,6 +28,27 @@ export const useReceiptHandlers = (
   const navigate = useNavigate();
   const [isProcessing, setIsProcessing] = useState(false);
 
+  const pollBulkJob = async (jobId: string, progressMessageId: string) => {
+    // The backend worker creates the copies; stop waiting after BULK_POLL_TIMEOUT_MS
+    const deadline = Date.now() + BULK_POLL_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+      await new Promise((resolve) => setTimeout(resolve, BULK_POLL_INTERVAL_MS));
+      const status = await getBulkJobStatus(jobId);
+      if (status.error || status.status === 'done') {
+        return status;
+      }
+      const eta = status.eta_seconds ? `, осталось ~${Math.ceil(status.eta_seconds)} с` : '';
+      setMessages((prev) => prev.map(m =>
+        m.id === progressMessageId ? { ...m, content: `${status.message}${eta}` } : m
+      ));
+    }
+    return {
+      success: false,
+      job_id: jobId,
+      message: `Задание ${jobId} ещё выполняется, копии продолжат создаваться. Проверь результат позже`,
+    };
+  };
+
   const handleSendMessage = async (input: string, operationType: string, setInput: (value: string) => void) => {
     if (!input.trim() || isProcessing) return;
     
@@ -167,7 +192,7 @@ export const useReceiptHandlers = (
       const savedSettings = localStorage.getItem('ecomkassa_settings');
       const settings = savedSettings ? JSON.parse(savedSettings) : {};
       
-      const data = await confirmReceipt(
+      let data = await confirmReceipt(
         pendingReceipt.userInput,
         pendingReceipt.operationType,
         editedData,
@@ -175,6 +200,13 @@ export const useReceiptHandlers = (
         settings
       );
 
+      if (data.job_id) {
+        setMessages((prev) => prev.map(m =>
+          m.id === processingMessageId ? { ...m, content: data.message } : m
+        ));
+        data = await pollBulkJob(data.job_id, processingMessageId);
+      }
+
       const typeName = OPERATION_NAMES[pendingReceipt.operationType] || pendingReceipt.operationType;
       const messageContent = data.success 
         ? (data.message || 'Чек успешно отправлен в ЕкомКасса') 
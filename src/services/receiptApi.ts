@@ -1,3 +1,5 @@
+import { getUserId } from '@/utils/userId';
+
 const RECEIPT_API_URL = 'https://functions.poehali.dev/734da785-2867-4c5d-b20c-90fc6d86b11c';
 
 export const sendReceiptPreview = async (
@@ -14,6 +16,7 @@ export const sendReceiptPreview = async (
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'X-User-Id': getUserId(),
       },
       body: JSON.stringify({
         message: userInput,
@@ -49,6 +52,7 @@ export const confirmReceipt = async (
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'X-User-Id': getUserId(),
       },
       body: JSON.stringify({
         message: userInput,
@@ -67,4 +71,11 @@ export const confirmReceipt = async (
     clearTimeout(timeoutId);
     throw error;
   }
-};
\ No newline at end of file
+};
+
+export const getBulkJobStatus = async (jobId: string) => {
+  const response = await fetch(`${RECEIPT_API_URL}?job_id=${encodeURIComponent(jobId)}`, {
+    method: 'GET'
+  });
+  return response.json();
+};
@@ -0,0 +1,126 @@
+'''
+Pooled Postgres connections (backend/process-receipt/db.py).
+
+The stub tests run anywhere. The live test needs a local Postgres:
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/postgres python -m pytest tests
+'''
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+import db  # noqa: E402
+
+
+class StubCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        self.conn.pings += 1
+        if self.conn.stale:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    def __init__(self, number, stale):
+        self.number = number
+        self.stale = stale
+        self.closed = 0
+        self.pings = 0
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class StubPool:
+    '''Idle connections handed out first, then new ones, like ThreadedConnectionPool'''
+
+    def __init__(self, idle):
+        self.idle = list(idle)
+        self.opened = 0
+
+    def getconn(self):
+        if self.idle:
+            return self.idle.pop(0)
+        self.opened += 1
+        return StubConnection(100 + self.opened, stale=False)
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.closed = 1
+        else:
+            self.idle.append(conn)
+
+
+@pytest.fixture(autouse=True)
+def clean_last_used():
+    db._last_used.clear()
+    yield
+    db._last_used.clear()
+
+
+def test_checkout_skips_every_stale_connection():
+    stale = [StubConnection(n, stale=True) for n in range(1, db.DB_POOL_MAX + 1)]
+    for conn in stale:
+        db._last_used[id(conn)] = time.monotonic() - db.DB_POOL_PING_IDLE - 1
+    pool = StubPool(stale)
+
+    conn = db._checkout(pool)
+
+    assert conn.number == 101
+    assert all(old.closed for old in stale)
+
+
+def test_new_connection_is_not_pinged():
+    pool = StubPool([])
+    conn = db._checkout(pool)
+    assert conn.pings == 0
+
+
+def test_recently_used_connection_is_not_pinged():
+    recent = StubConnection(1, stale=False)
+    db._last_used[id(recent)] = time.monotonic()
+    assert db._checkout(StubPool([recent])) is recent
+    assert recent.pings == 0
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_DATABASE_URL'), reason='TEST_DATABASE_URL not set')
+def test_live_pool_recovers_after_backend_restart(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', os.environ['TEST_DATABASE_URL'])
+    monkeypatch.setattr(db, 'DB_POOL_PING_IDLE', 0.0)
+    pids = []
+    for _ in range(2):
+        with db.db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_backend_pid()')
+            pids.append(cursor.fetchone()[0])
+            cursor.close()
+    assert pids[0] == pids[1], 'second checkout should reuse the pooled connection'
+
+    # Simulate a server restart for the pooled connection
+    admin = psycopg2.connect(os.environ['TEST_DATABASE_URL'])
+    admin.autocommit = True
+    cursor = admin.cursor()
+    cursor.execute('SELECT pg_terminate_backend(%s)', (pids[0],))
+    cursor.close()
+    admin.close()
+
+    with db.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT pg_backend_pid()')
+        assert cursor.fetchone()[0] != pids[0]
+        cursor.close()
+    db.get_pool().closeall()
@@ -0,0 +1,90 @@
+'''
+Integer-kopeck receipt money (backend/process-receipt/money.py).
+
+    python -m pytest tests
+'''
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+from money import MoneyError, QTY_SCALE, _scaled, build_money, item_lines, line_sum  # noqa: E402
+
+
+@pytest.mark.parametrize('value, digits, expected', [
+    (1.005, 2, 101),
+    (2.675, 2, 268),
+    ('1,5', 2, 150),
+    ('0.0005', 3, 1),
+    (-1.005, 2, -101),
+    (7, 2, 700),
+    (True, 2, 100),
+    ('1e3', 2, 100000),
+    ('', 2, 0),
+    (0.333, 3, 333),
+])
+def test_scaled_rounds_half_up_as_written(value, digits, expected):
+    assert _scaled(value, digits) == expected
+
+
+def assert_exact(lines):
+    for line in lines:
+        assert line.price >= 0
+        assert line_sum(line.price, line.qty) == line.sum
+
+
+def test_whole_quantity_is_one_line():
+    lines = item_lines({'price': 150, 'quantity': 3})
+    assert [(line.price, line.qty, line.sum) for line in lines] == [(15000, 3 * QTY_SCALE, 45000)]
+
+
+def test_fractional_quantity_is_split():
+    lines = item_lines({'price': 99.99, 'quantity': 2.5})
+    assert_exact(lines)
+    assert [line.qty for line in lines] == [2 * QTY_SCALE, QTY_SCALE // 2]
+    assert sum(line.sum for line in lines) == line_sum(9999, 2500)
+
+
+def test_rounding_difference_goes_to_last_line():
+    lines, payment_sums, total = build_money([{'price': 33.33, 'quantity': 3}], [{'sum': 100}])
+    assert total == 10000 and payment_sums == [10000]
+    assert_exact(lines)
+    assert sum(line.sum for line in lines) == total
+
+
+def test_reduction_larger_than_last_line_is_spread():
+    items = [{'price': 500, 'quantity': 1}, {'price': 10, 'quantity': 1}]
+    lines, _, total = build_money(items, [{'sum': 400}])
+    assert_exact(lines)
+    assert sum(line.sum for line in lines) == total == 40000
+
+
+def test_multi_unit_line_is_repriced_when_one_unit_cannot_take_it():
+    lines, _, total = build_money([{'price': 10, 'quantity': 5}], [{'sum': 20}])
+    assert_exact(lines)
+    assert sum(line.sum for line in lines) == total == 2000
+
+
+def test_negative_total_is_an_error():
+    with pytest.raises(MoneyError):
+        build_money([{'price': 10, 'quantity': 1}], [{'sum': -5}])
+
+
+def test_random_receipts_add_up():
+    rng = random.Random(20000)
+    for _ in range(20000):
+        items = [
+            {'price': round(rng.uniform(0.01, 500), 2), 'quantity': rng.choice([1, 2, 3, 7, 0.5, 0.333, 1.5, 2.75])}
+            for _ in range(rng.randint(1, 4))
+        ]
+        payments = None
+        if rng.random() < 0.8:
+            total = round(rng.uniform(0.01, 3000), 2)
+            parts = rng.randint(1, 3)
+            payments = [{'sum': round(total / parts, 2)} for _ in range(parts)]
+        lines, payment_sums, total = build_money(items, payments)
+        assert_exact(lines)
+        assert sum(line.sum for line in lines) == total == sum(payment_sums)
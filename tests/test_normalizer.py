@@ -0,0 +1,45 @@
+'''
+Voice transcript normalization (backend/process-receipt/normalizer.py).
+
+    python -m pytest tests
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+from normalizer import normalize_message  # noqa: E402
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('кофе 2 тысячи 3 штуки', 'кофе 2000 3 штуки'),
+    ('2 тысячи 5 кг сахара', '2000 5 кг сахара'),
+    ('кофе сто два раза', 'кофе 100 2 раза'),
+    ('две тысячи три штуки', '2000 3 штуки'),
+])
+def test_quantity_is_not_merged_into_amount(text, expected):
+    assert normalize_message(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('двадцать два килограмма', '22 килограмма'),
+    ('две тысячи пятьсот рублей', '2500 рублей'),
+    ('2 тысячи 500', '2500'),
+    ('тысяча триста рублей двенадцать копеек', '1300.12 рублей'),
+    ('полторы тысячи', '1500'),
+    ('три с половиной кг', '3.5 кг'),
+])
+def test_spoken_amounts(text, expected):
+    assert normalize_message(text) == expected
+
+
+def test_spoken_email_and_phone():
+    assert normalize_message('иван собака мейл точка ру') == 'ivan@mail.ru'
+    assert normalize_message('телефон 8 916 123 45 67') == 'телефон +79161234567'
+
+
+def test_plain_text_unchanged():
+    text = 'Консультация 5000₽ для ivan@mail.ru'
+    assert normalize_message(text) == text
@@ -0,0 +1,68 @@
+'''
+LLM parse cache in front of the providers (cached_ai_completion in
+backend/process-receipt/index.py). Runs without DATABASE_URL: memory tier only.
+
+    python -m pytest tests
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+if os.environ.get('DATABASE_URL'):
+    pytest.skip('memory tier only, unset DATABASE_URL', allow_module_level=True)
+
+import index  # noqa: E402
+from parse_cache import ParseCache  # noqa: E402
+
+SETTINGS = {
+    'active_ai_provider': 'gigachat',
+    'gigachat_auth_key': 'gigachat-key',
+    'yandexgpt_api_key': 'yandex-key',
+    'yandexgpt_folder_id': 'folder',
+    'ai_hedging': False,
+    'ai_tiered_routing': False,
+}
+
+
+def answer():
+    return {'items': [{'name': 'Кофе', 'price': 200, 'quantity': 1}], 'payments': [{'type': '1', 'sum': 200}]}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(index, 'LLM_PARSE_CACHE', ParseCache())
+    monkeypatch.setattr(index, 'call_gigachat', lambda *args: calls.append('gigachat') or answer())
+    monkeypatch.setattr(index, 'call_yandexgpt', lambda *args: calls.append('yandexgpt') or answer())
+    return calls
+
+
+def route_to(monkeypatch, provider):
+    key = index.breaker_key(provider, SETTINGS)
+    monkeypatch.setattr(index.PROVIDER_ROUTER, 'choose', lambda preferred, candidates: key)
+
+
+def test_primary_answer_is_cached(monkeypatch, calls):
+    route_to(monkeypatch, 'gigachat')
+    first = index.cached_ai_completion('кофе 200', SETTINGS)
+    second = index.cached_ai_completion('кофе 200', SETTINGS)
+    assert calls == ['gigachat']
+    assert first == second == answer()
+
+
+def test_failover_answer_is_not_served_under_primary_key(monkeypatch, calls):
+    route_to(monkeypatch, 'yandexgpt')
+    assert index.cached_ai_completion('кофе 200', SETTINGS) == answer()
+    route_to(monkeypatch, 'gigachat')
+    index.cached_ai_completion('кофе 200', SETTINGS)
+    assert calls == ['yandexgpt', 'gigachat']
+
+
+def test_examples_are_part_of_the_key(monkeypatch, calls):
+    route_to(monkeypatch, 'gigachat')
+    index.cached_ai_completion('кофе 200', SETTINGS, examples='Примеры похожих запросов:\n- "чай 100" → {}')
+    index.cached_ai_completion('кофе 200', SETTINGS, examples='')
+    assert calls == ['gigachat', 'gigachat']
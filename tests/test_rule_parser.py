@@ -0,0 +1,91 @@
+'''
+Rule parser (backend/process-receipt/rule_parser.py): receipts it must parse
+with full confidence and phrases it must leave to the LLM.
+
+    python -m pytest tests
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'process-receipt'))
+
+from rule_parser import parse_with_rules  # noqa: E402
+
+# index.RULE_PARSE_MIN_CONFIDENCE default; index itself needs the deploy environment
+MIN_CONFIDENCE = 0.9
+
+
+def lines(receipt):
+    return [(item['name'], item['price'], item['quantity']) for item in receipt['items']]
+
+
+def test_za_marks_price_without_quantity():
+    receipt, confidence = parse_with_rules('Создай чек на хлеб за 50 рублей и молоко за 80 рублей')
+    assert confidence >= MIN_CONFIDENCE
+    assert lines(receipt) == [('хлеб', 50.0, 1), ('молоко', 80.0, 1)]
+    assert receipt['payments'] == [{'type': '1', 'sum': 130.0}]
+
+
+def test_za_with_quantity_is_line_total():
+    receipt, confidence = parse_with_rules('сахар 3 кг за 270')
+    assert confidence >= MIN_CONFIDENCE
+    assert lines(receipt) == [('сахар', 90.0, 3)]
+
+
+def test_za_before_word_stays_in_name():
+    receipt, confidence = parse_with_rules('плата за доставку 500 руб')
+    assert confidence >= MIN_CONFIDENCE
+    assert lines(receipt) == [('плата за доставку', 500.0, 1)]
+
+
+@pytest.mark.parametrize('text', [
+    'кофе 200 без почты',
+    'кофе 200 не отправлять чек',
+    'кофе 200 для a@b.ru',
+    'кофе 200 для email a@b.ru',
+])
+def test_trailing_chatter_keeps_confidence(text):
+    receipt, confidence = parse_with_rules(text)
+    assert confidence >= MIN_CONFIDENCE
+    assert lines(receipt) == [('кофе', 200.0, 1)]
+
+
+@pytest.mark.parametrize('text', ['10 пицц 5000', 'пицца 10 шт 5000'])
+def test_bare_price_after_quantity_is_line_total(text):
+    receipt, confidence = parse_with_rules(text)
+    assert confidence >= MIN_CONFIDENCE
+    assert [(price, qty) for _, price, qty in lines(receipt)] == [(500.0, 10)]
+    assert receipt['payments'] == [{'type': '1', 'sum': 5000.0}]
+
+
+@pytest.mark.parametrize('text', [
+    'сахар 3 кг 100',
+    'iphone 15 pro 100000',
+    'кофе 200 сдача с 500',
+    'доставка 500 на адрес 25',
+    'кофе 200 руб 300 руб',
+])
+def test_ambiguous_numbers_go_to_llm(text):
+    _, confidence = parse_with_rules(text)
+    assert confidence < MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('кофе 2 шт по 150, булка 50 руб', [('кофе', 150.0, 2), ('булка', 50.0, 1)]),
+    ('2 кофе по 150', [('кофе', 150.0, 2)]),
+    ('хлеб 50 руб молоко 80 руб', [('хлеб', 50.0, 1), ('молоко', 80.0, 1)]),
+    ('мебель на заказ 5000', [('мебель на заказ', 5000.0, 1)]),
+])
+def test_plain_receipts_stay_confident(text, expected):
+    receipt, confidence = parse_with_rules(text)
+    assert confidence >= MIN_CONFIDENCE
+    assert lines(receipt) == expected
+
+
+def test_payment_split():
+    receipt, confidence = parse_with_rules('кофе 200₽, 100 наличными остальное картой, a@b.ru')
+    assert confidence >= MIN_CONFIDENCE
+    assert receipt['payments'] == [{'type': '0', 'sum': 100.0}, {'type': '1', 'sum': 100.0}]
+    assert receipt['client']['email'] == 'a@b.ru'
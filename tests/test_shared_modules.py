@@ -0,0 +1,37 @@
+'''
+Every cloud function under backend/ is deployed from its own directory, so
+shared helpers (log.py, tracing.py, http_client.py) are copied into each
+function that uses them. A module with the same name must stay identical in
+all of them: change one copy, copy it over the others.
+
+    python -m pytest tests
+'''
+import os
+from collections import defaultdict
+
+import pytest
+
+BACKEND = os.path.join(os.path.dirname(__file__), '..', 'backend')
+
+
+def shared_modules():
+    copies = defaultdict(list)
+    for function in sorted(os.listdir(BACKEND)):
+        directory = os.path.join(BACKEND, function)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if name.endswith('.py') and name != 'index.py':
+                copies[name].append(os.path.join(directory, name))
+    return sorted((name, paths) for name, paths in copies.items() if len(paths) > 1)
+
+
+@pytest.mark.parametrize('name, paths', shared_modules(), ids=lambda value: value if isinstance(value, str) else '')
+def test_copies_have_not_drifted(name, paths):
+    contents = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents[os.path.relpath(path, BACKEND)] = f.read()
+    reference = contents[os.path.relpath(paths[0], BACKEND)]
+    drifted = [path for path, content in contents.items() if content != reference]
+    assert not drifted, f'{name} differs from {os.path.relpath(paths[0], BACKEND)} in: {", ".join(drifted)}'